@@ -17,6 +17,8 @@ Options:
     --thresh <t>                Threshold for proportion area for including in data [default: .4]
     -h --help                   Show help
     -n --ndv <n>                Colon seperated list of no data values (see note below) [default [0;255]]
+    -j --jobs <n>               Number of processes for tile statistics [default: 1]
+    --checkpoint                Checkpoint tile statistics to '<output>.ckpt'
     <lcmap>                     Input landcover map for determining study area (raster)
     <map>                       Input change map (raster)
     <output>                    Output strata file (vector)
@@ -33,18 +35,34 @@ Notes:
     If a final strata including both change and stable classes has been created, the file
     can be used for both the <lcmap> and <changemap> inputs.
 
+    With '--checkpoint', tile statistics are checkpointed to the '<output>.ckpt' directory.
+    An interrupted run resumes from the tiles already counted, and a re-run only recounts
+    tiles whose geometry changed, that overlap changed tiles or that touch map blocks
+    whose pixels changed. Map blocks are only read again to check them when the size or
+    modification time of their file changed.
+
+    Change map class counts of every tile kept are written to '<output>.counts.npz',
+    which 4_SecondStageSample.py can read (--counts) instead of recounting pixels.
+
 Example:
 
     > 1_Prep_VHR.py --ndv '0; 255' -v --thresh .4 changemap.shp rapideye.shp strata.shp
 
 """
 from docopt import docopt
-from osgeo import ogr, osr
+from osgeo import ogr
 import numpy as np
 import gdal
 import os
 import sys
 
+from histogram import cached_histogram
+from raster_io import open_dataset, set_block_cache
+from tile_index import load_tile_index, mask_pixels
+from vector_io import read_layer, write_features
+from zonal import (tile_counts_filename, tile_histograms_pool,
+                   write_tile_counts)
+
 #Logging
 import logging
 VERBOSE = False
@@ -60,9 +78,39 @@ logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
 logger = logging.getLogger(__name__)
 
 
-def prep_vhr(changemap, rapideye, output,lcmap, thresh, ndv):
+def prep_vhr(changemap, rapideye, output,lcmap, thresh, ndv, jobs=1,
+             checkpoint=False):
     """ Prepare the VHR tile vector based on a corresponding change map"""
 
+    #Counts can be checkpointed next to the output so interrupted runs resume
+    #and re-runs only recount tiles that changed
+    tiles, in_fields, ch_classes, ch_counts = tile_statistics(
+        changemap, rapideye, lcmap, thresh, ndv, jobs,
+        checkpoint=output + '.ckpt' if checkpoint else None)
+
+    #Write kept tiles with their input attributes and zonal statistics
+    rapideye_open, _ = open_shapefile(rapideye)
+    write_strata(output, rapideye_open.GetLayer(), tiles, in_fields)
+    rapideye_open.Destroy()
+
+    #Save change map class counts of kept tiles next to the output, so later
+    #stages get populations without reading pixels
+    write_tile_counts(tile_counts_filename(output), tiles['SampID'],
+                      ch_classes, ch_counts, tiles['overlap'],
+                      open_dataset(changemap))
+
+
+def tile_statistics(changemap, rapideye, lcmap, thresh, ndv, jobs=1,
+                    checkpoint=None, counts=None):
+    """ Return attributes, geometries and zonal statistics of the VHR tiles
+        kept, with change map class counts of each and the pixels of each
+        counted in an overlapping tile ('overlap')
+
+        `counts` are the land cover and change map classes and their pixel
+        counts within every tile (one row per FID), if already counted;
+        otherwise the maps are read. Tiles without a `SampID` attribute are
+        numbered in layer order. """
+
     #Open the change map and vector tiles
     changemap_open, _ = open_raster(changemap)
     lc_open, _ = open_raster(lcmap)
@@ -70,6 +118,77 @@ def prep_vhr(changemap, rapideye, output,lcmap, thresh, ndv):
 
     #Open layer on VHR vector
     rapideyelayer = rapideye_open.GetLayer()
+    inLayerDefn = rapideyelayer.GetLayerDefn()
+
+    #Total number of tiles in vector file
+    totalfeats = len(rapideyelayer)
+
+    #Count pixels of each class within every tile in one pass over the maps
+    if counts is not None:
+        lc_classes, lc_counts, ch_classes, ch_counts = counts
+    else:
+        lc_classes, _ = cached_histogram(lcmap, 1, ds=lc_open)
+        ch_classes, _ = cached_histogram(changemap, 1, ds=changemap_open)
+        #With several processes, each counts a range of blocks with its own
+        #handles
+        logger.debug('Counting map pixels within tiles with {n} process(es)'.format(n=jobs))
+        lc_counts, ch_counts = tile_histograms_pool(rapideye,
+                                                    [lcmap, changemap],
+                                                    [lc_classes, ch_classes],
+                                                    jobs,
+                                                    checkpoint=checkpoint)
+
+    #Read tile attributes and geometries in one pass
+    tiles = read_layer(rapideyelayer)
+    in_fields = [inLayerDefn.GetFieldDefn(i).GetName()
+                 for i in range(inLayerDefn.GetFieldCount())]
+    if 'SampID' not in tiles:
+        tiles['SampID'] = np.arange(tiles['fid'].size)
+
+    #Zonal statistics of each tile
+    kept = []
+    stats = []
+    for i, fid in enumerate(tiles['fid']):
+
+        #Skip tiles outside the maps or below the land cover threshold
+        _1, proportion_lc, _2, _3 = zonal_stats(lc_counts[fid], lc_classes, ndv)
+        if proportion_lc is None or proportion_lc < thresh:
+            continue
+        area, proportion, pix, totalpix = zonal_stats(ch_counts[fid], ch_classes, ndv)
+        if proportion is None:
+            continue
+        kept.append(i)
+        stats.append((area, proportion, pix, totalpix))
+    logger.debug('Keeping {n} of {t} tiles'.format(n=len(kept), t=totalfeats))
+
+    #Columns of kept tiles
+    kept = np.array(kept, dtype=np.int64)
+    stats = np.array(stats, dtype=np.float64).reshape(-1, 4)
+    columns = dict((name, tiles[name][kept])
+                   for name in set(in_fields + ['fid', 'SampID']))
+    columns['wkb'] = [tiles['wkb'][i] for i in kept]
+    columns['area'] = stats[:, 0].astype(np.int64)
+    columns['proportion'] = stats[:, 1]
+    columns['ch_pix'] = stats[:, 2].astype(np.int64)
+    columns['noch_pix'] = stats[:, 3].astype(np.int64)
+
+    #Pixels of each tile counted in an overlapping tile with a larger FID
+    index = load_tile_index(rapideye, changemap_open)
+    rows = np.searchsorted(index['fid'], columns['fid'])
+    columns['overlap'] = (mask_pixels(index)[rows] -
+                          ch_counts[columns['fid']].sum(axis=1))
+
+    #Close and destroy the data source
+    changemap_open = None
+    lc_open = None
+    rapideye_open.Destroy()
+
+    return columns, in_fields, ch_classes, ch_counts[columns['fid']]
+
+
+def write_strata(output, rapideyelayer, tiles, in_fields):
+    """ Write kept tiles, with the fields of the VHR tile layer and their
+        zonal statistics, to the output strata file """
 
     #Create output strata
     outShapefile = output
@@ -104,151 +223,40 @@ def prep_vhr(changemap, rapideye, output,lcmap, thresh, ndv):
     outLayer.CreateField(prop_field)
     outLayer.CreateField(pixel_field)
     outLayer.CreateField(total_field)
-    outLayerDefn = outLayer.GetLayerDefn()
-
-    #Total number of tiles in vector file
-    totalfeats = len(rapideyelayer)
-
-    itera = 0
-    percent = 0
-    ten_perc = totalfeats / 10
-
-    #Iterate over features, retrieving zonal statistics
-    for i in range(totalfeats):
-
-        if itera == ten_perc:
-            percent += 10
-            logger.debug('{n}% Complete'.format(n=percent))
-            itera = 0
-
-        feat = rapideyelayer.GetFeature(i)
-
-        #if int(feat.GetField('TILE_ID')) == 1837116:
-            #import pdb; pdb.set_trace()
-
-        try:
-            _1, proportion_lc, _2, _3 = zonal_stats(feat, lc_open, rapideyelayer, ndv)
-            if proportion_lc < thresh:
-                itera += 1
-                continue
-            area, proportion, pix, totalpix = zonal_stats(feat, changemap_open, rapideyelayer, ndv)
-        except:
-            itera += 1
-            continue
-        outFeature = ogr.Feature(outLayerDefn)
-
-         # Add field values from input Layer
-        for i in range(0, inLayerDefn.GetFieldCount()):
-             outFeature.SetField(outLayerDefn.GetFieldDefn(i).GetNameRef(), feat.GetField(i))
 
-        #Fill zonal statistic fields in output file
-        outFeature.SetField('area',area)
-        outFeature.SetField('proportion',proportion)
-        outFeature.SetField('ch_pix',pix)
-        outFeature.SetField('noch_pix', totalpix)
+    fields = [(name, tiles[name]) for name in
+              in_fields + ['area', 'proportion', 'ch_pix', 'noch_pix']]
+    write_features(outLayer, fields, tiles['wkb'])
 
-        # Set geometry as centroid
-        geom = feat.GetGeometryRef()
-        outFeature.SetGeometry(geom)
-
-        # Add new feature to output Layer
-        outLayer.CreateFeature(outFeature)
-
-        itera += 1
-
-    #Close and destroy the data source
-    changemap_open = None
-    rapideye_open.Destroy()
     outDataSource.Destroy()
 
 
-def zonal_stats(feat, raster, layer, ndv):
+def zonal_stats(counts, classes, ndv):
     """Perform zonal statistics of vector feature
-       on change map"""
-
-    #Get extent information
-    transform = raster.GetGeoTransform()
-    xOrigin = transform[0]
-    yOrigin = transform[3]
-
-    #Pixel size
-    pixelWidth = transform[1]
-    pixelHeight = transform[5]
-    geom = feat.GetGeometryRef()
-    if (geom.GetGeometryName() == 'MULTIPOLYGON'):
-        count = 0
-        pointsX = []; pointsY = []
-        for polygon in geom:
-            geomInner = geom.GetGeometryRef(count)
-            ring = geomInner.GetGeometryRef(0)
-            numpoints = ring.GetPointCount()
-            for p in range(numpoints):
-                lon, lat, z = ring.GetPoint(p)
-                pointsX.append(lon)
-                pointsY.append(lat)
-            count += 1
-    elif (geom.GetGeometryName() == 'POLYGON'):
-        ring = geom.GetGeometryRef(0)
-        numpoints = ring.GetPointCount()
-        pointsX = []; pointsY = []
-        for p in range(numpoints):
-                lon, lat, z = ring.GetPoint(p)
-                pointsX.append(lon)
-                pointsY.append(lat)
-
-    #Extent of vector feature
-    xmin = min(pointsX)
-    xmax = max(pointsX)
-    ymin = min(pointsY)
-    ymax = max(pointsY)
-
-    # Specify offset and rows and columns to read
-    xoff = int((xmin - xOrigin)/pixelWidth)
-    yoff = int((yOrigin - ymax)/pixelWidth)
-    xcount = int((xmax - xmin)/pixelWidth)+1
-    ycount = int((ymax - ymin)/pixelWidth)+1
-
-    # Create memory target raster
-    target_ds = gdal.GetDriverByName('MEM').Create('', xcount, ycount, gdal.GDT_Byte)
-    target_ds.SetGeoTransform((
-        xmin, pixelWidth, 0,
-        ymax, 0, pixelHeight,
-    ))
-
-    # Create for target raster the same projection as for the value raster
-    raster_srs = osr.SpatialReference()
-    raster_srs.ImportFromWkt(raster.GetProjectionRef())
-    target_ds.SetProjection(raster_srs.ExportToWkt())
-
-    # Rasterize zone polygon to raster
-    gdal.RasterizeLayer(target_ds, [1], layer, burn_values=[1])
-
-    # Read raster as arrays
-    banddataraster = raster.GetRasterBand(1)
-    dataraster = banddataraster.ReadAsArray(xoff, yoff, xcount, ycount).astype(np.float)
-    bandmask = target_ds.GetRasterBand(1)
-    datamask = bandmask.ReadAsArray(0, 0, xcount, ycount).astype(np.float)
-
-    # Mask zone of raster
-    zonemask = np.ma.masked_array(dataraster,  np.logical_not(datamask))
-    zone_raster_full = np.ma.compressed(zonemask)
-    zone_masked = zone_raster_full[~np.in1d(zone_raster_full, ndv)]
+       on change map from its per-class pixel counts"""
+
+    #Pixels within tile, and those not in no data values
+    total = counts.sum()
+    valid = counts[~np.in1d(classes, ndv)].sum()
+    if total == 0:
+        return 0, None, 0, 0
 
     #Area of change. 1 pixel = 30 X 30 m = 900m^2
-    area = len(zone_masked) * 900
+    area = valid * 900
 
     #Proportion of change
-    proportion = float(len(zone_masked)) / len(zone_raster_full)
-    return area, proportion, len(zone_raster_full), len(zone_raster_full)
+    proportion = float(valid) / total
+    return int(area), proportion, int(valid), int(total - valid)
 
 
 def open_raster(raster):
     """ Open raster file """
 
-    raster_open = gdal.Open(raster)
-    if raster_open:
+    try:
+        raster_open = open_dataset(raster)
         success = True
-    else:
+    except (IOError, RuntimeError):
+        raster_open = None
         success = False
     return raster_open, success
 
@@ -265,6 +273,8 @@ def open_shapefile(shapefile):
 def main():
     """ Read and test inputs """
 
+    set_block_cache()
+
 
     method = 'raster'
 
@@ -341,7 +351,17 @@ def main():
     else:
         threshold = .4
 
-    prep_vhr(changemap, rapideye, output, lcmap, threshold, ndv)
+    try:
+        jobs = int(args['--jobs'])
+    except:
+        logger.error('Number of jobs must be an integer')
+        sys.exit(1)
+    if jobs < 1:
+        logger.error('Number of jobs must be at least 1')
+        sys.exit(1)
+
+    prep_vhr(changemap, rapideye, output, lcmap, threshold, ndv, jobs=jobs,
+             checkpoint=args['--checkpoint'])
 
 if __name__ == '__main__':
     args = docopt(__doc__,)
@@ -45,6 +45,8 @@ import numpy as np
 import os
 import sys
 
+from vector_io import read_layer, write_features
+
 #Logging
 import logging
 VERBOSE = False
@@ -62,26 +64,28 @@ logger = logging.getLogger(__name__)
 def do_firststage_sample(method, size, allocation, shapefile):
     """Main function for sampling vector tiles """
 
-    #Get total number of change pixels
-    total_area = 0
-    percent_total_change = []
+    #Read the area column in one pass
     driver = ogr.GetDriverByName("ESRI Shapefile")
     dataSource = driver.Open(shapefile, 0)
     layer = dataSource.GetLayer()
-    num_feat = layer.GetFeatureCount()
-    for feature in layer:
-        total_area+=feature.GetField("area")
+    area = read_layer(layer, ['area'], geometry=False)['area']
+    dataSource.Destroy()
+
+    return sample_tiles(method, size, allocation, area)
+
+def sample_tiles(method, size, allocation, area):
+    """ Stratify tiles by their area of change and sample each stratum
+
+        `area` is the area of change of each tile, by FID """
+
+    #Get total number of change pixels
+    total_area = area.sum()
 
     logger.debug('There are a total of {n} change pixels in the study area (Nh)'.format(n=total_area))
     logger.debug('Total samples that you have specified is {n} (n)'.format(n=size))
 
     #Get total area
-    for feature in range(num_feat):
-        count = layer[feature].GetField("area")
-        percent = float(count) / total_area
-        percent_total_change.append(percent)
-
-    percent_total_change = np.array(percent_total_change)
+    percent_total_change = area / float(total_area)
     sort = np.argsort(percent_total_change)[::-1]
     percent_not_sorted = np.copy(percent_total_change)
 
@@ -137,10 +141,6 @@ def write_output(shapefile, output, strata_1, strata_2, high, low, percent_not_s
         fieldDefn = inLayerDefn.GetFieldDefn(i)
         outLayer.CreateField(fieldDefn)
 
-    #Get inclusion probabilities
-    inclu1_high = float(high.shape[0]) / strata_1.shape[0]
-    inclu1_low = float(low.shape[0]) / strata_2.shape[0]
-
     strata_field = ogr.FieldDefn("strata", ogr.OFTInteger)
     outLayer.CreateField(strata_field)
     percent_field = ogr.FieldDefn("percent", ogr.OFTReal)
@@ -152,47 +152,48 @@ def write_output(shapefile, output, strata_1, strata_2, high, low, percent_not_s
     selection_field = ogr.FieldDefn("inclu_1", ogr.OFTReal)
     outLayer.CreateField(selection_field)
 
-    # Get the output Layer's Feature Definition
-    outLayerDefn = outLayer.GetLayerDefn()
-    # Add features to the ouput Layer
-    for i in range(0, layer.GetFeatureCount()):
-        # Get the input Feature
-        if i in strata_1:
-            feature_strata = 1
-            inclusion = inclu1_high
-            pop = len(strata_1)
-        elif i in strata_2:
-            feature_strata = 2
-            inclusion = inclu1_low
-            pop = len(strata_2)
-        if (i in high) or (i in low):
-            selection = 1
-        else:
-            continue
-        feature_percent = percent_not_sorted[i] * 100
-
-
-
-        inFeature = layer.GetFeature(i)
-        # Create output Feature
-        outFeature = ogr.Feature(outLayerDefn)
-        # Add field values from input Layer
-        for i in range(0, inLayerDefn.GetFieldCount()):
-            outFeature.SetField(outLayerDefn.GetFieldDefn(i).GetNameRef(), inFeature.GetField(i))
-        outFeature.SetField('strata',feature_strata)
-        outFeature.SetField('percent',feature_percent)
-        outFeature.SetField('selection',selection)
-        outFeature.SetField('inclu_1',inclusion)
-        outFeature.SetField('pop_stage1',pop)
-        # Set geometry as centroid
-        geom = inFeature.GetGeometryRef()
-        outFeature.SetGeometry(geom)
-        # Add new feature to output Layer
-        outLayer.CreateFeature(outFeature)
-        # Close DataSources
+    #Read and write only the selected tiles
+    selected = np.union1d(high, low).astype(np.int64)
+    if selected.size:
+        layer.SetAttributeFilter('FID IN ({f})'.format(
+            f=','.join(str(i) for i in selected)))
+        tiles = read_layer(layer)
+        layer.SetAttributeFilter(None)
+
+        names = [inLayerDefn.GetFieldDefn(i).GetName()
+                 for i in range(inLayerDefn.GetFieldCount())]
+        fields = [(name, tiles[name]) for name in names]
+        fields.extend(selection_fields(tiles['fid'], layer.GetFeatureCount(),
+                                       strata_1, strata_2, high, low,
+                                       percent_not_sorted))
+        write_features(outLayer, fields, tiles['wkb'])
+
+    # Close DataSources
     dataSource.Destroy()
     outDataSource.Destroy()
 
+def selection_fields(fid, n, strata_1, strata_2, high, low,
+                     percent_not_sorted):
+    """ Return first-stage fields (name, values) of selected tiles `fid`,
+        out of `n` tiles """
+
+    #Get inclusion probabilities
+    inclu1_high = float(high.shape[0]) / strata_1.shape[0]
+    inclu1_low = float(low.shape[0]) / strata_2.shape[0]
+
+    #Stratum, inclusion probability and population of each tile, by FID
+    stratum = np.zeros(n, dtype=np.int64)
+    stratum[strata_1] = 1
+    stratum[strata_2] = 2
+    inclusion = np.where(stratum == 1, inclu1_high, inclu1_low)
+    pop = np.where(stratum == 1, len(strata_1), len(strata_2))
+
+    return [('strata', stratum[fid]),
+            ('percent', percent_not_sorted[fid] * 100),
+            ('selection', np.ones(fid.size, dtype=np.int64)),
+            ('inclu_1', inclusion[fid]),
+            ('pop_stage1', pop[fid])]
+
 def do_neyman(n, strata1, strata2, sd1, sd2):
     """
     Neyman sampling aims at providing the most precision. #TODO: Elaborate
@@ -5,6 +5,11 @@ Get count of classes in raster.
 Modified from script from:
 https://ssrebelious.wordpress.com/
 
+The raster is read block by block in its native layout and a running
+histogram is kept, so memory use does not grow with the size of the map or
+the number of classes. Counts are cached next to the raster
+(<filename>.hist.json) and reused until the raster changes.
+
 Usage:
   ClassCount.py <filename> <ndv>
 
@@ -12,54 +17,42 @@ Example:
   3_ClassCount.py ../Material/peru/from_henning/Uso2011.tif '0;255'
 
 """
-
-
+from __future__ import print_function, division
 
 from docopt import docopt
-import gdal, ogr, osr, os
-import numpy as np
 from osgeo import gdal
 import sys
-import math
+
+from histogram import cached_histogram
+
+
+def class_count(path, ndv):
+    """ Print pixel count and proportion of area of each class in raster """
+
+    gdalData = gdal.Open(path)
+    if gdalData is None:
+        sys.exit("ERROR: can't open raster")
+
+    classes, counts = cached_histogram(path, 1, ndv, ds=gdalData)
+    total = counts.sum()
+
+    # print results sorted by cell_value
+    for key, pixels in zip(classes, counts):
+        classtotal = pixels / float(total)
+        print("# pixels class %s: %s" % (key, pixels))
+        print("Percent total area class %s: %s" % (key, classtotal))
+
+    gdalData = None
 
 
 if __name__ == '__main__':
     args = docopt(__doc__, version='0.1.0')
 
+    path = args['<filename>']
+
+    ndv = []
+    ndvs = args['<ndv>'].split(';')
+    for i in ndvs:
+        ndv.append(int(i))
 
-path = args['<filename>']
-
-ndv = []
-ndvs = args['<ndv>'].split(';')
-for i in ndvs:
-    ndv.append(int(i))
-
-
-gdalData = gdal.Open(path)
-if gdalData is None:
-  sys.exit( "ERROR: can't open raster" )
-
-# get number of bands
-bands = gdalData.RasterCount
-
-band_i = gdalData.GetRasterBand(1)
-raster_full = band_i.ReadAsArray()
-raster_flat = raster_full.flatten()
-del raster_full
-raster_full = None
-raster = raster_flat[~np.in1d(raster_flat, ndv)]
-del raster_flat
-raster_flat = None
-  # create dictionary for unique values count
-count = {}
-classes = np.unique(raster)
-total = 0
-for pix in classes:
-    count[pix] = len(raster[raster == pix])
-    total += count[pix]
-
-  # print results sorted by cell_value
-for key in sorted(count.iterkeys()):
-  classtotal = count[key] / float(total)
-  print "# pixels class %s: %s" %(key, count[key])
-  print "Percent total area class %s: %s" %(key, classtotal)
+    class_count(path, ndv)
@@ -13,6 +13,16 @@ Options:
     -v --verbose                Show verbose debugging messages
     -h --help                   Show help
     --allocation <allocation>   Comma-seperated list of sample allocations
+    --table <filename>          Also write samples to a table; format from
+                                extension (.arrow, .parquet or .csv). The
+                                Reference column is -1 until interpreted
+    --counts <filename>         Tile class count table from 1_Prep_VHR.py
+                                (<strata>.counts.npz) giving class populations
+                                of the selected tiles, if counted on
+                                <changemap> and the tiles don't overlap
+    --seed <seed>               Seed of the random sample; drawn at random
+                                and logged if not given
+    -j --jobs <n>               Number of processes sampling tiles [default: 1]
 
 
 Examples:
@@ -26,8 +36,18 @@ from docopt import docopt
 from osgeo import ogr, osr
 import numpy as np
 import gdal
+import os
 import sys
 
+from estimation import UNLABELLED
+from raster_io import open_dataset, set_block_cache
+from table_io import write_table
+from tile_index import grid_key, load_tile_index, raster_key
+from tile_sampling import (EDGE_BUFFER, allocated_samples, later_overlaps,
+                           new_seed, random_tiles, tile_class_samples)
+from vector_io import pixel_centers, pixel_polygons, read_layer, write_features
+from zonal import read_tile_counts
+
 #Logging
 import logging
 VERBOSE = False
@@ -42,17 +62,122 @@ logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%H:%M:%S')
 logger = logging.getLogger(__name__)
 
-def do_point_sample(method, size,shapefile, changemap, output, strata):
-    """ Main function for doing point sampling """
+# Map values excluded from second-stage strata
+_mask = [0, 255]
+
+# First-stage tile attributes used here
+_tile_fields = ['SampID', 'selection', 'inclu_1', 'pop_stage1', 'strata']
+
+# Sample fields, in output order, after the sample ID
+_sample_fields = ['Tile', 'TilePop', 'Strata1', 'Strata', 'TotalPix',
+                  'Inclu_1', 'Inclu_2', 'Inclu_Fin', 'Design']
+
+# Second-stage design of each sampling method, as written with the samples
+_designs = {'random': 'Random', 'stratified': 'Stratified'}
+
+
+def do_point_sample(method, size,shapefile, changemap, output, strata,
+                    table=None, counts=None, seed=None, jobs=1):
+    """ Main function for doing point sampling
+
+        Each tile is sampled with its own random stream derived from `seed`
+        and its tile ID, so the sample is the same for any number of `jobs`.
+    """
 
     #Open shapefile from first stage sampling
     driver = ogr.GetDriverByName("ESRI Shapefile")
     dataSource = driver.Open(shapefile, 0)
     layer = dataSource.GetLayer()
 
-    #Open changemap
-    map_ds = gdal.Open(changemap)
-    map_ar = map_ds.GetRasterBand(1).ReadAsArray()
+    #First-stage attributes of all tiles, read in one pass
+    tiles = read_layer(layer, _tile_fields, geometry=False)
+
+    #Open changemap; only windows of the selected tiles are read
+    map_ds = open_dataset(changemap)
+
+    #Tile windows and masks on the changemap grid, cached with the shapefile
+    index = load_tile_index(shapefile, map_ds, layer)
+
+    #Class populations of the selected tiles from the stage-1 table
+    population = None
+    if counts and method == 'stratified':
+        population = tile_populations(read_tile_counts(counts), tiles,
+                                      map_ds)
+
+    records = point_sample(method, size, tiles, shapefile, changemap, index,
+                           strata, population, seed, jobs)
+
+    #Write output
+    write_sample_layer(output, map_ds, records)
+
+    if table:
+        write_sample_table(table, records, map_ds)
+
+
+def point_sample(method, size, tiles, shapefile, changemap, index, strata,
+                 population=None, seed=None, jobs=1):
+    """ Sample pixels within the selected first-stage tiles
+
+        `tiles` holds the first-stage attributes of the tiles, with the FID
+        of each in `shapefile`, whose windows on the `changemap` grid are in
+        `index`. Returns the sample ID, row, column and fields of each
+        sample. """
+
+    if seed is None:
+        seed = new_seed()
+    logger.info('Sampling with seed {s}'.format(s=seed))
+
+    #Return first-stage inclusion probabilities
+    inclu1 = get_first_inclusion(tiles)
+
+    values = []
+    if method == 'stratified':
+
+                #Sample the selected scenes
+                strata, sample_y, sample_x, total, inclu2, classes, sample_tiles = sample_stratified(size, tiles, shapefile, changemap, index, strata, population, seed, jobs)
+
+                values.append(sample_values(sample_x, sample_y, strata,
+                                            classes, sample_tiles, total,
+                                            inclu2, inclu1,
+                                            _designs[method]))
+    elif method == 'random':
+
+        #Sample pixels within each selected tile, over `jobs` processes;
+        #where selected tiles overlap, pixels belong to the larger FID
+        selected = np.flatnonzero(tiles['selection'] == 1)
+        fids = tiles['fid'][selected]
+        samples = random_tiles(shapefile, changemap, fids,
+                               tiles['SampID'][selected], size, seed, jobs,
+                               later_overlaps(index, fids))
+
+        #Loop over selected tiles
+        for i, (sample_y, sample_x, sample_strata, total, inclu2) in zip(
+                selected, samples):
+
+            tile = int(tiles['SampID'][i])
+
+            #Tiles with no pixels inside the edge buffer are left unsampled,
+            #and count as selected tiles without samples in the estimates
+            if total == 0:
+                logger.warning('Tile {t} (FID {f}) has no pixels more than '
+                               '{b} pixels from its edges; not sampled'.format(
+                                   t=tile, f=int(tiles['fid'][i]),
+                                   b=EDGE_BUFFER))
+                continue
+
+            values.append(sample_values(sample_x, sample_y, sample_strata,
+                                        None, tile, total, inclu2, inclu1,
+                                        _designs[method]))
+
+    names = ['ROW', 'COL'] + _sample_fields
+    records = dict((name, np.concatenate([v[name] for v in values]) if values
+                    else np.array([], dtype=np.int64)) for name in names)
+    records['ID'] = np.arange(1, records['ROW'].size + 1)
+    return records
+
+
+def write_sample_layer(output, map_ds, records):
+    """ Write pixel footprints of samples, with their fields, to `output` """
 
     #Create new vector file with samples
     map_sr = osr.SpatialReference()
@@ -94,311 +219,237 @@ def do_point_sample(method, size,shapefile, changemap, output, strata):
 
     ## TilePop: First-stage strata population
     out_layer.CreateField(ogr.FieldDefn('TilePop', ogr.OFTInteger))
-    #Sample ID
-    pix_id = 1
 
-    if method == 'stratified':
-
-                #Return changemap in chosen vector tiles
-                changemap_mask, tile_ar = extract_alltiles(layer, changemap)
-
-                #Sample the selected scenes
-                strata, sample_y, sample_x, total, inclu2, classes = sample_stratified(size, changemap_mask, strata)
-
-                #Return first-stage inclusion probabilities
-                inclu1 = get_first_inclusion(layer)
+    ## Design: Second-stage sampling design (Random or Stratified)
+    design = ogr.FieldDefn('Design', ogr.OFTString)
+    design.SetWidth(10)
+    out_layer.CreateField(design)
+
+    # Write footprints and fields of all samples in bulk, with the reference
+    # class left to interpret
+    fields = [(name, records[name]) for name in ['ID'] + _sample_fields]
+    fields.append(('Reference', np.full(records['ID'].size, UNLABELLED,
+                                        dtype=np.int64)))
+    write_features(out_layer, fields,
+                   pixel_polygons(records['COL'], records['ROW'],
+                                  map_ds.GetGeoTransform()))
+    sample_ds = None
+
+
+def write_sample_table(table, records, map_ds):
+    """ Write sample records to a columnar table, with pixel center
+        coordinates and sampling weights """
+
+    x, y = pixel_centers(records['COL'], records['ROW'],
+                         map_ds.GetGeoTransform())
+    inclusion = np.array(records['Inclu_Fin'], dtype=np.float64)
+    columns = [('ID', records['ID']),
+               ('ROW', np.array(records['ROW'], dtype=np.int64)),
+               ('COL', np.array(records['COL'], dtype=np.int64)),
+               ('X', x),
+               ('Y', y)]
+    columns.extend((name, records[name]) for name in _sample_fields)
+    columns.append(('Reference', np.full(inclusion.size, UNLABELLED,
+                                         dtype=np.int64)))
+    columns.append(('Weights', 1 / inclusion))
+    write_table(table, columns)
+
+
+def get_first_inclusion(tiles):
+    """ Return first-stage inclusion probability for each vector tile """
 
-                #Write output
-                _, _ = write_vector_output(sample_x, sample_y,
-                                    map_ds,out_layer, map_ar,
-                                    output, classes, pix_id, tile_ar, total, inclu2, inclu1,
-                                    ogr_frmt='ESRI Shapefile')
-    elif method == 'random':
+    combined = []
+    combined.append(tiles['SampID'])
+    combined.append(tiles['inclu_1'])
+    combined.append(tiles['pop_stage1'])
+    combined.append(tiles['strata'])
 
-        #Loop over features
-        for feat in range(layer.GetFeatureCount()):
+    return combined
 
-            feature = layer.GetFeature(feat)
-            tile = feature.GetField("SampID")
-            inclu1 = feature.GetField("inclu_1")
-            if feature.GetField("selection") == 0:
-                continue
+def tile_populations(tile_counts, tiles, map_ds):
+    """ Return map classes and their populations within the selected tiles,
+        summed from the stage-1 tile class count table
 
-            #Extract indices of pixels within sampled vector tiles
-            _, barray, xoff, yoff, xcount, ycount = extract_tile(feature, changemap, layer)
+        The table must have been counted on the grid of `map_ds`. Returns
+        None, so populations are counted here, if it was counted on another
+        map file, or if pixels of selected tiles were counted in overlapping
+        tiles, which may not have been selected. """
 
-            #Sample the raster indices
-            sample_y, sample_x, total, inclu2 = sample_random(size, xoff, yoff, xcount, ycount)
+    shape = (map_ds.RasterYSize, map_ds.RasterXSize)
+    if (tile_counts['grid'] != grid_key(map_ds) or
+            tuple(tile_counts['shape']) != shape):
+        raise ValueError(
+            'Tile class counts were counted on a different map grid')
+    if tile_counts['map'] != raster_key(map_ds):
+        logger.warning('Tile class counts were counted on another map file; '
+                       'counting class populations of the selected tiles')
+        return None
 
-            #Write output
-            pix_id, out_layer = write_vector_output(sample_x, sample_y,
-                                                       map_ds,out_layer, map_ar,
-                                                    output,None, pix_id, tile,
-                                                    total, inclu2, inclu1,
-                                                ogr_frmt='ESRI Shapefile')
+    ids, classes, counts = (tile_counts['tiles'], tile_counts['classes'],
+                            tile_counts['counts'])
 
+    selected = tiles['SampID'][tiles['selection'] == 1].astype(np.int64)
 
+    rows = np.minimum(np.searchsorted(ids, selected), max(ids.size - 1, 0))
+    if ids.size == 0 or (ids[rows] != selected).any():
+        raise ValueError(
+            'Tile class counts are missing selected tiles')
+    if (tile_counts['overlap'][rows] > 0).any():
+        logger.warning('Selected tiles overlap other tiles; counting class '
+                       'populations of the selected tiles')
+        return None
 
-def get_first_inclusion(layer):
-    """ Return first-stage inclusion probability for each vector tile """
+    total = counts[rows].sum(axis=0)
+    keep = ~np.in1d(classes, _mask) & (total > 0)
+    return classes[keep], total[keep]
 
-    inclu1 = []
-    tiles = []
-    tilepop = []
-    combined = []
-    strata1 = []
-    for i in range(layer.GetFeatureCount()):
-        feat = layer.GetFeature(i)
-        inclu1.append(feat.GetField('inclu_1'))
-        tiles.append(feat.GetField('SampId'))
-        tilepop.append(feat.GetField('pop_stage1'))
-        strata1.append(feat.GetField('strata'))
-    inclu1 = np.array(inclu1)
-    tiles = np.array(tiles)
-    population = np.array(tilepop)
-    first_strata = np.array(strata1)
-    combined.append(tiles)
-    combined.append(inclu1)
-    combined.append(population)
-    combined.append(first_strata)
 
-    return combined
-
-def sample_stratified(size, changemap_mask, strata):
+def sample_stratified(size, tiles, shapefile, changemap, index, strata,
+                      population=None, seed=None, jobs=1):
     """ perform random stratified sample of map
         Modified from code by Chris Holden
-        https://github.com/ceholden/misc """
-
-    # Find map classes within image
-    classes = np.sort(np.unique(changemap_mask))
-    # Exclude masked values
-    mask = [0, 255]
-    classes = classes[~np.in1d(classes, mask)]
+        https://github.com/ceholden/misc
+
+        Pixels are sampled from the windows of the selected tiles only, and
+        each sample's tile ID is returned with its row and column. Where
+        selected tiles overlap, pixels belong to the tile with the larger
+        FID, as in the stage-1 tile class counts. The samples of each class
+        are allocated among tiles with a multivariate hypergeometric draw
+        from the run's random stream, then taken from candidates drawn from
+        the tile's own stream while its pixels are counted, so each tile is
+        read once. """
+
+    selected = np.flatnonzero(tiles['selection'] == 1)
+    fids = tiles['fid'][selected]
+    tile_ids = tiles['SampID'][selected].astype(np.int64)
+    cover = later_overlaps(index, fids)
+
+    # Count pixels of each class in each tile, drawing enough candidate
+    # samples of each class in the same pass for any allocation
+    cap = int(max(strata)) if len(strata) else 0
+    tile_classes, per_tile, candidates = tile_class_samples(
+        shapefile, changemap, fids, cover, tile_ids, seed, cap, jobs)
+
+    # Find map classes and their populations within the selected tiles,
+    # excluding masked values. These are counts over the sampled tiles only,
+    # so they come from the stage-1 tile count table if given, or are
+    # counted here rather than taken from the whole-map histogram cache.
+    if population is not None:
+        classes, class_counts = population
+    else:
+        total = per_tile.sum(axis=0)
+        keep = ~np.in1d(tile_classes, _mask) & (total > 0)
+        classes, class_counts = tile_classes[keep], total[keep]
 
     counts = np.array(strata)
-    class_counts = []
-    inclu2 = []
-    for a, i in enumerate(classes):
-        px = np.sum(changemap_mask == i)
-        class_counts.append(px)
-        inclu2.append(counts[a]/float(px))
-    inclu2 = np.array(inclu2)
     logger.debug('Found {n} classes'.format(n=classes.size))
 
     if classes.size != counts.size:
         raise ValueError(
             'Sample counts must be given for each unmasked class in map')
 
-    # Initialize outputs
-    strata = np.array([])
-    rows = np.array([])
-    cols = np.array([])
+    inclu2 = counts / class_counts.astype(np.float64)
 
     logger.debug('Performing sampling')
 
-    for c, n in zip(classes, counts):
-        logger.debug('Sampling class {c}'.format(c=c))
-
-        # Find pixels containing class c
-        row, col = np.where(changemap_mask == c)
+    # Allocate the samples of each class among tiles
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+    allocation = np.zeros((fids.size, classes.size), dtype=np.int64)
+    for k, (c, n) in enumerate(zip(classes, counts)):
+        col = np.flatnonzero(tile_classes == c)
+        per_tile_c = (per_tile[:, col[0]] if col.size else
+                      np.zeros(fids.size, dtype=np.int64))
+        population_c = int(per_tile_c.sum())
 
         # Check for sample size > population size
-        if n > col.size:
+        if n > population_c:
             logger.warning(
                 'Class {0} sample size larger than population'.format(c))
             logger.warning('Reducing sample count to size of population')
 
-            n = col.size
-
-        samples = np.random.choice(col.size, n, replace=False)
-
-        logger.debug('    collected samples')
-
-        strata = np.append(strata, np.repeat(c, n))
-        rows = np.append(rows, row[samples])
-        cols = np.append(cols, col[samples])
-
-    return strata, rows, cols, class_counts, inclu2, classes
-
-
-def extract_alltiles(layer, changemap):
-    """ Extract changemap for areas sampled in first-stage of sampling """
-
-    ch_open = gdal.Open(changemap)
-    ch_ar = ch_open.GetRasterBand(1).ReadAsArray()
-    mask_ar = np.zeros_like(ch_ar)
-
-    #Create matching tile array to save corresponding tile ID
-    tile_ar = np.zeros((np.shape(mask_ar)[0],np.shape(mask_ar)[1]))
-
-    for feat in range(layer.GetFeatureCount()):
-        feature = layer.GetFeature(feat)
-        if feature.GetField("selection") == 1:
-            #Extract subset for feature
-            _, barray, xoff, yoff, xcount, ycount = extract_tile(feature, changemap, layer)
-
-            #File in new array with subset
-            mask_ar[yoff:(yoff+ycount), xoff:(xoff+xcount)] = barray
-
-            #File in matching tile array in sample ID
-            tile_ar[yoff:(yoff+ycount), xoff:(xoff+xcount)] = feature.GetField("SampID")
-
-    return mask_ar, tile_ar
-
-def extract_tile(feat, raster_file, layer):
-    """Subset changemap for vector feature
-       Modified from the Python GDAL/Ogr Cookbook
-       https://pcjericks.github.io/py-gdalogr-cookbook/ """
-
-    raster = gdal.Open(raster_file)
-    transform = raster.GetGeoTransform()
-    xOrigin = transform[0]
-    yOrigin = transform[3]
-    pixelWidth = transform[1]
-    pixelHeight = transform[5]
-    geom = feat.GetGeometryRef()
-    if (geom.GetGeometryName() == 'MULTIPOLYGON'):
-        count = 0
-        pointsX = []; pointsY = []
-        for polygon in geom:
-            geomInner = geom.GetGeometryRef(count)
-            ring = geomInner.GetGeometryRef(0)
-            numpoints = ring.GetPointCount()
-            for p in range(numpoints):
-                lon, lat, z = ring.GetPoint(p)
-                pointsX.append(lon)
-                pointsY.append(lat)
-            count += 1
-    elif (geom.GetGeometryName() == 'POLYGON'):
-        ring = geom.GetGeometryRef(0)
-        numpoints = ring.GetPointCount()
-        pointsX = []; pointsY = []
-        for p in range(numpoints):
-                lon, lat, z = ring.GetPoint(p)
-                pointsX.append(lon)
-                pointsY.append(lat)
-
-    #Get extent of feature
-    xmin = min(pointsX)
-    xmax = max(pointsX)
-    ymin = min(pointsY)
-    ymax = max(pointsY)
-
-    # Specify offset and rows and columns to read
-    xoff = int((xmin - xOrigin)/pixelWidth)
-    yoff = int((yOrigin - ymax)/pixelWidth)
-    xcount = int((xmax - xmin)/pixelWidth)+1
-    ycount = int((ymax - ymin)/pixelWidth)+1
-
-    # Create memory target raster
-    target_ds = gdal.GetDriverByName('MEM').Create('', xcount, ycount, gdal.GDT_Byte)
-    target_ds.SetGeoTransform((
-        xmin, pixelWidth, 0,
-        ymax, 0, pixelHeight,
-    ))
-
-    # Create for target raster the same projection as for the value raster
-    raster_srs = osr.SpatialReference()
-    raster_srs.ImportFromWkt(raster.GetProjectionRef())
-    target_ds.SetProjection(raster_srs.ExportToWkt())
-
-    # Rasterize zone polygon to raster
-    gdal.RasterizeLayer(target_ds, [1], layer, burn_values=[1])
-    # Read raster as arrays
-    banddataraster = raster.GetRasterBand(1)
-    dataraster = banddataraster.ReadAsArray(xoff, yoff, xcount, ycount).astype(np.float)
-    bandmask = target_ds.GetRasterBand(1)
-    datamask = bandmask.ReadAsArray(0, 0, xcount, ycount).astype(np.float)
-
-    # Mask zone of raster
-    zonemask = np.ma.masked_array(dataraster, np.logical_not(datamask))
-    zonal_data = zonemask.data
-    return target_ds, zonal_data, xoff, yoff, xcount, ycount
-
-
-def sample_random(size, xoff, yoff, xcount, ycount):
-    """ Perform random sample """
-
-    #Buffer 50 pixels to avoid edges
-    xoff += 25
-    yoff += 25
-    xcount -= 50
-    ycount -= 50
-    sample_x = np.random.choice(np.arange(xoff,(xoff+xcount)), size, replace=False)
-    sample_y = np.random.choice(np.arange(yoff,(yoff+ycount)), size, replace=False)
-    total = xcount * ycount
-    inclu2 = float(size) / total
-    return sample_y, sample_x, total, inclu2
-
-def write_vector_output(cols, rows, map_file,layer,changemap, output,
-                        classes, pix_id, tiles, _total, _inclu2, _inclu1, ogr_frmt='ESRI Shapefile'):
-    """ Write output row and column indices to point samples
-        Modified from code by Chris Holden
-        https://github.com/ceholden/misc """
-
-    # Corners of pixel in pixel coordinates
-    corners = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
-
-    gt = map_file.GetGeoTransform()
-    # Loop through samples adding to layer
-    for i, (col, row) in enumerate(zip(cols, rows)):
-        # Feature
-        if type(tiles) == int:
-            tile = tiles
-            strata = int(changemap[row,col])
-            inclu2 = _inclu2
-            inclu1 = _inclu1
-            total = _total
-            #total = _TilePop #TODO
-        else:
-            tile = int(tiles[row, col])
-            strata = int(changemap[row, col])
-            inclu2 = _inclu2[classes == strata][0]
-            inclu2 = float(inclu2)
-            total = np.array(_total)[classes == strata][0]
-            total = int(total)
-            inc_id = np.where(tile == _inclu1[0])[0]
-            inclu1 = float(_inclu1[1][inc_id])
-            tilepop = int(_inclu1[2][inc_id])
-            strata1 = int(_inclu1[3][inc_id])
-
-        final_inclusion = inclu2 * inclu1
-        feature = ogr.Feature(layer.GetLayerDefn())
-        feature.SetField('ID', pix_id)
-        feature.SetField('Tile', tile)
-        feature.SetField('TilePop', tilepop)
-        feature.SetField('Strata1', strata1)
-        feature.SetField('Strata', strata)
-        feature.SetField('TotalPix', total)
-        feature.SetField('Inclu_1', inclu1)
-        feature.SetField('Inclu_2', inclu2)
-        feature.SetField('Inclu_Fin', final_inclusion)
-
-        # Geometry
-        ring = ogr.Geometry(type=ogr.wkbLinearRing)
-
-        for corner in corners:
-            ring.AddPoint(
-                gt[0] + (col + corner[0]) * gt[1] + (row + corner[1]) * gt[2],
-                gt[3] + (col + corner[1]) * gt[4] + (row + corner[1]) * gt[5])
-        square = ogr.Geometry(type=ogr.wkbPolygon)
-        square.AddGeometry(ring)
-
-        feature.SetGeometry(square)
-
-        layer.CreateFeature(feature)
-
-        feature.Destroy()
-
-        pix_id += 1
-
-    tiles = None
-    return pix_id, layer
+            n = population_c
+
+        allocation[:, k] = rng.multivariate_hypergeometric(per_tile_c, n)
+
+    # Take the allocated pixels within each tile from its candidates
+    empty = np.array([], dtype=np.int64)
+    strata, rows, cols, sample_tiles = [empty], [empty], [empty], [empty]
+    for tile, (s, row, col) in zip(tile_ids, allocated_samples(
+            candidates, classes, allocation)):
+        strata.append(s)
+        rows.append(row)
+        cols.append(col)
+        sample_tiles.append(np.repeat(tile, s.size))
+
+    logger.debug('    collected samples')
+
+    # Group samples by class
+    strata = np.concatenate(strata)
+    order = np.argsort(strata, kind='mergesort')
+    return (strata[order], np.concatenate(rows)[order],
+            np.concatenate(cols)[order], class_counts, inclu2, classes,
+            np.concatenate(sample_tiles)[order])
+
+
+def sample_values(cols, rows, sample_strata, classes, tiles, _total, _inclu2,
+                  _inclu1, design):
+    """ Return fields of samples at `cols`, `rows`
+
+        `tiles` is the tile ID of each sample (or of all samples), and
+        `_inclu1` the first-stage table from `get_first_inclusion`. With
+        `classes`, `_total` and `_inclu2` are given per class; otherwise they
+        apply to all samples. `design` is the second-stage design
+        ('Random' or 'Stratified') the samples were drawn with. """
+
+    n = len(cols)
+    sample_strata = np.asarray(sample_strata, dtype=np.int64)
+
+    # Dense lookup of first-stage values by tile ID
+    tile_ids = np.asarray(_inclu1[0], dtype=np.int64)
+    tile_lut = np.zeros(tile_ids.max() + 1 if tile_ids.size else 0,
+                        dtype=np.int64)
+    tile_lut[tile_ids] = np.arange(tile_ids.size)
+    tile = np.broadcast_to(np.asarray(tiles, dtype=np.int64), (n, ))
+    missing = np.setdiff1d(tile, tile_ids)
+    if missing.size:
+        raise ValueError('Tiles {t} are missing from the first-stage '
+                         'table'.format(t=missing.tolist()))
+    t = tile_lut[tile]
+    inclu1 = np.asarray(_inclu1[1], dtype=np.float64)[t]
+    tilepop = np.asarray(_inclu1[2], dtype=np.int64)[t]
+    strata1 = np.asarray(_inclu1[3], dtype=np.int64)[t]
+
+    # Dense lookup of second-stage values by class
+    if classes is None:
+        inclu2 = np.full(n, _inclu2, dtype=np.float64)
+        total = np.full(n, _total, dtype=np.int64)
+    else:
+        classes = np.asarray(classes, dtype=np.int64)
+        class_lut = np.zeros(classes.max() + 1 if classes.size else 0,
+                             dtype=np.int64)
+        class_lut[classes] = np.arange(classes.size)
+        c = class_lut[sample_strata]
+        inclu2 = np.asarray(_inclu2, dtype=np.float64)[c]
+        total = np.asarray(_total, dtype=np.int64)[c]
+
+    return {'ROW': np.asarray(rows, dtype=np.int64),
+            'COL': np.asarray(cols, dtype=np.int64),
+            'Tile': np.array(tile),
+            'TilePop': tilepop,
+            'Strata1': strata1,
+            'Strata': sample_strata,
+            'TotalPix': total,
+            'Inclu_1': inclu1,
+            'Inclu_2': inclu2,
+            'Inclu_Fin': inclu2 * inclu1,
+            'Design': np.repeat(design, n)}
 
 
 def main():
     """ Read in arguments and test them """
 
+    set_block_cache()
+
     # Sample size
     try:
         size = int(args['--size'])
@@ -429,7 +480,33 @@ def main():
     shapefile = args['<shapefile>']
     output = args['<output>']
 
-    do_point_sample(method, size, shapefile, changemap, output, strata)
+    table = args['--table']
+
+    counts = args['--counts']
+    if counts and not os.path.isfile(counts):
+        logger.error(
+            'Specified tile count table {f} does not exist'.format(f=counts))
+        sys.exit(1)
+
+    seed = args['--seed']
+    if seed is not None:
+        try:
+            seed = int(seed)
+        except ValueError:
+            logger.error('Seed must be an integer')
+            sys.exit(1)
+
+    try:
+        jobs = int(args['--jobs'])
+    except ValueError:
+        logger.error('Number of jobs must be an integer')
+        sys.exit(1)
+    if jobs < 1:
+        logger.error('Number of jobs must be at least 1')
+        sys.exit(1)
+
+    do_point_sample(method, size, shapefile, changemap, output, strata,
+                    table=table, counts=counts, seed=seed, jobs=jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" Estimate map accuracy and class areas from a two-stage sample
+
+    Reads the sample table written by '4_SecondStageSample.py --table', once
+    the 'Reference' column holds the reference class of every sample, and
+    reports user's, producer's and overall accuracy, reference class areas
+    with their two-stage standard errors (tiles as primary sampling units)
+    and the unbiased error matrix of area proportions. Replaces
+    R/AccuracyMetrics.R for any number of classes.
+
+Usage:
+    5_AccuracyMetrics.py [options] <table>
+
+Options:
+    --output <filename>         Also write estimates of each class to a table;
+                                format from extension (.arrow, .parquet or .csv)
+    --pixel-area <a>            Area of a pixel, for areas in map units
+                                [default: 1]
+    -v --verbose                Show verbose debugging messages
+    -h --help                   Show help
+
+Example:
+
+    > 5_AccuracyMetrics.py --output accuracy.csv point_sample.csv
+"""
+from __future__ import print_function, division
+
+from docopt import docopt
+import os
+import sys
+
+from estimation import assess_accuracy
+from table_io import read_table, write_table
+
+#Logging
+import logging
+VERBOSE = False
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    level=logging.INFO,
+                    datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def accuracy_metrics(table, output=None, pixel_area=1.0):
+    """ Print accuracy, area and error matrix estimates of a sample table """
+
+    samples = read_table(table)
+    results = assess_accuracy(samples)
+    classes = results['classes']
+    area = results['area'] * pixel_area
+    area_se = results['area_se'] * pixel_area
+
+    for i, c in enumerate(classes):
+        print('Users/Producers Accuracy with Standard Errors in () for '
+              'Class {c}: {u:.4f} ({use:.4f}), {p:.4f} ({pse:.4f})'.format(
+                  c=c, u=results['users'][i], use=results['users_se'][i],
+                  p=results['producers'][i], pse=results['producers_se'][i]))
+    print('Overall Accuracy: {o:.4f} ({ose:.4f})'.format(
+        o=results['overall'], ose=results['overall_se']))
+
+    for i, c in enumerate(classes):
+        print('Estimated Area For Class {c}: {a:.1f} ({se:.1f})'.format(
+            c=c, a=area[i], se=area_se[i]))
+
+    #Unbiased error matrix: map classes in rows, reference classes in columns
+    print('Error matrix (proportion of area):')
+    print('\t'.join(['map\\ref'] + [str(c) for c in classes]))
+    for c, row in zip(classes, results['error_matrix']):
+        print('\t'.join([str(c)] + ['{p:.6f}'.format(p=p) for p in row]))
+
+    if output:
+        columns = [('Class', classes),
+                   ('Users', results['users']),
+                   ('Users_SE', results['users_se']),
+                   ('Producers', results['producers']),
+                   ('Producers_SE', results['producers_se']),
+                   ('Area', area),
+                   ('Area_SE', area_se)]
+        columns.extend(('Ref_{c}'.format(c=c), results['error_matrix'][:, i])
+                       for i, c in enumerate(classes))
+        write_table(output, columns)
+
+    return results
+
+
+def main():
+    """ Read in arguments and test them """
+
+    table = args['<table>']
+    if not os.path.isfile(table):
+        logger.error(
+            'Specified <table> file {f} does not exist'.format(f=table))
+        sys.exit(1)
+
+    try:
+        pixel_area = float(args['--pixel-area'])
+    except ValueError:
+        logger.error('Pixel area must be a number')
+        sys.exit(1)
+
+    accuracy_metrics(table, args['--output'], pixel_area)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__,)
+
+    if args['--verbose']:
+        VERBOSE = True
+        logger.setLevel(logging.DEBUG)
+
+    main()
@@ -0,0 +1,50 @@
+""" Helpers for walking a raster band in its native block layout
+
+    Reading a band window by window, with windows aligned to the band's own
+    blocks (tiles or strips), keeps memory flat no matter how large the map is
+    and lets GDAL decode every block exactly once.
+"""
+from __future__ import division
+
+# Largest window (in pixels) handed out when several native blocks are
+# coalesced into one read
+BLOCK_PIXELS = 2 ** 22
+
+
+def block_windows(band, max_pixels=BLOCK_PIXELS):
+    """ Yield (xoff, yoff, xsize, ysize) windows aligned to native blocks
+
+    Neighbouring blocks are merged (first along rows, then down columns) until
+    a window holds about `max_pixels` pixels, so striped files are not read one
+    scanline at a time. Windows are yielded in row-major order.
+
+    Args:
+        band (gdal.Band): raster band to walk
+        max_pixels (int, optional): pixel budget for one window
+
+    Yields:
+        tuple: xoff, yoff, xsize, ysize of each window
+    """
+    xsize, ysize = band.XSize, band.YSize
+    bx, by = band.GetBlockSize()
+    bx = max(1, min(bx, xsize))
+    by = max(1, min(by, ysize))
+
+    nx = max(1, min(-(-xsize // bx), max_pixels // (bx * by)))
+    win_x = min(xsize, bx * nx)
+    ny = max(1, min(-(-ysize // by), max_pixels // (win_x * by)))
+    win_y = min(ysize, by * ny)
+
+    for yoff in range(0, ysize, win_y):
+        for xoff in range(0, xsize, win_x):
+            yield (xoff, yoff,
+                   min(win_x, xsize - xoff), min(win_y, ysize - yoff))
+
+
+def iter_blocks(band, max_pixels=BLOCK_PIXELS):
+    """ Yield (xoff, yoff, array) for every block-aligned window of `band`
+
+    Arrays keep the band's native data type.
+    """
+    for xoff, yoff, xcount, ycount in block_windows(band, max_pixels):
+        yield xoff, yoff, band.ReadAsArray(xoff, yoff, xcount, ycount)
@@ -0,0 +1,299 @@
+""" Checkpoint store of per-tile class counts
+
+    Tile statistics can be checkpointed to a sidecar directory. `state.npz`
+    keys the counts by FID and an MD5 digest of the tile geometry and, for
+    each raster, its pixel grid, file size and modification time, classes,
+    the tile windows on its grid and a CRC32 digest of each native block read
+    while counting. While a run counts, each finished part of the work is
+    appended as its own `part_<run>_<i>.npz` file rather than rewriting the
+    store. Parts are folded into the state once all are done.
+
+    A run that stops partway resumes from the parts already counted. A later
+    run only recounts tiles that are new, whose geometry changed, that touch
+    raster blocks whose pixels changed, or whose window overlaps a new,
+    changed or removed tile (overlaps decide which tile owns shared pixels).
+    Blocks are digested as they are read for counting, and only read again
+    to check them when the size or modification time of their raster file
+    changed.
+"""
+from __future__ import division
+
+import glob
+import hashlib
+import logging
+import os
+import zlib
+
+import numpy as np
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+
+from tile_index import load_tile_index, raster_key, window_pairs
+
+logger = logging.getLogger(__name__)
+
+# Block windows counted between checkpoint parts
+CHECKPOINT_BLOCKS = 50
+
+_state_fn = 'state.npz'
+
+
+def geometry_hashes(layer_fn):
+    """ Return FIDs (sorted) and MD5 digest of the WKB geometry of each tile """
+    vector_ds = ogr.Open(layer_fn, 0)
+    layer = vector_ds.GetLayer()
+
+    fids, digests = [], []
+    for feat in layer:
+        geom = feat.GetGeometryRef()
+        wkb = bytes(geom.ExportToWkb()) if geom is not None else b''
+        fids.append(feat.GetFID())
+        digests.append(hashlib.md5(wkb).hexdigest())
+    vector_ds = None
+
+    fids = np.array(fids, dtype=np.int64)
+    order = np.argsort(fids, kind='mergesort')
+    return fids[order], np.array(digests, dtype='S32')[order]
+
+
+def block_digests(arr, xoff, yoff, band):
+    """ Return windows (n x 4) and CRC32 digests of the native blocks of
+    `band` within an array read from it at `xoff`, `yoff`
+
+    Windows handed out by `blocks.block_windows` are aligned to native
+    blocks, so a change to a few pixels only invalidates tiles near them.
+    """
+    bx, by = band.GetBlockSize()
+    bx = max(1, min(bx, band.XSize))
+    by = max(1, min(by, band.YSize))
+
+    windows, digests = [], []
+    for y in range(0, arr.shape[0], by):
+        for x in range(0, arr.shape[1], bx):
+            block = np.ascontiguousarray(arr[y:y + by, x:x + bx])
+            windows.append((xoff + x, yoff + y,
+                            block.shape[1], block.shape[0]))
+            digests.append(zlib.crc32(block.tobytes()) & 0xffffffff)
+    return (np.array(windows, dtype=np.int64).reshape(-1, 4),
+            np.array(digests, dtype=np.uint32))
+
+
+def merge_digests(digests):
+    """ Return windows and digests of blocks from a list of (windows,
+    digests), later digests of a window replacing earlier ones """
+    windows = np.concatenate([w for w, _ in digests] +
+                             [np.zeros((0, 4), dtype=np.int64)])
+    crcs = np.concatenate([c for _, c in digests] +
+                          [np.array([], dtype=np.uint32)])
+    # Last digest of each window
+    _, last = np.unique(windows[::-1], axis=0, return_index=True)
+    keep = np.sort(windows.shape[0] - 1 - last)
+    return windows[keep], crcs[keep]
+
+
+def load_checkpoint(path):
+    """ Return checkpoint state saved in directory `path`, or None """
+    filename = os.path.join(path, _state_fn)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        saved = np.load(filename)
+        return dict((key, saved[key]) for key in saved.files)
+    except (IOError, OSError, ValueError):
+        logger.warning('Ignoring unreadable checkpoint {f}'.format(f=path))
+        return None
+
+
+def save_checkpoint(path, state):
+    """ Save checkpoint state, replacing the saved state only once fully
+    written, and drop parts of other runs """
+    if os.path.isfile(path):
+        os.remove(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    filename = os.path.join(path, _state_fn)
+    tmp = filename + '.tmp.npz'
+    np.savez(tmp, **state)
+    os.rename(tmp, filename)
+
+    for part in glob.glob(os.path.join(path, 'part_*.npz')):
+        if not os.path.basename(part).startswith(
+                'part_{r}_'.format(r=_run(state))):
+            os.remove(part)
+
+
+def _run(state):
+    return state['run'].item().decode('ascii')
+
+
+def start_run(state, todo, parts):
+    """ Mark the work of a run in the checkpoint state
+
+    Runs counting the same tiles, in the same parts, of the same rasters
+    share parts saved in the checkpoint.
+
+    Args:
+        state (dict): checkpoint state
+        todo (np.ndarray): FIDs being counted
+        parts (int): number of parts the work is split into
+    """
+    digest = hashlib.md5(np.ascontiguousarray(todo).tobytes())
+    digest.update(str(parts).encode('utf-8'))
+    for k in range(int(state['n_rasters'])):
+        digest.update(state['raster_%d' % k].tobytes())
+        digest.update(state['classes_%d' % k].tobytes())
+    state['run'] = np.array(digest.hexdigest()[:12], dtype='S12')
+
+
+def save_part(path, state, i, fids, counts, digests):
+    """ Append counts of tiles `fids`, and digests of the blocks read for
+    them, from part `i` of the current run to the checkpoint """
+    filename = os.path.join(path, 'part_{r}_{i}.npz'.format(r=_run(state),
+                                                            i=i))
+    tmp = filename + '.tmp.npz'
+    arrays = dict(('counts_%d' % k, c) for k, c in enumerate(counts))
+    for k, (windows, crcs) in enumerate(digests):
+        arrays['dwin_%d' % k] = windows
+        arrays['dcrc_%d' % k] = crcs
+    np.savez_compressed(tmp, fid=fids, **arrays)
+    os.rename(tmp, filename)
+
+
+def load_parts(path, state):
+    """ Return FIDs, counts and block digests of the parts of the current run
+    already saved, by part number """
+    parts = {}
+    prefix = 'part_{r}_'.format(r=_run(state))
+    for filename in glob.glob(os.path.join(path, prefix + '*.npz')):
+        name = os.path.basename(filename)
+        if name.endswith('.tmp.npz'):
+            continue
+        try:
+            saved = np.load(filename)
+            n = range(int(state['n_rasters']))
+            parts[int(name[len(prefix):-4])] = (
+                saved['fid'], [saved['counts_%d' % k] for k in n],
+                [(saved['dwin_%d' % k], saved['dcrc_%d' % k]) for k in n])
+        except (IOError, OSError, KeyError, ValueError):
+            logger.warning('Ignoring unreadable checkpoint part {f}'.format(
+                f=filename))
+    return parts
+
+
+def refresh_checkpoint(state, layer_fn, rasters, classes):
+    """ Match a saved checkpoint against the current tiles and rasters
+
+    Counts of tiles whose FID and geometry are unchanged, that don't overlap
+    a new, changed or removed tile or touch a changed raster block, on
+    rasters with the same grid and classes, are kept and marked done; all
+    other tiles are marked to count.
+
+    Args:
+        state (dict): saved checkpoint state, or None
+        layer_fn (str): tile vector filename
+        rasters (list): categorical maps (gdal.Dataset)
+        classes (list): sorted values of all classes (np.ndarray) in each map
+
+    Returns:
+        dict: checkpoint state for the current tiles and rasters
+    """
+    fids, geoms = geometry_hashes(layer_fn)
+    n = fids.size
+
+    fresh = np.zeros(n, dtype=bool)
+    changed = np.ones(n, dtype=bool)
+    pos = np.zeros(n, dtype=np.int64)
+    usable = (state is not None and
+              int(state['n_rasters']) == len(rasters) and
+              state['fid'].size > 0)
+    if usable:
+        pos = np.minimum(np.searchsorted(state['fid'], fids),
+                         state['fid'].size - 1)
+        # Tiles that are new or whose geometry changed, and tiles removed
+        changed = ((state['fid'][pos] != fids) |
+                   (state['geom'][pos] != geoms))
+        removed = np.ones(state['fid'].size, dtype=bool)
+        removed[pos[~changed]] = False
+        fresh = ~changed & state['done'][pos]
+
+    new = {'fid': fids, 'geom': geoms, 'n_rasters': len(rasters)}
+    for k, (raster, cls) in enumerate(zip(rasters, classes)):
+        index = load_tile_index(layer_fn, raster)
+        rows = np.searchsorted(index['fid'], fids)
+        windows = np.column_stack([index[name][rows] for name in
+                                   ['xoff', 'yoff', 'xcount', 'ycount']])
+        key = raster_key(raster)
+        new['raster_%d' % k] = np.array(key, dtype='S64')
+        new['classes_%d' % k] = cls
+        new['win_%d' % k] = windows
+        new['bwin_%d' % k] = np.zeros((0, 4), dtype=np.int64)
+        new['crc_%d' % k] = np.array([], dtype=np.uint32)
+
+        saved_key = (state['raster_%d' % k].item().decode('ascii')
+                     if usable else '')
+        if (not usable or not fresh.any() or not key or
+                saved_key.split(':')[0] != key.split(':')[0] or
+                'bwin_%d' % k not in state or
+                not np.array_equal(state['classes_%d' % k], cls)):
+            fresh[:] = False
+            continue
+
+        # Tiles touching blocks whose pixels changed, digesting the blocks
+        # counted before again only if the raster file changed
+        new['bwin_%d' % k] = state['bwin_%d' % k]
+        new['crc_%d' % k] = state['crc_%d' % k]
+        if saved_key != key:
+            band = raster.GetRasterBand(1)
+            new['crc_%d' % k] = np.array(
+                [zlib.crc32(np.ascontiguousarray(
+                    band.ReadAsArray(*w)).tobytes()) & 0xffffffff
+                 for w in new['bwin_%d' % k].tolist()], dtype=np.uint32)
+            hit, _ = window_pairs(windows, new['bwin_%d' % k][
+                new['crc_%d' % k] != state['crc_%d' % k]])
+            fresh[hit] = False
+
+        # Tiles overlapping the current or former window of a changed tile
+        hit, _ = window_pairs(windows, windows[changed])
+        fresh[hit] = False
+        hit, _ = window_pairs(windows, state['win_%d' % k][
+            removed | np.in1d(state['fid'], fids[changed])])
+        fresh[hit] = False
+
+    for k, cls in enumerate(classes):
+        counts = np.zeros((n, cls.size), dtype=np.int64)
+        if fresh.any():
+            counts[fresh] = state['counts_%d' % k][pos[fresh]]
+        new['counts_%d' % k] = counts
+    new['done'] = fresh
+    new['run'] = np.array('', dtype='S12')
+
+    logger.debug('Reusing checkpointed counts of {n} of {t} tiles'.format(
+        n=fresh.sum(), t=n))
+    return new
+
+
+def record_counts(state, fids, counts):
+    """ Add counts of tiles `fids` to checkpoint state and mark them done
+
+    Counts of a tile split over several parts of the work add up.
+    """
+    rows = np.searchsorted(state['fid'], fids)
+    for k, cnt in enumerate(counts):
+        state['counts_%d' % k][rows] += cnt
+    state['done'][rows] = True
+
+
+def record_digests(state, digests):
+    """ Add digests of blocks read by the parts of a run to checkpoint state
+
+    Args:
+        state (dict): checkpoint state
+        digests (list): (windows, digests) of the blocks of each raster, for
+            each part
+    """
+    for k in range(int(state['n_rasters'])):
+        state['bwin_%d' % k], state['crc_%d' % k] = merge_digests(
+            [(state['bwin_%d' % k], state['crc_%d' % k])] +
+            [part[k] for part in digests])
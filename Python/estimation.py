@@ -0,0 +1,270 @@
+""" Two-stage accuracy and area estimation from a stage-4 sample table
+
+    Tiles are the primary sampling units (PSUs), drawn by stratified simple
+    random sampling within first-stage strata (`Strata1`, with `TilePop`
+    tiles each). Pixels are the second-stage units, drawn within map strata
+    (`Strata`) with inclusion probability `Inclu_2`. Every estimate is a
+    Horvitz-Thompson total, or a ratio of totals, of indicator variables
+    weighted by 1 / `Inclu_Fin`.
+
+    Standard errors follow the two-stage variance estimator (Cochran, 1977,
+    Section 11.8): the between-PSU variance of estimated tile totals within
+    first-stage strata, plus the second-stage variance scaled by the
+    first-stage weights. Selected tiles without samples count as PSUs with
+    zero totals. When map strata are sampled over all selected tiles together
+    (Stratified sampling in stage 4) the second stage is a stratified sample
+    of the pooled tiles, and the part of the between-PSU variance due to it
+    is taken out. Ratios (user's, producer's and overall accuracy, error
+    matrix proportions) are linearized as in Cochran (1977, Section 6.11).
+
+    All indicators are stacked as columns of
+    one matrix and reduced by group at once, so any number of classes costs
+    a few passes over the samples.
+"""
+from __future__ import division
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Reference class of samples not yet interpreted
+UNLABELLED = -1
+
+# Second-stage designs of stage 4
+_designs = ['Random', 'Stratified']
+
+
+def _codes(*keys):
+    """ Return dense codes of the distinct combinations of `keys` """
+    _, codes = np.unique(np.rec.fromarrays(keys), return_inverse=True)
+    return codes.ravel()
+
+
+def _group_sums(codes, values, n_groups):
+    """ Return sums of the rows of `values` in each group of `codes` """
+    out = np.zeros((n_groups, ) + values.shape[1:], dtype=np.float64)
+    if codes.size == 0:
+        return out
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    out[sorted_codes[starts]] = np.add.reduceat(values[order], starts, axis=0)
+    return out
+
+
+def _group_keys(codes, keys):
+    """ Return the key of each group of `codes`, for keys shared by all rows
+    of a group """
+    out = np.zeros(int(codes.max()) + 1 if codes.size else 0, dtype=np.int64)
+    out[codes] = keys
+    return out
+
+
+def sample_design(samples):
+    """ Return the two-stage design of a sample table
+
+    Second-stage strata are the groups of samples drawn together, following
+    the `Design` written by stage 4: the whole tile for `Random` samples, and
+    map strata pooled over all selected tiles for `Stratified` samples.
+
+    Args:
+        samples (dict): columns `Tile`, `TilePop`, `Strata1`, `Strata`,
+            `Inclu_1`, `Inclu_2` and `Design` of each sample
+
+    Returns:
+        dict: sample weights and PSU and stratum codes of the design
+    """
+    inclu1 = np.asarray(samples['Inclu_1'], dtype=np.float64)
+    inclu2 = np.asarray(samples['Inclu_2'], dtype=np.float64)
+    if (inclu1 <= 0).any() or (inclu2 <= 0).any():
+        raise ValueError('Inclusion probabilities must be positive')
+
+    # PSUs, and their first-stage stratum
+    psu = _codes(np.asarray(samples['Tile']))
+    strata1 = _codes(np.asarray(samples['Strata1']))
+    n_first = int(strata1.max()) + 1 if strata1.size else 0
+    first = _group_keys(psu, strata1)
+
+    # Tiles selected in each first-stage stratum, including those without
+    # samples (zero totals), and its sampling fraction
+    f_first = np.zeros(n_first)
+    f_first[strata1] = inclu1
+    n_h = np.zeros(n_first)
+    n_h[strata1] = np.round(inclu1 *
+                            np.asarray(samples['TilePop'], dtype=np.float64))
+    if (n_h < np.bincount(first, minlength=n_first)).any():
+        raise ValueError('Sample table has more tiles in a first-stage '
+                         'stratum than Inclu_1 * TilePop selected')
+
+    # Second-stage strata
+    if 'Design' not in samples:
+        raise ValueError('Sample table has no Design column; write it again '
+                         'with 4_SecondStageSample.py')
+    design = np.unique(np.asarray(samples['Design']).astype(str))
+    if design.size > 1 or design.size and design[0] not in _designs:
+        raise ValueError('Sample table must have a single Design, one of '
+                         '{d}; found {f}'.format(d=sorted(_designs),
+                                                 f=design.tolist()))
+    if design.size and design[0] == 'Stratified':
+        second = _codes(np.asarray(samples['Strata']))
+    else:
+        second = psu
+
+    return {'weights': 1 / (inclu1 * inclu2),
+            'inclu1': inclu1,
+            'inclu2': inclu2,
+            'psu': psu,
+            'strata1': strata1,
+            'first': first,
+            'n_first': n_h,
+            'f_first': f_first,
+            'second': second}
+
+
+def total_variance(design, y):
+    """ Return estimated totals of the columns of `y` and their variances
+
+    The variance is the between-PSU variance of estimated tile totals,
+    less the part of it due to the second stage, plus the variance of the
+    second stage given the selected tiles. Samples of a second-stage stratum
+    may span several tiles, so estimated tile totals may be correlated.
+
+    Args:
+        design (dict): design from `sample_design`
+        y (np.ndarray): one row per sample, one column per variable
+
+    Returns:
+        tuple: totals and variances (np.ndarray) of each column
+    """
+    y = np.asarray(y, dtype=np.float64).reshape(design['psu'].size, -1)
+    w = design['weights'][:, np.newaxis]
+    totals = (w * y).sum(axis=0)
+
+    # Between PSUs: estimated tile totals, expanded by the first stage,
+    # varying around their first-stage stratum mean. Selected tiles without
+    # samples have zero totals
+    psu, first, strata1 = design['psu'], design['first'], design['strata1']
+    n_h, f_h = design['n_first'], design['f_first']
+    n_first = n_h.size
+    z = _group_sums(psu, w * y, first.size)
+    sum_h = _group_sums(first, z, n_first)
+    ss_h = (_group_sums(first, z ** 2, n_first) -
+            sum_h ** 2 / np.maximum(n_h, 1)[:, np.newaxis])
+    # Strata with a single PSU are centered on the mean of all PSUs, as
+    # with the survey package's "adjust" option for lonely PSUs
+    lonely = n_h == 1
+    ss_h[lonely] = (sum_h[lonely] - totals / max(n_h.sum(), 1)) ** 2
+    scale = np.where(n_h > 1, n_h / np.maximum(n_h - 1, 1), 1.0) * (1 - f_h)
+
+    # Second stage: simple random samples within each second-stage stratum,
+    # of the samples expanded by the first stage
+    u = y / design['inclu1'][:, np.newaxis]
+    second = design['second']
+    n_second = int(second.max()) + 1 if second.size else 0
+    m = np.bincount(second, minlength=n_second).astype(np.float64)
+    pi2 = _group_sums(second, design['inclu2'], n_second) / np.maximum(m, 1)
+    c = np.where(m > 1, m * (1 - pi2) / pi2 ** 2 / np.maximum(m - 1, 1), 0)
+    s1 = _group_sums(second, u, n_second)
+    s2 = _group_sums(second, u ** 2, n_second)
+    within = (c[:, np.newaxis] *
+              (s2 - s1 ** 2 / np.maximum(m, 1)[:, np.newaxis])).sum(axis=0)
+
+    # Second-stage variance of the tile totals within each first-stage
+    # stratum, less that of their sum, as included in the between-PSU sum
+    # of squares
+    cm = c / np.maximum(m, 1)
+    a_h = _group_sums(strata1, c[second][:, np.newaxis] * u ** 2, n_first)
+    squares = []
+    for keys in (psu, strata1):
+        codes = _codes(second, keys)
+        k = _group_keys(codes, second)
+        s1_k = _group_sums(codes, u, k.size)
+        squares.append(_group_sums(_group_keys(codes, strata1),
+                                   cm[k][:, np.newaxis] * s1_k ** 2, n_first))
+    b_h, c_h = squares
+    n = np.maximum(n_h, 1)[:, np.newaxis]
+    d_h = np.where((n_h > 1)[:, np.newaxis],
+                   (1 - 1 / n) * a_h - b_h + c_h / n, 0)
+
+    between = (scale[:, np.newaxis] * (ss_h - d_h)).sum(axis=0)
+    # Small samples may give negative estimates
+    return totals, np.maximum(between + within, 0)
+
+
+def ratio_variance(design, y, x):
+    """ Return ratios of estimated totals of `y` and `x` columns and their
+    linearized variances """
+    y = np.asarray(y, dtype=np.float64).reshape(design['psu'].size, -1)
+    x = np.asarray(x, dtype=np.float64).reshape(design['psu'].size, -1)
+    w = design['weights'][:, np.newaxis]
+    ty, tx = (w * y).sum(axis=0), (w * x).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(tx > 0, ty / tx, np.nan)
+    _, var = total_variance(design, y - np.nan_to_num(ratio) * x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ratio, np.where(tx > 0, var / tx ** 2, np.nan)
+
+
+def assess_accuracy(samples, classes=None):
+    """ Estimate accuracy, area and error matrix of a map from its sample
+
+    Args:
+        samples (dict): sample table columns, with map (`Strata`) and
+            reference (`Reference`) class of each sample; samples still
+            `UNLABELLED` are rejected
+        classes (np.ndarray, optional): classes to report; by default all
+            classes found in the map or reference labels
+
+    Returns:
+        dict: `classes`; `users`, `producers` and their standard errors
+            `users_se`, `producers_se`; `overall` and `overall_se`; reference
+            class totals `area` and `area_se` (pixels); and the unbiased
+            `error_matrix` of area proportions (map class rows, reference
+            class columns) with standard errors `error_matrix_se`
+    """
+    design = sample_design(samples)
+    mapped = np.asarray(samples['Strata'], dtype=np.int64)
+    reference = np.asarray(samples['Reference'], dtype=np.int64)
+    unlabelled = np.count_nonzero(reference == UNLABELLED)
+    if unlabelled:
+        raise ValueError(
+            '{n} samples have no reference class ({u}); interpret every '
+            'sample before estimating accuracy'.format(n=unlabelled,
+                                                      u=UNLABELLED))
+    if classes is None:
+        classes = np.union1d(mapped, reference)
+    classes = np.asarray(classes, dtype=np.int64)
+    k = classes.size
+    logger.debug('Assessing {n} samples of {k} classes'.format(
+        n=mapped.size, k=k))
+
+    # Indicators of map and reference class, and of agreement
+    map_ind = (mapped[:, np.newaxis] == classes).astype(np.float64)
+    ref_ind = (reference[:, np.newaxis] == classes).astype(np.float64)
+    correct = map_ind * ref_ind
+    ones = np.ones((mapped.size, 1))
+
+    users, users_var = ratio_variance(design, correct, map_ind)
+    producers, producers_var = ratio_variance(design, correct, ref_ind)
+    overall, overall_var = ratio_variance(design, correct.sum(axis=1), ones)
+    area, area_var = total_variance(design, ref_ind)
+
+    # Error matrix cells as proportions of the estimated map area
+    cells = (map_ind[:, :, np.newaxis] *
+             ref_ind[:, np.newaxis, :]).reshape(mapped.size, k * k)
+    matrix, matrix_var = ratio_variance(design, cells, ones)
+
+    return {'classes': classes,
+            'users': users,
+            'users_se': np.sqrt(users_var),
+            'producers': producers,
+            'producers_se': np.sqrt(producers_var),
+            'overall': float(overall[0]),
+            'overall_se': float(np.sqrt(overall_var[0])),
+            'area': area,
+            'area_se': np.sqrt(area_var),
+            'error_matrix': matrix.reshape(k, k),
+            'error_matrix_se': np.sqrt(matrix_var).reshape(k, k)}
@@ -0,0 +1,210 @@
+""" Streaming class histograms of categorical rasters
+
+    The band is read once, block by block, and a running `np.bincount` is kept
+    so memory stays flat regardless of the raster or the number of classes.
+
+    Histograms are cached in a JSON sidecar next to the raster
+    (`<raster>.hist.json`) so every stage of the sampling workflow can reuse
+    them. The sidecar records the raster's size and modification time and is
+    only recomputed when those change. Full histograms (no values excluded)
+    are stored per band; no data values are dropped when the cache is read,
+    so any set of no data values is served from the same entry.
+"""
+from __future__ import division
+
+import json
+import logging
+import os
+
+import numpy as np
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+from blocks import iter_blocks
+
+logger = logging.getLogger(__name__)
+
+_sidecar_ext = '.hist.json'
+
+
+def _bincount_range(dtype):
+    """ Return (offset, nbins) if `dtype` is small enough for `np.bincount` """
+    if dtype.kind in 'bu' and dtype.itemsize <= 2:
+        return 0, int(np.iinfo(dtype).max) + 1
+    if dtype.kind == 'i' and dtype.itemsize <= 2:
+        info = np.iinfo(dtype)
+        return -int(info.min), int(info.max) - int(info.min) + 1
+    return None
+
+
+def _histogram(arrays, ndv=None):
+    """ Accumulate one histogram over a sequence of arrays of the same type
+
+    Byte and 16 bit arrays are counted with a fixed size `np.bincount`; other
+    data types fall back to `np.unique` per array, merged as we go. NaN is
+    not a class and is left out.
+    """
+    hist = None
+    extra = {}
+    offset = 0
+    for arr in arrays:
+        if hist is None and not extra:
+            bins = _bincount_range(arr.dtype)
+            if bins is not None:
+                offset, nbins = bins
+                hist = np.zeros(nbins, dtype=np.int64)
+
+        if hist is not None:
+            values = arr.ravel()
+            if offset:
+                values = values.astype(np.int32) + offset
+            hist += np.bincount(values, minlength=hist.size)
+        else:
+            values, counts = np.unique(arr, return_counts=True)
+            if values.dtype.kind in 'fc':
+                keep = ~np.isnan(values)
+                values, counts = values[keep], counts[keep]
+            for v, n in zip(values.tolist(), counts.tolist()):
+                extra[v] = extra.get(v, 0) + n
+
+    if hist is not None:
+        classes = np.flatnonzero(hist)
+        counts = hist[classes]
+        classes = classes - offset
+    else:
+        classes = np.array(sorted(extra))
+        counts = np.array([extra[c] for c in classes.tolist()],
+                          dtype=np.int64)
+
+    return _exclude(classes, counts, ndv)
+
+
+def _exclude(classes, counts, ndv):
+    """ Drop `ndv` values from a histogram """
+    if ndv is None:
+        return classes, counts
+    keep = ~np.in1d(classes, ndv)
+    return classes[keep], counts[keep]
+
+
+def array_histogram(arr, ndv=None):
+    """ Count pixels of each class in an in-memory array
+
+    Args:
+        arr (np.ndarray or list): categorical image, or several arrays of the
+            same type counted together
+        ndv (list, optional): values to leave out of the histogram
+
+    Returns:
+        tuple: sorted class values and their pixel counts (ndarrays)
+    """
+    return _histogram([arr] if isinstance(arr, np.ndarray) else arr, ndv)
+
+
+def raster_histogram(band, ndv=None):
+    """ Count pixels of each class in `band` in a single streaming pass
+
+    Args:
+        band (gdal.Band): categorical raster band
+        ndv (list, optional): values to leave out of the histogram
+
+    Returns:
+        tuple: sorted class values and their pixel counts (ndarrays)
+    """
+    return _histogram((arr for _, _, arr in iter_blocks(band)), ndv)
+
+
+def histogram_sidecar(path):
+    """ Return filename of the histogram cache for raster `path` """
+    return path + _sidecar_ext
+
+
+def _raster_key(path):
+    """ Return the file identity the cache is validated against """
+    st = os.stat(path)
+    return {'path': os.path.abspath(path),
+            'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+def _read_sidecar(path, key):
+    """ Return cached histograms for `path`, or {} if missing or stale """
+    sidecar = histogram_sidecar(path)
+    if not os.path.isfile(sidecar):
+        return {}
+    try:
+        with open(sidecar) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        logger.warning('Ignoring unreadable histogram cache {f}'.format(
+            f=sidecar))
+        return {}
+    if (cache.get('size') != key['size'] or
+            cache.get('mtime') != key['mtime']):
+        logger.debug('Histogram cache {f} is stale'.format(f=sidecar))
+        return {}
+    return dict((h['band'], h) for h in cache.get('histograms', []))
+
+
+def _write_sidecar(path, key, histograms):
+    """ Write histograms to the sidecar of `path`; failures are not fatal """
+    sidecar = histogram_sidecar(path)
+    cache = dict(key)
+    cache['histograms'] = [histograms[b] for b in sorted(histograms)]
+    try:
+        with open(sidecar, 'w') as f:
+            json.dump(cache, f)
+    except (IOError, OSError):
+        logger.warning('Could not write histogram cache {f}'.format(
+            f=sidecar))
+
+
+def cached_histogram(path, band=1, ndv=None, ds=None):
+    """ Return class histogram of raster `path`, reading it only if needed
+
+    The histogram is looked up in the raster's sidecar cache and only computed
+    (and stored) when the cache is missing or the raster has changed since.
+
+    Args:
+        path (str): raster filename
+        band (int, optional): band number
+        ndv (list, optional): values to leave out of the histogram
+        ds (gdal.Dataset, optional): already open dataset for `path`
+
+    Returns:
+        tuple: sorted class values and their pixel counts (ndarrays)
+    """
+    key = _raster_key(path)
+    histograms = _read_sidecar(path, key)
+
+    if band in histograms:
+        logger.debug('Using cached histogram from {f}'.format(
+            f=histogram_sidecar(path)))
+        classes = np.array(histograms[band]['classes'])
+        counts = np.array(histograms[band]['counts'], dtype=np.int64)
+        return _exclude(classes, counts, ndv)
+
+    logger.debug('Computing histogram of {f} band {b}'.format(f=path, b=band))
+    if ds is None:
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+    classes, counts = raster_histogram(ds.GetRasterBand(band))
+
+    histograms[band] = {'band': band,
+                        'classes': classes.tolist(),
+                        'counts': counts.tolist()}
+    _write_sidecar(path, key, histograms)
+
+    return _exclude(classes, counts, ndv)
+
+
+def store_histogram(path, classes, counts, band=1):
+    """ Cache the full histogram of raster `path`, counted while it was
+    written, so it's never read to count it """
+    key = _raster_key(path)
+    histograms = _read_sidecar(path, key)
+    histograms[band] = {'band': band,
+                        'classes': np.asarray(classes).tolist(),
+                        'counts': np.asarray(counts).tolist()}
+    _write_sidecar(path, key, histograms)
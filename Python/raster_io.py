@@ -0,0 +1,63 @@
+""" Shared raster access for the sampling stages
+
+    Datasets are opened read-only through a bounded pool of handles, so
+    stages that visit many tiles don't reopen the same rasters for each one.
+    Windows are read in the raster's native data type, and GDAL's block cache
+    is sized for reading large maps block by block.
+"""
+from collections import OrderedDict
+import os
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+# Open dataset handles kept in the pool
+MAX_HANDLES = 64
+
+# GDAL block cache size (MB), unless set with the GDAL_CACHEMAX option
+CACHE_MB = 512
+
+_pool = OrderedDict()
+_pool_pid = None
+
+
+def set_block_cache(megabytes=CACHE_MB):
+    """ Size GDAL's block cache, unless GDAL_CACHEMAX is already configured """
+    if gdal.GetConfigOption('GDAL_CACHEMAX') is None:
+        gdal.SetCacheMax(megabytes * 1024 * 1024)
+
+
+def open_dataset(path):
+    """ Return a read-only dataset for `path` from the handle pool
+
+    The least recently used handle is closed once the pool holds
+    `MAX_HANDLES` datasets. Handles aren't shared with forked processes.
+    """
+    global _pool_pid
+    if _pool_pid != os.getpid():
+        _pool.clear()
+        _pool_pid = os.getpid()
+
+    ds = _pool.pop(path, None)
+    if ds is None:
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise IOError('Could not open raster {f}'.format(f=path))
+    _pool[path] = ds
+
+    while len(_pool) > MAX_HANDLES:
+        _pool.popitem(last=False)
+    return ds
+
+
+def close_datasets():
+    """ Close all pooled dataset handles """
+    _pool.clear()
+
+
+def read_window(path, xoff, yoff, xcount, ycount, band=1):
+    """ Read a window of a raster band in its native data type """
+    return open_dataset(path).GetRasterBand(band).ReadAsArray(
+        xoff, yoff, xcount, ycount)
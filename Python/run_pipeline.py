@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+""" Run the whole two-stage sample design, stages 0 to 4, in one process
+
+    Intermediate products (strata map, tile statistics and first-stage
+    sample) are kept in memory and handed from stage to stage, rather than
+    written by one script and parsed again by the next. Only the final sample
+    is written, unless intermediate products are asked for with --keep.
+
+Usage:
+    run_pipeline.py [options] (Random | Stratified) <lcmap> <changemap> <tiles> <output>
+
+Options:
+    --forest <c>                Forest class of the land cover map [default: 2]
+    --out-forest <c>            Strata class of stable forest [default: 5]
+    --out-nonforest <c>         Strata class of stable non-forest [default: 6]
+    --other <classes>           Semicolon separated change map classes recoded
+                                to --out-other
+    --out-other <c>             Strata class of recoded classes [default: 0]
+    --cm-ndv <n>                No change value of the change map [default: 255]
+    --lc-ndv <n>                No data value of the land cover map [default: 255]
+    --thresh <t>                Threshold for proportion area for including
+                                tiles [default: .4]
+    -n --ndv <n>                Semicolon separated values of the maps treated as
+                                outside the study region [default: 0;255]
+    --tile-size <n>             First-stage sample size (tiles) [default: 100]
+    --size <size>               Second-stage sample size [default: 100]
+    --allocation <allocation>   Semicolon separated second-stage sample
+                                allocation of each stratum (Stratified)
+    --table <filename>          Also write samples to a table; format from
+                                extension (.arrow, .parquet or .csv)
+    --seed <seed>               Seed of the random sample; drawn at random and
+                                logged if not given
+    -j --jobs <n>               Number of processes [default: 1]
+    --keep                      Also write intermediate products next to
+                                <output>
+    -v --verbose                Show verbose debugging messages
+    -h --help                   Show help
+
+Notes:
+    Stages run as in the separate scripts: the strata map is created from
+    <changemap> and <lcmap> (0_PrepStrata), its classes are counted
+    (3_ClassCount), tiles of <tiles> are kept and stratified by change
+    (1_Prep_VHR), sampled with Neyman allocation (2_FirstStageSamply), and
+    pixels of the strata map are sampled within the selected tiles
+    (4_SecondStageSample). The maps are read once: class counts of the maps
+    and strata, overall and within every tile, are counted while the strata
+    map is written.
+
+    The strata map is held in GDAL's in-memory file system, which worker
+    processes share by forking; where processes aren't forked it is written
+    to a temporary file instead. With --keep it is written to
+    '<output>_strata.tif' (with its class counts cached), the kept tiles to
+    '<output>_strata.shp' (with its tile class count table) and the
+    first-stage sample to '<output>_stage1.shp', as the separate scripts
+    would write them.
+
+Example:
+
+    > run_pipeline.py --allocation '20; 60; 20' --size 100 Stratified landcover.tif changemap.tif rapideye.shp point_sample.shp
+"""
+from docopt import docopt
+from osgeo import ogr
+import numpy as np
+import gdal
+import importlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+from histogram import store_histogram
+from raster_io import close_datasets, open_dataset, set_block_cache
+from strata import create_strata
+from tile_index import load_tile_index
+from tile_sampling import new_seed
+from zonal import tile_counts_filename, tile_counts_table, write_tile_counts
+
+# Stages are run through the functions of the stage scripts
+stage1 = importlib.import_module('1_Prep_VHR')
+stage2 = importlib.import_module('2_FirstStageSamply')
+stage4 = importlib.import_module('4_SecondStageSample')
+
+#Logging
+import logging
+VERBOSE = False
+
+ogr.UseExceptions()
+ogr.RegisterAll()
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    level=logging.INFO,
+                    datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def run_pipeline(method, lcmap, changemap, tiles_fn, output, strata_opts,
+                 thresh, ndv, tile_size, size, allocation, table=None,
+                 seed=None, jobs=1, keep=False):
+    """ Run stages 0 to 4 of the sample design, keeping intermediate
+        products in memory
+
+    Args:
+        strata_opts (dict): `create_strata` class options of stage 0
+    """
+    base = os.path.splitext(output)[0]
+    if seed is None:
+        seed = new_seed()
+    logger.info('Running sample design with seed {s}'.format(s=seed))
+
+    #Stage 2 draws from NumPy's global random state
+    np.random.seed(np.random.SeedSequence(seed).generate_state(1))
+
+    #Stage 0: final strata, in memory unless kept. Workers only share GDAL's
+    #in-memory files when forked, so otherwise the strata go to a temporary
+    #file
+    logger.debug('Creating strata')
+    tmpdir = None
+    if keep:
+        strata_fn = base + '_strata.tif'
+    elif jobs > 1 and multiprocessing.get_start_method() != 'fork':
+        tmpdir = tempfile.mkdtemp()
+        strata_fn = os.path.join(tmpdir, 'strata.tif')
+    else:
+        strata_fn = '/vsimem/strata_{p}.tif'.format(p=os.getpid())
+
+    #Pixels of each class of the maps and strata within each tile are
+    #counted while the strata are written
+    changemap_open = open_dataset(changemap)
+    tiles_index = load_tile_index(tiles_fn, changemap_open)
+    strata_ds, classes, counts, tile_counts = create_strata(
+        changemap_open, open_dataset(lcmap), strata_fn, index=tiles_index,
+        **strata_opts)
+    strata_ds = None
+    (ch_classes, ch_counts), (lc_classes, lc_counts), \
+        (st_classes, st_counts) = tile_counts
+
+    try:
+        #Stage 3: class counts of the strata, counted while writing them,
+        #and cached with the kept strata
+        total = counts.sum()
+        for key, pixels in zip(classes, counts):
+            logger.info('Strata class {c}: {n} pixels ({p:.4f} of area)'.format(
+                c=key, n=pixels, p=pixels / float(total)))
+        if keep:
+            store_histogram(strata_fn, classes, counts)
+
+        #Stage 1: zonal statistics of tiles on the change map
+        logger.debug('Computing tile statistics')
+        tiles, in_fields, ch_classes, ch_counts = stage1.tile_statistics(
+            changemap, tiles_fn, lcmap, thresh, ndv, jobs,
+            counts=(lc_classes, lc_counts, ch_classes, ch_counts))
+        if keep:
+            tiles_ds = ogr.Open(tiles_fn, 0)
+            stage1.write_strata(base + '_strata.shp', tiles_ds.GetLayer(),
+                                tiles, in_fields)
+            tiles_ds = None
+            write_tile_counts(tile_counts_filename(base + '_strata.shp'),
+                              tiles['SampID'], ch_classes, ch_counts,
+                              tiles['overlap'], changemap_open)
+
+        #Stage 2: stratify kept tiles by change and sample them
+        logger.debug('Sampling tiles')
+        strata_1, strata_2, high, low, percent = stage2.sample_tiles(
+            'neyman', tile_size, None, tiles['area'])
+        if keep:
+            stage2.write_output(base + '_strata.shp', base + '_stage1.shp',
+                                strata_1, strata_2, high, low, percent)
+
+        #First-stage attributes of selected tiles, with their FIDs in the
+        #tile layer, whose tile index is shared with stage 1
+        selected = np.union1d(high, low).astype(np.int64)
+        first = dict(stage2.selection_fields(selected, tiles['fid'].size,
+                                             strata_1, strata_2, high, low,
+                                             percent))
+        first['fid'] = tiles['fid'][selected]
+        first['SampID'] = tiles['SampID'][selected]
+
+        #Stage 4: sample pixels of the strata within selected tiles, with
+        #strata populations of the selected tiles counted in stage 0
+        logger.debug('Sampling pixels')
+        strata_open = open_dataset(strata_fn)
+        index = load_tile_index(tiles_fn, strata_open)
+        population = None
+        if method == 'stratified':
+            population = stage4.tile_populations(
+                tile_counts_table(tiles['SampID'], st_classes,
+                                  st_counts[tiles['fid']], tiles['overlap'],
+                                  strata_open),
+                first, strata_open)
+        records = stage4.point_sample(method, size, first, tiles_fn,
+                                      strata_fn, index, allocation,
+                                      population, seed, jobs)
+
+        stage4.write_sample_layer(output, strata_open, records)
+        if table:
+            stage4.write_sample_table(table, records, strata_open)
+    finally:
+        close_datasets()
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+        elif not keep:
+            gdal.Unlink(strata_fn)
+
+
+def main():
+    """ Read in arguments and test them """
+
+    set_block_cache()
+
+    for name in ['<lcmap>', '<changemap>', '<tiles>']:
+        if not os.path.isfile(args[name]):
+            logger.error('Specified {n} file {f} does not exist'.format(
+                n=name, f=args[name]))
+            sys.exit(1)
+
+    try:
+        strata_opts = {
+            'forest': int(args['--out-forest']),
+            'nonforest': int(args['--out-nonforest']),
+            'inforest': int(args['--forest']),
+            'ndv': int(args['--cm-ndv']),
+            'lc_ndv': int(args['--lc-ndv']),
+            'outother': int(args['--out-other']),
+            'inother': ([int(i) for i in args['--other'].split(';')]
+                        if args['--other'] else None)}
+        ndv = [int(i) for i in args['--ndv'].split(';')]
+        thresh = float(args['--thresh'])
+        tile_size = int(args['--tile-size'])
+        size = int(args['--size'])
+        jobs = int(args['--jobs'])
+        seed = int(args['--seed']) if args['--seed'] is not None else None
+    except ValueError:
+        logger.error('Class values, sizes, jobs and seed must be integers')
+        sys.exit(1)
+    if jobs < 1:
+        logger.error('Number of jobs must be at least 1')
+        sys.exit(1)
+
+    # Sampling method
+    if args['Random']:
+        method = 'random'
+        allocation = None
+    else:
+        method = 'stratified'
+        if not args['--allocation']:
+            logger.error('Must specify sample allocation for stratified sample')
+            sys.exit(1)
+        allocation = [int(i) for i in args['--allocation'].split(';')]
+        if sum(allocation) != size:
+            logger.error('Sample size must equal strata allocation')
+            sys.exit(1)
+
+    run_pipeline(method, args['<lcmap>'], args['<changemap>'],
+                 args['<tiles>'], args['<output>'], strata_opts, thresh, ndv,
+                 tile_size, size, allocation, table=args['--table'],
+                 seed=seed, jobs=jobs, keep=args['--keep'])
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__,)
+
+    if args['--verbose']:
+        VERBOSE = True
+        for log in [logger, stage1.logger, stage2.logger, stage4.logger]:
+            log.setLevel(logging.DEBUG)
+
+    main()
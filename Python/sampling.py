@@ -0,0 +1,65 @@
+""" Simple random sampling of ranks and of pixels within tile masks """
+from __future__ import division
+
+import numpy as np
+
+
+def sample_ranks(population, n, rng=np.random):
+    """
+    Return sorted ranks of a simple random sample, without replacement, of `n`
+    units from a population of size `population`
+
+    Small samples from large populations are drawn by rejecting duplicates
+    rather than permuting the whole population, so memory scales with `n`.
+
+    Args:
+        population (int)        population size
+        n (int)                 sample size (<= population)
+        rng                     random generator (np.random.Generator) or
+                                the global `np.random` state
+
+    Return:
+        ranks (ndarray)         sorted sample ranks in [0, population)
+    """
+    if n == 0:
+        return np.array([], dtype=np.int64)
+    if n * 4 > population:
+        return np.sort(rng.choice(population, n, replace=False))
+
+    draw = getattr(rng, 'integers', None) or rng.randint
+    ranks = np.unique(draw(0, population, size=n))
+    while ranks.size < n:
+        ranks = np.unique(np.concatenate((
+            ranks, draw(0, population, size=n - ranks.size))))
+    return ranks
+
+
+def sample_mask(mask, n, rng=np.random):
+    """
+    Return row and column of a simple random sample, without replacement, of
+    `n` pixels set in `mask`
+
+    Ranks are drawn among the set pixels and located through per-row counts,
+    so no coordinate arrays of the whole mask are built.
+
+    Args:
+        mask (ndarray)          2D boolean mask of pixels to sample from
+        n (int)                 sample size (<= pixels set in `mask`)
+        rng                     random generator, as in `sample_ranks`
+
+    Return:
+        rows, cols (ndarray)    pixel coordinates, in row-major order
+    """
+    # Nothing to locate, and an empty mask has no columns to search
+    if n == 0:
+        return (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+    row_counts = np.count_nonzero(mask, axis=1)
+    ends = np.cumsum(row_counts)
+    ranks = sample_ranks(int(ends[-1]) if ends.size else 0, n, rng)
+
+    rows = np.searchsorted(ends, ranks, side='right')
+    within = ranks - (ends[rows] - row_counts[rows])
+    cols = np.argmax(np.cumsum(mask[rows], axis=1) > within[:, np.newaxis],
+                     axis=1)
+    return rows, cols
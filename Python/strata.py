@@ -0,0 +1,96 @@
+""" Final change strata from a change map and a land cover map
+
+    Stable pixels of the change map are split into stable forest and stable
+    non-forest using the land cover map, as in QGIS/0_PrepStrata.py. Both maps
+    are read once, in block-aligned windows, and the class histogram of the
+    strata is counted while they are written, so later stages don't need to
+    read the strata again to find its classes. Given a tile index, pixels of
+    each class of all three maps within each tile are counted in the same
+    pass.
+"""
+from __future__ import division
+
+import numpy as np
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+from blocks import block_windows
+from tile_index import label_block
+from zonal import block_class_counts, merge_class_counts
+
+
+def strata_block(cm_ar, lc_ar, ndv, forest, nonforest, inforest, lc_ndv,
+                 inother=None, outother=0):
+    """ Return strata of a window of the change and land cover maps """
+    out_ar = np.zeros(cm_ar.shape, dtype=np.uint8)
+
+    stable = cm_ar == ndv
+    out_ar[stable & (lc_ar == inforest)] = forest
+    out_ar[stable & (lc_ar != inforest)] = nonforest
+    out_ar[~stable] = cm_ar[~stable]
+    out_ar[lc_ar == lc_ndv] = ndv
+
+    if inother:
+        out_ar[np.in1d(cm_ar, inother).reshape(cm_ar.shape)] = outother
+    return out_ar
+
+
+def create_strata(changemap, lcmap, output, ndv, forest, nonforest, inforest,
+                  lc_ndv, inother=None, outother=0, driver='GTiff',
+                  index=None):
+    """ Create final change strata with the classes:
+    1..n: n number of change classes
+    <f>: specified class for stable forest
+    <o>: specified class for stable non-forest
+
+    Args:
+        changemap, lcmap (gdal.Dataset): aligned change and land cover maps
+        output (str): output filename (a `/vsimem/` path keeps it in memory)
+        driver (str, optional): GDAL driver of the output
+        index (dict, optional): tile index on the grid of the maps
+
+    Returns:
+        tuple: strata (gdal.Dataset), its sorted classes and their pixel
+            counts (np.ndarray) and, with `index`, the sorted classes and
+            pixel counts within each tile (one row per FID) of the change
+            map, land cover map and strata (list of tuples; else None)
+    """
+    cm_band = changemap.GetRasterBand(1)
+    lc_band = lcmap.GetRasterBand(1)
+    if (changemap.RasterXSize != lcmap.RasterXSize or
+            changemap.RasterYSize != lcmap.RasterYSize):
+        raise ValueError('Landcover and change maps must be aligned')
+
+    options = ['COMPRESS=DEFLATE'] if driver == 'GTiff' else []
+    out_ds = gdal.GetDriverByName(driver).Create(
+        output, changemap.RasterXSize, changemap.RasterYSize, 1,
+        gdal.GDT_Byte, options=options)
+    out_ds.SetGeoTransform(changemap.GetGeoTransform())
+    out_ds.SetProjection(changemap.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+
+    counts = np.zeros(256, dtype=np.int64)
+    parts = [[], [], []]
+    for xoff, yoff, xsize, ysize in block_windows(cm_band):
+        cm_ar = cm_band.ReadAsArray(xoff, yoff, xsize, ysize)
+        lc_ar = lc_band.ReadAsArray(xoff, yoff, xsize, ysize)
+        out_ar = strata_block(cm_ar, lc_ar, ndv, forest, nonforest, inforest,
+                              lc_ndv, inother, outother)
+        out_band.WriteArray(out_ar, xoff, yoff)
+        counts += np.bincount(out_ar.ravel(), minlength=256)
+
+        if index is not None:
+            label = label_block(index, xoff, yoff, xsize, ysize)
+            for part, arr in zip(parts, [cm_ar, lc_ar, out_ar]):
+                part.append(block_class_counts(label, arr))
+    out_band.FlushCache()
+
+    tile_counts = None
+    if index is not None:
+        n_rows = int(index['fid'].max()) + 1 if index['fid'].size else 0
+        tile_counts = [merge_class_counts(part, n_rows) for part in parts]
+
+    classes = np.flatnonzero(counts)
+    return out_ds, classes, counts[classes], tile_counts
@@ -0,0 +1,102 @@
+""" Columnar export of sample tables
+
+    Sample tables are written straight from NumPy columns to Arrow IPC
+    (`.arrow`, `.feather`) or Parquet (`.parquet`) when `pyarrow` is
+    installed, and to CSV otherwise, so estimation can read them directly
+    without converting the vector output. Tables are read back into NumPy
+    columns the same way.
+"""
+from __future__ import division
+
+import logging
+import os
+
+import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+_arrow_ext = ['.arrow', '.feather', '.ipc']
+_parquet_ext = ['.parquet']
+
+
+def write_table(filename, columns):
+    """ Write a table of equal length columns
+
+    The format follows the file extension. Arrow and Parquet fall back to CSV
+    (with a `.csv` extension) if `pyarrow` is unavailable.
+
+    Args:
+        filename (str): output filename
+        columns (list): (name, values) for each column, in order
+
+    Returns:
+        str: filename written
+    """
+    root, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext in _arrow_ext + _parquet_ext and pa is None:
+        logger.warning('pyarrow is not installed; writing CSV table instead')
+        filename, ext = root + '.csv', '.csv'
+
+    names = [name for name, _ in columns]
+    arrays = [np.asarray(values) for _, values in columns]
+
+    if ext in _arrow_ext + _parquet_ext:
+        table = pa.Table.from_arrays([pa.array(a) for a in arrays],
+                                     names=names)
+        if ext in _parquet_ext:
+            pq.write_table(table, filename)
+        else:
+            sink = pa.OSFile(filename, 'wb')
+            try:
+                writer = pa.ipc.new_file(sink, table.schema)
+                writer.write_table(table)
+                writer.close()
+            finally:
+                sink.close()
+    else:
+        # Full precision for floats so the CSV round-trips exactly
+        fmt = ['%d' if a.dtype.kind in 'biu' else
+               '%s' if a.dtype.kind in 'OSU' else '%.17g' for a in arrays]
+        np.savetxt(filename, np.rec.fromarrays(arrays, names=names),
+                   fmt=fmt, delimiter=',', header=','.join(names),
+                   comments='')
+
+    logger.debug('Wrote sample table {f}'.format(f=filename))
+    return filename
+
+
+def read_table(filename):
+    """ Read a table written by `write_table` into NumPy columns
+
+    Args:
+        filename (str): Arrow, Parquet or CSV table, by extension
+
+    Returns:
+        dict: values (np.ndarray) of each column
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in _arrow_ext + _parquet_ext:
+        if pa is None:
+            raise ImportError('pyarrow is required to read {f}'.format(
+                f=filename))
+        if ext in _parquet_ext:
+            table = pq.read_table(filename)
+        else:
+            source = pa.memory_map(filename, 'r')
+            try:
+                table = pa.ipc.open_file(source).read_all()
+            finally:
+                source.close()
+        return dict((name, table.column(name).to_numpy())
+                    for name in table.column_names)
+
+    data = np.genfromtxt(filename, delimiter=',', names=True, dtype=None,
+                         encoding='utf-8')
+    return dict((name, np.atleast_1d(data[name]))
+                for name in data.dtype.names)
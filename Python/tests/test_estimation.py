@@ -0,0 +1,166 @@
+""" Simulation tests of the two-stage estimator against repeated samples of a
+    known population, for both second-stage sampling methods of stage 4 """
+from __future__ import division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from estimation import assess_accuracy, sample_design  # noqa: E402
+
+CLASSES = np.array([1, 2, 3])
+TILE_POP = np.array([24, 16])
+TILES_SAMPLED = np.array([6, 4])
+REPLICATES = 1000
+
+
+def make_population(rng):
+    """ Return map and reference classes of the pixels of each tile, and the
+    first-stage stratum of each tile """
+    tiles, strata1 = [], []
+    for h, n_tiles in enumerate(TILE_POP):
+        for _ in range(n_tiles):
+            size = rng.integers(40, 400)
+            mapped = rng.choice(CLASSES, size, p=rng.dirichlet([2, 2, 2]))
+            wrong = rng.random(size) < 0.2
+            reference = np.where(wrong, rng.choice(CLASSES, size), mapped)
+            tiles.append((mapped, reference))
+            strata1.append(h)
+    return tiles, np.array(strata1)
+
+
+def select_tiles(rng, strata1):
+    """ Return tiles selected by stratified simple random sampling """
+    return np.concatenate([
+        rng.choice(np.flatnonzero(strata1 == h), n, replace=False)
+        for h, n in enumerate(TILES_SAMPLED)])
+
+
+def sample_table(tile, strata1, mapped, reference, inclu2, total, design):
+    """ Return a sample table with the stage-4 columns """
+    h = strata1[tile]
+    return {'Tile': tile,
+            'TilePop': TILE_POP[h],
+            'Strata1': h,
+            'Strata': mapped,
+            'Reference': reference,
+            'TotalPix': total,
+            'Inclu_1': TILES_SAMPLED[h] / TILE_POP[h],
+            'Inclu_2': inclu2,
+            'Design': np.repeat(design, tile.size)}
+
+
+def random_sample(rng, tiles, strata1, size=10):
+    """ Sample `size` pixels at random within each selected tile """
+    tile, mapped, reference, inclu2, total = [], [], [], [], []
+    for t in select_tiles(rng, strata1):
+        pick = rng.choice(tiles[t][0].size, size, replace=False)
+        tile.append(np.repeat(t, size))
+        mapped.append(tiles[t][0][pick])
+        reference.append(tiles[t][1][pick])
+        inclu2.append(np.repeat(size / tiles[t][0].size, size))
+        total.append(np.repeat(tiles[t][0].size, size))
+    return sample_table(np.concatenate(tile), strata1,
+                        np.concatenate(mapped), np.concatenate(reference),
+                        np.concatenate(inclu2), np.concatenate(total),
+                        'Random')
+
+
+def stratified_sample(rng, tiles, strata1, sizes=(40, 30, 30)):
+    """ Sample pixels of each map class from all selected tiles together """
+    selected = select_tiles(rng, strata1)
+    tile = np.concatenate([np.repeat(t, tiles[t][0].size) for t in selected])
+    mapped = np.concatenate([tiles[t][0] for t in selected])
+    reference = np.concatenate([tiles[t][1] for t in selected])
+
+    pick, inclu2, total = [], [], []
+    for c, n in zip(CLASSES, sizes):
+        pixels = np.flatnonzero(mapped == c)
+        pick.append(rng.choice(pixels, n, replace=False))
+        inclu2.append(np.repeat(n / pixels.size, n))
+        total.append(np.repeat(pixels.size, n))
+    pick = np.concatenate(pick)
+    return sample_table(tile[pick], strata1, mapped[pick], reference[pick],
+                        np.concatenate(inclu2), np.concatenate(total),
+                        'Stratified')
+
+
+@pytest.mark.parametrize('sampler', [random_sample, stratified_sample])
+def test_estimates_and_standard_errors(sampler):
+    rng = np.random.default_rng(7)
+    tiles, strata1 = make_population(rng)
+    mapped = np.concatenate([m for m, _ in tiles])
+    reference = np.concatenate([r for _, r in tiles])
+    area = (reference[:, np.newaxis] == CLASSES).sum(axis=0)
+    overall = np.mean(mapped == reference)
+
+    results = [assess_accuracy(sampler(rng, tiles, strata1), CLASSES)
+               for _ in range(REPLICATES)]
+    est_area = np.array([r['area'] for r in results])
+    est_overall = np.array([r['overall'] for r in results])
+
+    # Area totals are unbiased; overall accuracy nearly so
+    se_mean = est_area.std(axis=0) / np.sqrt(REPLICATES)
+    assert (np.abs(est_area.mean(axis=0) - area) < 4 * se_mean).all()
+    assert abs(est_overall.mean() - overall) < 0.01
+
+    # Estimated variances match the variance of the estimates
+    ratio = (np.array([r['area_se'] for r in results]) ** 2).mean(axis=0) / \
+        est_area.var(axis=0)
+    assert ((ratio > 0.85) & (ratio < 1.15)).all()
+    ratio = np.mean([r['overall_se'] ** 2 for r in results]) / \
+        est_overall.var()
+    assert 0.8 < ratio < 1.2
+
+
+def test_second_stage_strata():
+    rng = np.random.default_rng(3)
+    tiles, strata1 = make_population(rng)
+
+    samples = random_sample(rng, tiles, strata1)
+    design = sample_design(samples)
+    assert np.array_equal(design['second'], design['psu'])
+
+    samples = stratified_sample(rng, tiles, strata1)
+    design = sample_design(samples)
+    assert design['second'].max() + 1 == CLASSES.size
+    assert np.array_equal(design['n_first'], TILES_SAMPLED)
+
+    # Selected tiles without samples still count in their stratum
+    keep = samples['Tile'] != samples['Tile'][0]
+    design = sample_design(dict((k, v[keep]) for k, v in samples.items()))
+    assert design['first'].size == np.unique(samples['Tile']).size - 1
+    assert np.array_equal(design['n_first'], TILES_SAMPLED)
+
+
+def test_more_tiles_than_selected():
+    rng = np.random.default_rng(5)
+    tiles, strata1 = make_population(rng)
+    samples = random_sample(rng, tiles, strata1)
+    samples['TilePop'] = samples['TilePop'] // 2
+    with pytest.raises(ValueError):
+        sample_design(samples)
+
+
+def test_design_column():
+    rng = np.random.default_rng(11)
+    tiles, strata1 = make_population(rng)
+
+    # Stratified samples are pooled by map stratum, however few per tile
+    samples = stratified_sample(rng, tiles, strata1, sizes=(3, 3, 3))
+    design = sample_design(samples)
+    assert np.array_equal(design['second'],
+                          np.searchsorted(CLASSES, samples['Strata']))
+
+    samples = random_sample(rng, tiles, strata1)
+    samples['Design'] = np.where(np.arange(samples['Tile'].size) == 0,
+                                 'Stratified', 'Random')
+    with pytest.raises(ValueError):
+        sample_design(samples)
+    del samples['Design']
+    with pytest.raises(ValueError):
+        sample_design(samples)
@@ -0,0 +1,116 @@
+""" Uniformity tests of the simple random samplers: every subset of the
+    sample size is drawn equally often, within each stratum for stratified
+    samples """
+from __future__ import division
+
+from itertools import combinations
+import os
+import sys
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from sampling import sample_mask, sample_ranks  # noqa: E402
+
+REPLICATES = 20000
+
+
+def chi_square(draws, cells):
+    """ Return Pearson's statistic of `draws` (tuples) against equal
+    frequencies of each of `cells` """
+    cells = list(cells)
+    counts = dict((c, 0) for c in cells)
+    for d in draws:
+        counts[d] += 1
+    expected = len(draws) / len(cells)
+    return sum((n - expected) ** 2 / expected for n in counts.values())
+
+
+def chi_square_limit(df):
+    """ Return a bound the statistic with `df` degrees of freedom exceeds
+    with probability of about 1e-4 """
+    return df + 6 * np.sqrt(2 * df)
+
+
+@pytest.mark.parametrize('population, n', [(6, 3), (12, 2)])
+def test_sample_ranks_uniform(population, n):
+    # Large samples permute the population; small ones reject duplicates
+    rng = np.random.default_rng(1)
+    draws = []
+    for _ in range(REPLICATES):
+        ranks = sample_ranks(population, n, rng)
+        assert np.all(np.diff(ranks) > 0)
+        draws.append(tuple(ranks.tolist()))
+    cells = list(combinations(range(population), n))
+    assert set(draws) <= set(cells)
+    assert chi_square(draws, cells) < chi_square_limit(len(cells) - 1)
+
+
+def test_sample_ranks_global_state():
+    np.random.seed(2)
+    ranks = sample_ranks(1000, 10)
+    assert ranks.size == 10 and np.unique(ranks).size == 10
+    assert sample_ranks(5, 0).size == 0
+
+
+def test_sample_mask_uniform():
+    mask = np.array([[0, 1, 0, 0, 1],
+                     [0, 0, 0, 0, 0],
+                     [1, 1, 0, 1, 0],
+                     [0, 0, 0, 0, 1]], dtype=bool)
+    pixels = list(zip(*np.nonzero(mask)))
+    rng = np.random.default_rng(3)
+
+    draws = []
+    for _ in range(REPLICATES):
+        rows, cols = sample_mask(mask, 2, rng)
+        # Samples fall on set pixels, in row-major order
+        assert mask[rows, cols].all()
+        assert np.all(np.diff(rows * mask.shape[1] + cols) > 0)
+        draws.append(tuple(zip(rows.tolist(), cols.tolist())))
+    cells = list(combinations(pixels, 2))
+    assert chi_square(draws, cells) < chi_square_limit(len(cells) - 1)
+
+
+def test_sample_mask_empty():
+    for mask in [np.zeros((3, 0), dtype=bool), np.zeros((0, 3), dtype=bool),
+                 np.ones((2, 2), dtype=bool)]:
+        rows, cols = sample_mask(mask, 0)
+        assert rows.size == 0 and cols.size == 0
+    with pytest.raises(ValueError):
+        sample_mask(np.zeros((3, 0), dtype=bool), 1)
+
+
+def test_random_stratified_uniform():
+    pytest.importorskip('docopt')
+    pytest.importorskip('osgeo')
+    sys.path.insert(0, os.path.join(HERE, os.pardir, os.pardir, 'QGIS'))
+    from sample_map import random_stratified
+
+    image = np.array([[1, 2, 0, 2],
+                      [3, 1, 2, 0],
+                      [2, 0, 1, 3]])
+    classes, counts = np.array([1, 2, 3]), np.array([1, 2, 0])
+    np.random.seed(4)
+
+    draws = dict((c, []) for c in classes.tolist())
+    for _ in range(REPLICATES // 2):
+        strata, cols, rows = random_stratified(image, classes, counts)
+        assert np.array_equal(image[rows, cols], strata)
+        for c in classes.tolist():
+            pick = strata == c
+            draws[c].append(tuple(zip(rows[pick].tolist(),
+                                      cols[pick].tolist())))
+
+    for c, n in zip(classes.tolist(), counts.tolist()):
+        cells = list(combinations(zip(*np.nonzero(image == c)), n))
+        stat = chi_square(draws[c], [tuple((int(r), int(k)) for r, k in cell)
+                                     for cell in cells])
+        assert stat < chi_square_limit(max(len(cells) - 1, 1))
+
+    # No classes to sample
+    strata, cols, rows = random_stratified(image, classes[:0], counts[:0])
+    assert strata.size == cols.size == rows.size == 0
@@ -0,0 +1,99 @@
+""" Tests of tile masks, block labels and window overlaps of a tile index
+    against brute force on random tiles """
+from __future__ import division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tile_index import label_block, tile_mask, window_pairs  # noqa: E402
+
+SHAPE = (60, 70)
+
+
+def make_index(rng, n=12):
+    """ Return a tile index of `n` random overlapping tiles, with masks
+    packed back to back, and the full mask of each tile """
+    fids = np.sort(rng.choice(100, n, replace=False))
+    windows, masks, packed = [], [], []
+    for _ in range(n):
+        xcount, ycount = rng.integers(1, 25, size=2)
+        xoff = rng.integers(0, SHAPE[1] - xcount + 1)
+        yoff = rng.integers(0, SHAPE[0] - ycount + 1)
+        mask = rng.random((ycount, xcount)) < 0.7
+        windows.append((xoff, yoff, xcount, ycount))
+        masks.append(mask)
+        packed.append(np.packbits(mask.ravel()))
+
+    windows = np.array(windows, dtype=np.int64)
+    index = {'fid': fids,
+             'xoff': windows[:, 0], 'yoff': windows[:, 1],
+             'xcount': windows[:, 2], 'ycount': windows[:, 3],
+             'offset': np.cumsum([0] + [p.size for p in packed])[:-1],
+             'masks': np.concatenate(packed)}
+    return index, masks
+
+
+def burn(index, masks, rows=None):
+    """ Return FID + 1 of the last tile, in FID order, covering each pixel """
+    label = np.zeros(SHAPE, dtype=np.int32)
+    for row in range(index['fid'].size) if rows is None else sorted(rows):
+        x, y = index['xoff'][row], index['yoff'][row]
+        ycount, xcount = masks[row].shape
+        label[y:y + ycount, x:x + xcount][masks[row]] = index['fid'][row] + 1
+    return label
+
+
+def test_tile_mask():
+    index, masks = make_index(np.random.default_rng(1))
+    for row, mask in enumerate(masks):
+        assert np.array_equal(tile_mask(index, row), mask)
+        for y0, y1 in [(0, 1), (2, 5), (mask.shape[0] - 1, None), (3, 100)]:
+            assert np.array_equal(tile_mask(index, row, y0, y1), mask[y0:y1])
+
+
+def test_label_block():
+    rng = np.random.default_rng(2)
+    index, masks = make_index(rng)
+    full = burn(index, masks)
+    assert np.array_equal(label_block(index, 0, 0, SHAPE[1], SHAPE[0]), full)
+
+    for _ in range(20):
+        xcount, ycount = rng.integers(1, 30, size=2)
+        xoff = rng.integers(0, SHAPE[1] - xcount + 1)
+        yoff = rng.integers(0, SHAPE[0] - ycount + 1)
+        assert np.array_equal(
+            label_block(index, xoff, yoff, xcount, ycount),
+            full[yoff:yoff + ycount, xoff:xoff + xcount])
+
+    rows = rng.choice(index['fid'].size, 5, replace=False)
+    assert np.array_equal(
+        label_block(index, 0, 0, SHAPE[1], SHAPE[0], rows=rows),
+        burn(index, masks, rows))
+
+
+def test_window_pairs():
+    rng = np.random.default_rng(3)
+    a = np.column_stack([rng.integers(0, 50, size=(30, 2)),
+                         rng.integers(1, 15, size=(30, 2))])
+    b = np.column_stack([rng.integers(0, 50, size=(20, 2)),
+                         rng.integers(1, 15, size=(20, 2))])
+
+    expected = set((i, j) for i in range(a.shape[0])
+                   for j in range(b.shape[0])
+                   if a[i, 0] < b[j, 0] + b[j, 2] and
+                   b[j, 0] < a[i, 0] + a[i, 2] and
+                   a[i, 1] < b[j, 1] + b[j, 3] and
+                   b[j, 1] < a[i, 1] + a[i, 3])
+    i, j = window_pairs(a, b)
+    assert i.size == len(expected)
+    assert set(zip(i.tolist(), j.tolist())) == expected
+
+    i, j = window_pairs(a, b[:0])
+    assert i.size == j.size == 0
@@ -0,0 +1,88 @@
+""" Tests that second-stage samples of each tile depend only on the seed and
+    the tile, not on how many processes share the work """
+from __future__ import division
+
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tile_sampling  # noqa: E402
+from tile_sampling import (allocated_samples, later_overlaps,  # noqa: E402
+                           random_tiles, tile_class_samples)
+
+WINDOWS = [(5, 0, 80, 60), (30, 10, 90, 80), (120, 100, 80, 85),
+           (60, 50, 100, 100), (150, 5, 60, 70)]
+JOBS = [1, 2] if 'fork' in multiprocessing.get_all_start_methods() else [1]
+
+
+@pytest.fixture
+def tiles(monkeypatch):
+    """ Patch the tile index and raster reads with random tiles on a random
+    map, returning the tile index """
+    rng = np.random.default_rng(0)
+    image = rng.integers(1, 4, size=(200, 220)).astype(np.uint8)
+    windows = np.array(WINDOWS, dtype=np.int64)
+    packed = [np.packbits((rng.random((h, w)) < 0.8).ravel())
+              for _, _, w, h in WINDOWS]
+    index = {'fid': np.arange(len(WINDOWS)),
+             'xoff': windows[:, 0], 'yoff': windows[:, 1],
+             'xcount': windows[:, 2], 'ycount': windows[:, 3],
+             'offset': np.cumsum([0] + [p.size for p in packed])[:-1],
+             'masks': np.concatenate(packed)}
+
+    monkeypatch.setattr(tile_sampling, '_tile_index', lambda l, r: index)
+    monkeypatch.setattr(tile_sampling, 'read_window',
+                        lambda fn, x, y, xc, yc: image[y:y + yc, x:x + xc])
+    return index
+
+
+def assert_same(a, b):
+    """ Assert nested lists and tuples of arrays are equal """
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        if isinstance(x, (list, tuple)):
+            assert_same(x, y)
+        else:
+            assert np.array_equal(x, y)
+
+
+def test_random_tiles(tiles):
+    fids = tiles['fid']
+    cover = later_overlaps(tiles, fids)
+    results = [random_tiles('tiles', 'map', fids, fids + 10, 30, 7, jobs,
+                            cover) for jobs in JOBS]
+    for result in results[1:]:
+        assert_same(result, results[0])
+
+    # Subsets of the tiles sample each tile as before
+    subset = random_tiles('tiles', 'map', fids[::2], fids[::2] + 10, 30, 7,
+                          JOBS[-1], cover[::2])
+    assert_same(subset, results[0][::2])
+
+
+def test_allocated_samples(tiles):
+    fids = tiles['fid']
+    cover = later_overlaps(tiles, fids)
+    results = []
+    for jobs in JOBS:
+        classes, counts, candidates = tile_class_samples(
+            'tiles', 'map', fids, cover, fids + 10, 11, 20, jobs)
+        allocation = np.minimum(counts, 5)
+        allocation[0] = 0
+        results.append((classes, counts,
+                        allocated_samples(candidates, classes, allocation)))
+    for result in results[1:]:
+        assert_same(result, results[0])
+
+    classes, counts, samples = results[0]
+    assert samples[0][0].size == 0
+    for (strata, rows, cols), alloc in zip(samples[1:], allocation[1:]):
+        assert np.array_equal(np.bincount(np.searchsorted(classes, strata),
+                                          minlength=classes.size), alloc)
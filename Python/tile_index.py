@@ -0,0 +1,271 @@
+""" Persistent index of tile windows and coverage masks on a raster grid
+
+    For every feature of a tile layer the index stores the pixel window of the
+    feature on a raster's grid (xoff, yoff, xcount, ycount) and a bit-packed
+    mask of the pixels it covers. Indexes are cached next to the layer in
+    `<layer>.<grid>.tiles.npz`, keyed by the raster grid and checked against
+    the layer file's size and modification time, so tiles are only rasterized
+    again when the layer changes.
+"""
+from __future__ import division
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+try:
+    from osgeo import gdal, ogr
+except ImportError:
+    import gdal
+    import ogr
+
+logger = logging.getLogger(__name__)
+
+_index_fields = ['fid', 'xoff', 'yoff', 'xcount', 'ycount', 'offset']
+
+
+def grid_key(raster):
+    """ Return a short digest identifying the pixel grid of `raster` """
+    key = repr((tuple(raster.GetGeoTransform()),
+                raster.RasterXSize, raster.RasterYSize,
+                raster.GetProjectionRef()))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+
+
+def raster_key(raster):
+    """ Return the identity of a raster file: grid, size and mtime
+
+    Rasters that aren't plain files (e.g. in GDAL's `/vsimem/`) get an empty
+    key. Empty keys compare equal, so products keyed by an in-memory raster
+    match any other in-memory raster and are only checked by their grid;
+    callers that need the file's identity must test for an empty key.
+    """
+    path = raster.GetDescription()
+    if not os.path.isfile(path):
+        return ''
+    st = os.stat(path)
+    return '{g}:{s}:{m!r}'.format(g=grid_key(raster), s=st.st_size,
+                                  m=st.st_mtime)
+
+
+def tile_index_filename(layer_fn, raster):
+    """ Return filename of the tile index of `layer_fn` on grid of `raster` """
+    return '{l}.{g}.tiles.npz'.format(l=layer_fn, g=grid_key(raster))
+
+
+def extent_window(extent, gt, xsize, ysize):
+    """ Return pixel window (x0, y0, x1, y1) covering an extent, clipped to
+    the raster """
+    xmin, xmax, ymin, ymax = extent
+    x0 = int(np.floor((xmin - gt[0]) / gt[1]))
+    x1 = int(np.ceil((xmax - gt[0]) / gt[1]))
+    y0 = int(np.floor((ymax - gt[3]) / gt[5]))
+    y1 = int(np.ceil((ymin - gt[3]) / gt[5]))
+    return (max(x0, 0), max(y0, 0),
+            max(min(x1, xsize), 0), max(min(y1, ysize), 0))
+
+
+def build_tile_index(layer, raster):
+    """ Rasterize each feature of `layer` into its own window of `raster`
+
+    Args:
+        layer (ogr.Layer): tile polygons
+        raster (gdal.Dataset): raster defining the pixel grid
+
+    Returns:
+        dict: index arrays, ordered by FID
+    """
+    gt = raster.GetGeoTransform()
+    xsize, ysize = raster.RasterXSize, raster.RasterYSize
+
+    # One feature at a time is burned from a scratch memory layer
+    scratch_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    scratch = scratch_ds.CreateLayer('tile', layer.GetSpatialRef(),
+                                     ogr.wkbUnknown)
+    mem = gdal.GetDriverByName('MEM')
+
+    records, masks = [], []
+    offset = 0
+    layer.ResetReading()
+    for feat in layer:
+        geom = feat.GetGeometryRef()
+        x0, y0, x1, y1 = extent_window(geom.GetEnvelope(), gt, xsize, ysize)
+        xcount, ycount = max(x1 - x0, 0), max(y1 - y0, 0)
+
+        mask = np.zeros((ycount, xcount), dtype=np.uint8)
+        if xcount and ycount:
+            target = mem.Create('', xcount, ycount, 1, gdal.GDT_Byte)
+            target.SetGeoTransform((gt[0] + x0 * gt[1] + y0 * gt[2], gt[1],
+                                    gt[2],
+                                    gt[3] + x0 * gt[4] + y0 * gt[5], gt[4],
+                                    gt[5]))
+            target.SetProjection(raster.GetProjectionRef())
+            tile = ogr.Feature(scratch.GetLayerDefn())
+            tile.SetGeometry(geom)
+            scratch.CreateFeature(tile)
+            gdal.RasterizeLayer(target, [1], scratch, burn_values=[1])
+            scratch.DeleteFeature(tile.GetFID())
+            mask = target.GetRasterBand(1).ReadAsArray()
+            target = None
+
+        packed = np.packbits(mask.ravel() > 0)
+        records.append((feat.GetFID(), x0, y0, xcount, ycount, offset))
+        masks.append(packed)
+        offset += packed.size
+    layer.ResetReading()
+    scratch_ds = None
+
+    records = np.array(records, dtype=np.int64).reshape(-1, 6)
+    order = np.argsort(records[:, 0], kind='mergesort')
+    index = dict((name, records[order, i])
+                 for i, name in enumerate(_index_fields))
+    index['masks'] = (np.concatenate(masks) if masks else
+                      np.array([], dtype=np.uint8))
+    return index
+
+
+def load_tile_index(layer_fn, raster, layer=None):
+    """ Return the tile index of `layer_fn` on the grid of `raster`
+
+    The cached index is used if the layer file hasn't changed since it was
+    built; otherwise the index is built and cached again.
+
+    Args:
+        layer_fn (str): tile vector filename
+        raster (gdal.Dataset): raster defining the pixel grid
+        layer (ogr.Layer, optional): already open layer of `layer_fn`
+
+    Returns:
+        dict: index arrays, ordered by FID
+    """
+    fn = tile_index_filename(layer_fn, raster)
+    st = os.stat(layer_fn)
+
+    if os.path.isfile(fn):
+        try:
+            cached = np.load(fn)
+            if (int(cached['layer_size']) == st.st_size and
+                    float(cached['layer_mtime']) == st.st_mtime):
+                logger.debug('Using tile index {f}'.format(f=fn))
+                return dict((name, cached[name])
+                            for name in _index_fields + ['masks'])
+        except (IOError, OSError, KeyError, ValueError):
+            logger.warning('Ignoring unreadable tile index {f}'.format(f=fn))
+
+    logger.debug('Building tile index {f}'.format(f=fn))
+    vector_ds = None
+    if layer is None:
+        vector_ds = ogr.Open(layer_fn, 0)
+        layer = vector_ds.GetLayer()
+    index = build_tile_index(layer, raster)
+    vector_ds = None
+
+    try:
+        np.savez(fn, layer_size=st.st_size, layer_mtime=st.st_mtime, **index)
+    except (IOError, OSError):
+        logger.warning('Could not write tile index {f}'.format(f=fn))
+    return index
+
+
+def tile_row(index, fid):
+    """ Return row of feature `fid` in `index` """
+    return int(np.searchsorted(index['fid'], fid))
+
+
+def tile_window(index, row):
+    """ Return pixel window (xoff, yoff, xcount, ycount) of tile `row` """
+    return (int(index['xoff'][row]), int(index['yoff'][row]),
+            int(index['xcount'][row]), int(index['ycount'][row]))
+
+
+def tile_mask(index, row, y0=0, y1=None):
+    """ Return coverage mask (bool) of tile `row`, for rows `y0` to `y1` of
+    its window (all rows by default)
+
+    Only the bits of the requested rows are unpacked.
+    """
+    xcount, ycount = int(index['xcount'][row]), int(index['ycount'][row])
+    y1 = ycount if y1 is None else min(y1, ycount)
+    y0 = min(max(y0, 0), y1)
+    start, stop = y0 * xcount, y1 * xcount
+    offset = int(index['offset'][row])
+    packed = index['masks'][offset + start // 8:offset + (stop + 7) // 8]
+    bits = np.unpackbits(packed)[start % 8:start % 8 + stop - start]
+    return bits.reshape(y1 - y0, xcount).astype(bool)
+
+
+def mask_pixels(index):
+    """ Return the number of pixels covered by the mask of each tile """
+    nbytes = (index['xcount'] * index['ycount'] + 7) // 8
+    pixels = np.zeros(nbytes.size, dtype=np.int64)
+    # Masks are packed back to back, in the order tiles were indexed
+    some = np.flatnonzero(nbytes > 0)
+    some = some[np.argsort(index['offset'][some], kind='mergesort')]
+    if some.size:
+        ones = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis],
+                             axis=1).sum(axis=1)
+        pixels[some] = np.add.reduceat(ones[index['masks']],
+                                       index['offset'][some], dtype=np.int64)
+    return pixels
+
+
+def label_block(index, xoff, yoff, xcount, ycount, rows=None):
+    """ Return FID + 1 of the tile covering each pixel of a window (0 if none)
+
+    Tiles are burned in FID order, so where tiles overlap the larger FID
+    wins, as when rasterizing the whole layer.
+
+    Args:
+        index (dict): tile index
+        xoff, yoff, xcount, ycount (int): pixel window
+        rows (np.ndarray, optional): only consider these index rows
+    """
+    label = np.zeros((ycount, xcount), dtype=np.int32)
+
+    x0, y0 = index['xoff'], index['yoff']
+    x1, y1 = x0 + index['xcount'], y0 + index['ycount']
+    hits = np.flatnonzero((x0 < xoff + xcount) & (x1 > xoff) &
+                          (y0 < yoff + ycount) & (y1 > yoff))
+    if rows is not None:
+        hits = np.intersect1d(hits, rows)
+
+    for row in hits:
+        # Overlap of tile window and block window, in both frames
+        bx0, by0 = max(x0[row], xoff), max(y0[row], yoff)
+        bx1, by1 = min(x1[row], xoff + xcount), min(y1[row], yoff + ycount)
+        # Only the mask rows within the block are unpacked
+        sub = tile_mask(index, row, by0 - y0[row], by1 - y0[row])[
+            :, bx0 - x0[row]:bx1 - x0[row]]
+        label[by0 - yoff:by1 - yoff, bx0 - xoff:bx1 - xoff][sub] = \
+            index['fid'][row] + 1
+
+    return label
+
+
+def window_pairs(a, b):
+    """ Return index pairs (i, j) of windows `a[i]` and `b[j]` that overlap
+
+    Windows are rows of (xoff, yoff, xcount, ycount). Windows of `a` are
+    sorted by column offset, so each window of `b` is only checked against
+    those whose column range could reach it.
+    """
+    a = np.asarray(a, dtype=np.int64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.int64).reshape(-1, 4)
+    if a.shape[0] == 0 or b.shape[0] == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty
+
+    order = np.argsort(a[:, 0], kind='mergesort')
+    ax0 = a[order, 0]
+    width = int(a[:, 2].max())
+    lo = np.searchsorted(ax0, b[:, 0] - width, side='right')
+    hi = np.searchsorted(ax0, b[:, 0] + b[:, 2], side='left')
+    n = np.maximum(hi - lo, 0)
+
+    j = np.repeat(np.arange(b.shape[0]), n)
+    i = order[np.repeat(lo, n) + np.arange(n.sum()) -
+              np.repeat(np.cumsum(n) - n, n)]
+    keep = ((a[i, 0] < b[j, 0] + b[j, 2]) & (a[i, 0] + a[i, 2] > b[j, 0]) &
+            (a[i, 1] < b[j, 1] + b[j, 3]) & (a[i, 1] + a[i, 3] > b[j, 1]))
+    return i[keep], j[keep]
@@ -0,0 +1,246 @@
+""" Second-stage sampling of pixels within first-stage tiles, tile by tile
+
+    Every tile draws from its own random generator, spawned from the run seed
+    and the tile ID with `np.random.SeedSequence`, so samples don't depend on
+    the order tiles are visited in or on how many processes share the work.
+    Workers read their tile's window through the shared raster handle pool
+    and the cached tile index.
+"""
+from __future__ import division
+
+import logging
+import multiprocessing
+
+import numpy as np
+
+from histogram import array_histogram
+from raster_io import open_dataset, read_window
+from sampling import sample_mask
+from tile_index import (load_tile_index, tile_mask, tile_row, tile_window,
+                        window_pairs)
+
+logger = logging.getLogger(__name__)
+
+# Pixels left out along the edges of each tile's window
+EDGE_BUFFER = 25
+
+# Batches of tiles handed to each worker process
+CHUNKS_PER_JOB = 4
+
+# Tile indexes loaded by this process
+_indexes = {}
+
+
+def new_seed():
+    """ Return fresh entropy to seed a run """
+    return int(np.random.SeedSequence().entropy)
+
+
+def tile_rng(seed, tile):
+    """ Return the random generator of tile ID `tile` in run `seed` """
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(int(tile), )))
+
+
+def _tile_index(layer_fn, raster_fn):
+    """ Return the tile index of a layer on a raster grid, loaded once """
+    key = (layer_fn, raster_fn)
+    if key not in _indexes:
+        _indexes[key] = load_tile_index(layer_fn, open_dataset(raster_fn))
+    return _indexes[key]
+
+
+def later_overlaps(index, fids):
+    """ Return, for each tile in `fids`, the tiles in `fids` with a larger FID
+    whose windows overlap it
+
+    Where tiles overlap, pixels belong to the tile with the larger FID, as in
+    the stage-1 tile class counts (`tile_index.label_block`).
+    """
+    fids = np.asarray(fids, dtype=np.int64)
+    if fids.size == 0:
+        return []
+    rows = np.searchsorted(index['fid'], fids)
+    windows = np.column_stack([index[name][rows] for name in
+                               ['xoff', 'yoff', 'xcount', 'ycount']])
+
+    # Pairs of tiles (i covering j), grouped by tile j
+    i, j = window_pairs(windows, windows)
+    keep = fids[i] > fids[j]
+    i, j = i[keep], j[keep]
+    order = np.lexsort((fids[i], j))
+    i, j = i[order], j[order]
+    groups = np.split(fids[i], np.searchsorted(j, np.arange(1, fids.size)))
+    return [g.tolist() for g in groups]
+
+
+def read_tile(layer_fn, raster_fn, fid, cover=()):
+    """ Return the window values, coverage mask and offset of tile `fid`
+
+    Pixels also covered by tiles in `cover` are left out of the mask, so
+    each pixel belongs to a single tile.
+    """
+    index = _tile_index(layer_fn, raster_fn)
+    row = tile_row(index, fid)
+    xoff, yoff, xcount, ycount = tile_window(index, row)
+    zone = tile_mask(index, row)
+
+    for other in cover:
+        o = tile_row(index, other)
+        x, y, xc, yc = tile_window(index, o)
+        x0, y0 = max(x, xoff), max(y, yoff)
+        x1, y1 = min(x + xc, xoff + xcount), min(y + yc, yoff + ycount)
+        if x0 < x1 and y0 < y1:
+            zone[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] &= \
+                ~tile_mask(index, o, y0 - y, y1 - y)[:, x0 - x:x1 - x]
+
+    values = read_window(raster_fn, xoff, yoff, xcount, ycount)
+    return values, zone, xoff, yoff
+
+
+def sample_random(size, zone, xoff, yoff, rng=np.random):
+    """ Perform random sample of pixels within a tile
+
+        Pixels are drawn without replacement from the tile's coverage mask,
+        so samples always fall inside the tile polygon. Tiles without
+        pixels more than `EDGE_BUFFER` from the window edges get no samples
+        and a population of 0. """
+
+    #Buffer pixels to avoid edges
+    b = EDGE_BUFFER
+    inner = np.zeros_like(zone)
+    inner[b:-b, b:-b] = zone[b:-b, b:-b]
+    total = int(np.count_nonzero(inner))
+
+    # Tiles too small, or too thin, to hold pixels away from their edges
+    if total == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty + yoff, empty + xoff, 0, 0.0
+
+    if size > total:
+        logger.warning('Tile sample size larger than population')
+        logger.warning('Reducing sample count to size of population')
+        size = total
+
+    row, col = sample_mask(inner, size, rng)
+    inclu2 = float(size) / total
+    return row + yoff, col + xoff, total, inclu2
+
+
+def _random_worker(job):
+    """ Sample pixels at random within one tile """
+    layer_fn, raster_fn, fid, cover, tile, seed, size = job
+
+    values, zone, xoff, yoff = read_tile(layer_fn, raster_fn, fid, cover)
+    rows, cols, total, inclu2 = sample_random(size, zone, xoff, yoff,
+                                              tile_rng(seed, tile))
+    strata = values[rows - yoff, cols - xoff]
+    return rows, cols, strata, total, inclu2
+
+
+def _class_worker(job):
+    """ Count pixels of each class within one tile, and draw up to `cap`
+    pixels of each class in random order """
+    layer_fn, raster_fn, fid, cover, tile, seed, cap = job
+
+    values, zone, xoff, yoff = read_tile(layer_fn, raster_fn, fid, cover)
+    rng = tile_rng(seed, tile)
+
+    classes, counts = array_histogram(values[zone])
+    candidates = []
+    for c, n in zip(classes, counts):
+        row, col = sample_mask(zone & (values == c), min(int(n), cap), rng)
+        order = rng.permutation(row.size)
+        candidates.append((row[order] + yoff, col[order] + xoff))
+    return classes, counts, candidates
+
+
+def map_tiles(worker, work, jobs=1):
+    """ Run `worker` on each job, over `jobs` processes, in job order """
+    if jobs <= 1 or len(work) < 2:
+        return [worker(job) for job in work]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(worker, work,
+                        max(1, len(work) // (jobs * CHUNKS_PER_JOB)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def random_tiles(layer_fn, raster_fn, fids, tiles, size, seed, jobs=1,
+                 cover=None):
+    """ Sample `size` pixels at random within each tile
+
+    Pixels of each tile also covered by the tiles in its `cover` list are
+    left out.
+
+    Returns:
+        list: rows, columns, map values, tile population and inclusion
+            probability of the samples of each tile
+    """
+    if cover is None:
+        cover = [()] * len(fids)
+    work = [(layer_fn, raster_fn, int(fid), c, int(tile), seed, size)
+            for fid, c, tile in zip(fids, cover, tiles)]
+    return map_tiles(_random_worker, work, jobs)
+
+
+def tile_class_samples(layer_fn, raster_fn, fids, cover, tiles, seed, cap,
+                       jobs=1):
+    """ Count pixels of each class within each tile, drawing candidate
+    samples of each class in the same pass
+
+    Each tile's candidates of a class are a simple random sample of up to
+    `cap` of its pixels, in random order, so the first `n` of them are a
+    simple random sample of `n` pixels for any `n` up to `cap`. Tiles are
+    read once whatever samples are later allocated to them.
+
+    Returns:
+        tuple: sorted classes, counts (np.ndarray), one row per tile, and the
+            candidates of each tile (dict of rows and columns by class)
+    """
+    work = [(layer_fn, raster_fn, int(fid), c, int(tile), seed, cap)
+            for fid, c, tile in zip(fids, cover, tiles)]
+    results = map_tiles(_class_worker, work, jobs)
+
+    classes = np.unique(np.concatenate(
+        [c for c, _, _ in results] + [np.array([], dtype=np.int64)]))
+    counts = np.zeros((len(results), classes.size), dtype=np.int64)
+    candidates = []
+    for i, (c, n, cand) in enumerate(results):
+        counts[i, np.searchsorted(classes, c)] = n
+        candidates.append(dict(zip(c.tolist(), cand)))
+    return classes, counts, candidates
+
+
+def allocated_samples(candidates, classes, allocation):
+    """ Take the allocated number of samples of each class from the
+    candidates of each tile
+
+    Args:
+        candidates (list): candidates of each tile, from `tile_class_samples`
+        classes (np.ndarray): classes sampled
+        allocation (np.ndarray): samples of each class (columns) in each tile
+            (rows)
+
+    Returns:
+        list: map values, rows and columns of the samples of each tile, in
+            row-major order within each class
+    """
+    empty = np.array([], dtype=np.int64)
+    samples = []
+    for cand, alloc in zip(candidates, allocation):
+        strata, rows, cols = [empty], [empty], [empty]
+        for c, n in zip(classes, alloc):
+            if n == 0:
+                continue
+            row, col = cand[int(c)]
+            order = np.lexsort((col[:n], row[:n]))
+            strata.append(np.repeat(c, n).astype(np.int64))
+            rows.append(row[:n][order])
+            cols.append(col[:n][order])
+        samples.append((np.concatenate(strata), np.concatenate(rows),
+                        np.concatenate(cols)))
+    return samples
@@ -0,0 +1,260 @@
+""" Bulk reading and writing of OGR layers
+
+    Layers are read once into NumPy columns (FID, envelope, attributes and
+    WKB), through OGR's Arrow stream interface where GDAL provides it, so
+    stages don't walk tiles feature by feature.
+
+    Pixel footprints are computed for all samples at once with the raster's
+    affine geotransform and encoded straight to WKB with NumPy, instead of
+    adding ring vertices one at a time. Features are then created in large
+    transactions where the driver supports them.
+"""
+from __future__ import division
+
+import numpy as np
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+
+# Features written per transaction
+BATCH_SIZE = 100000
+
+# Corners of pixel in pixel coordinates
+_corners = np.array([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+
+# Little endian WKB polygon header, with the points of its first ring
+_wkb_header = np.dtype([('order', 'u1'),
+                        ('type', '<u4'),
+                        ('rings', '<u4'),
+                        ('points', '<u4')])
+
+# Little endian WKB polygon with one ring of five points
+_wkb_square = np.dtype(_wkb_header.descr +
+                       [('xy', '<f8', (_corners.size, ))])
+
+
+def _read_arrow(layer, fields, geometry):
+    """ Read FID, attribute and WKB columns through OGR's Arrow stream """
+    fid_name = layer.GetFIDColumn() or 'OGC_FID'
+    geom_name = layer.GetGeometryColumn() or 'wkb_geometry'
+
+    # Only fetch the columns asked for
+    defn = layer.GetLayerDefn()
+    ignored = [defn.GetFieldDefn(i).GetName()
+               for i in range(defn.GetFieldCount())
+               if defn.GetFieldDefn(i).GetName() not in fields]
+    if not geometry:
+        ignored.append('OGR_GEOMETRY')
+    layer.SetIgnoredFields(ignored)
+
+    batches = []
+    stream = layer.GetArrowStreamAsNumPy(options=['INCLUDE_FID=YES'])
+    for batch in stream:
+        batches.append(dict((key, batch[key]) for key in
+                            [fid_name] + fields +
+                            ([geom_name] if geometry else [])))
+    stream = None
+    layer.SetIgnoredFields([])
+
+    def column(key):
+        if not batches:
+            return np.array([])
+        values = np.concatenate([b[key] for b in batches])
+        if values.dtype.kind == 'O' and values.size and \
+                isinstance(values[0], bytes) and key != geom_name:
+            values = np.array([v.decode('utf-8') for v in values],
+                              dtype=object)
+        return values
+
+    columns = dict((name, column(name)) for name in fields)
+    columns['fid'] = column(fid_name).astype(np.int64)
+    if geometry:
+        columns['wkb'] = [bytes(w) if w is not None else None
+                          for w in column(geom_name)]
+    return columns
+
+
+def _read_features(layer, fields, geometry):
+    """ Read FID, attribute and WKB columns feature by feature """
+    defn = layer.GetLayerDefn()
+    index = [defn.GetFieldIndex(name) for name in fields]
+
+    fids, values, wkb = [], [[] for _ in fields], []
+    layer.ResetReading()
+    for feat in layer:
+        fids.append(feat.GetFID())
+        for v, i in zip(values, index):
+            v.append(feat.GetField(i))
+        if geometry:
+            geom = feat.GetGeometryRef()
+            wkb.append(bytes(geom.ExportToWkb()) if geom is not None
+                       else None)
+    layer.ResetReading()
+
+    columns = dict((name, np.array(v)) for name, v in zip(fields, values))
+    columns['fid'] = np.array(fids, dtype=np.int64)
+    if geometry:
+        columns['wkb'] = wkb
+    return columns
+
+
+def wkb_envelopes(wkb):
+    """ Return envelopes (xmin, xmax, ymin, ymax) of WKB geometries
+
+    Envelopes of little endian, single ring 2D polygons (such as tiles) are
+    reduced from their packed coordinates all at once, without building
+    geometries. Other geometries are parsed by OGR. Envelopes of missing
+    geometries are NaN.
+
+    Args:
+        wkb (list): WKB (bytes) of each geometry, or None
+
+    Returns:
+        np.ndarray: envelope of each geometry, one row each
+    """
+    envelopes = np.full((len(wkb), 4), np.nan)
+    sizes = np.array([len(w) if w is not None else 0 for w in wkb],
+                     dtype=np.int64)
+    buf = np.frombuffer(b''.join(w for w in wkb if w is not None),
+                        dtype=np.uint8)
+    starts = np.cumsum(sizes) - sizes
+
+    # Byte order, geometry type, rings and points of the first ring
+    size = _wkb_header.itemsize
+    header = np.zeros((sizes.size, size), dtype=np.uint8)
+    full = sizes >= size
+    header[full] = buf[starts[full, np.newaxis] + np.arange(size)]
+    header = header.view(_wkb_header).ravel()
+    simple = (full & (header['order'] == 1) &
+              (header['type'] == ogr.wkbPolygon) & (header['rings'] == 1) &
+              (header['points'] > 0) &
+              (sizes == size + 16 * header['points'].astype(np.int64)))
+
+    if simple.any():
+        # Gather the coordinates of all simple polygons into one array
+        first = starts[simple] + size
+        edges = np.zeros(buf.size + 1, dtype=np.int8)
+        edges[first] = 1
+        edges[starts[simple] + sizes[simple]] -= 1
+        xy = buf[np.cumsum(edges[:-1], dtype=np.int8) > 0].view('<f8')
+        xy = xy.reshape(-1, 2)
+        points = header['points'][simple].astype(np.int64)
+        offsets = np.cumsum(points) - points
+        envelopes[simple] = np.column_stack([
+            np.minimum.reduceat(xy[:, 0], offsets),
+            np.maximum.reduceat(xy[:, 0], offsets),
+            np.minimum.reduceat(xy[:, 1], offsets),
+            np.maximum.reduceat(xy[:, 1], offsets)])
+
+    for i in np.flatnonzero(~simple & (sizes > 0)):
+        envelopes[i] = ogr.CreateGeometryFromWkb(wkb[i]).GetEnvelope()
+    return envelopes
+
+
+def read_layer(layer, fields=None, geometry=True):
+    """ Read a whole layer into NumPy columns in one pass
+
+    Args:
+        layer (ogr.Layer): layer to read
+        fields (list, optional): attribute fields to read (all by default);
+            names are matched case insensitively, as by OGR
+        geometry (bool, optional): also read geometries and envelopes
+
+    Returns:
+        dict: `fid`, a column for each field (keyed as requested) and, with
+            `geometry`, `wkb` (list of WKB bytes) and envelope columns `xmin`,
+            `xmax`, `ymin` and `ymax` (NaN where geometry is missing), with
+            one row per feature in layer order
+    """
+    defn = layer.GetLayerDefn()
+    if fields is None:
+        fields = [defn.GetFieldDefn(i).GetName()
+                  for i in range(defn.GetFieldCount())]
+    names = []
+    for name in fields:
+        i = defn.GetFieldIndex(name)
+        if i < 0:
+            raise KeyError('Layer has no field {f}'.format(f=name))
+        names.append(defn.GetFieldDefn(i).GetName())
+
+    if hasattr(layer, 'GetArrowStreamAsNumPy'):
+        columns = _read_arrow(layer, names, geometry)
+    else:
+        columns = _read_features(layer, names, geometry)
+    for name, actual in zip(fields, names):
+        columns[name] = columns.pop(actual)
+
+    if geometry:
+        envelopes = wkb_envelopes(columns['wkb'])
+        for i, key in enumerate(['xmin', 'xmax', 'ymin', 'ymax']):
+            columns[key] = envelopes[:, i]
+    return columns
+
+
+def pixel_centers(cols, rows, gt):
+    """ Return map x and y of the centers of pixels at `cols`, `rows` """
+    cols = np.asarray(cols, dtype=np.float64) + 0.5
+    rows = np.asarray(rows, dtype=np.float64) + 0.5
+    return (gt[0] + cols * gt[1] + rows * gt[2],
+            gt[3] + cols * gt[4] + rows * gt[5])
+
+
+def pixel_polygons(cols, rows, gt):
+    """ Return WKB polygons of the footprints of pixels at `cols`, `rows`
+
+    Args:
+        cols (np.ndarray): pixel columns
+        rows (np.ndarray): pixel rows
+        gt (tuple): raster geotransform
+
+    Returns:
+        list: WKB (bytes) polygon for each pixel
+    """
+    cols = np.asarray(cols, dtype=np.float64)[:, np.newaxis] + _corners[:, 0]
+    rows = np.asarray(rows, dtype=np.float64)[:, np.newaxis] + _corners[:, 1]
+    x = gt[0] + cols * gt[1] + rows * gt[2]
+    y = gt[3] + cols * gt[4] + rows * gt[5]
+
+    wkb = np.empty(x.shape[0], dtype=_wkb_square)
+    wkb['order'] = 1
+    wkb['type'] = ogr.wkbPolygon
+    wkb['rings'] = 1
+    wkb['points'] = _corners.shape[0]
+    wkb['xy'] = np.dstack((x, y)).reshape(x.shape[0], _corners.size)
+
+    buf = wkb.tobytes()
+    size = _wkb_square.itemsize
+    return [buf[i:i + size] for i in range(0, len(buf), size)]
+
+
+def write_features(layer, fields, geometries, batch_size=BATCH_SIZE):
+    """ Create a feature for each geometry, committing in large batches
+
+    Args:
+        layer (ogr.Layer): output layer, with `fields` already created
+        fields (list): (name, values) for each field, values holding one
+            value per feature
+        geometries (list): WKB geometry of each feature
+        batch_size (int, optional): features written per transaction
+    """
+    defn = layer.GetLayerDefn()
+    index = [defn.GetFieldIndex(name) for name, _ in fields]
+    # Native Python values are much faster to set than NumPy scalars
+    values = [np.asarray(v).tolist() for _, v in fields]
+
+    transactions = layer.TestCapability(ogr.OLCTransactions)
+    for start in range(0, len(geometries), batch_size):
+        if transactions:
+            layer.StartTransaction()
+
+        for i in range(start, min(start + batch_size, len(geometries))):
+            feature = ogr.Feature(defn)
+            for j, v in zip(index, values):
+                feature.SetField(j, v[i])
+            feature.SetGeometryDirectly(
+                ogr.CreateGeometryFromWkb(geometries[i]))
+            layer.CreateFeature(feature)
+
+        if transactions:
+            layer.CommitTransaction()
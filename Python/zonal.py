@@ -0,0 +1,331 @@
+""" Zonal class counts of raster maps within vector tiles
+
+    Rather than rasterizing the tile layer once per tile, the FID of every
+    tile is composed from the cached tile index into a label raster on the
+    map's grid, one block at a time, and pixels of each class within each
+    tile are counted with a single 2-D `np.bincount` over (label, class) per
+    block. The whole layer is processed in one streaming pass over the map.
+
+    Ranges of blocks can be counted independently, in separate processes.
+    Every block is read by exactly one of them and the counts of all ranges
+    add up, so results don't depend on how the work is split.
+"""
+from __future__ import division
+
+import multiprocessing
+
+import numpy as np
+
+from blocks import block_windows
+from checkpoint import (CHECKPOINT_BLOCKS, block_digests, load_checkpoint,
+                        load_parts, merge_digests, record_counts,
+                        record_digests, refresh_checkpoint, save_checkpoint,
+                        save_part, start_run)
+from raster_io import open_dataset
+from tile_index import (grid_key, label_block, load_tile_index, raster_key,
+                        tile_index_filename, window_pairs)
+
+# Block ranges handed to each worker process, to balance uneven blocks
+CHUNKS_PER_JOB = 4
+
+
+def _tile_blocks(index, rows, band):
+    """ Return block windows of `band` overlapping the tiles in `rows` """
+    windows = np.array(list(block_windows(band)), dtype=np.int64)
+    tiles = np.column_stack([index[name][rows] for name in
+                             ['xoff', 'yoff', 'xcount', 'ycount']])
+    _, hit = window_pairs(tiles, windows.reshape(-1, 4))
+    return windows[np.unique(hit)]
+
+
+def _count_grid(index, rows, rasters, classes, counts, part=None,
+                digests=None):
+    """ Accumulate tile class counts of rasters sharing one pixel grid """
+    bands = [r.GetRasterBand(1) for r in rasters]
+    if digests is None:
+        digests = [None] * len(bands)
+
+    # Only blocks overlapping the tiles being counted need reading
+    windows = _tile_blocks(index, rows, bands[0])
+    if part is not None:
+        windows = np.array_split(windows, part[1])[part[0]]
+
+    for xoff, yoff, xcount, ycount in windows.tolist():
+        # Compose labels of tiles touching the block from their masks
+        label = label_block(index, xoff, yoff, xcount, ycount)
+        inside = label > 0
+        if not inside.any():
+            continue
+        tiles, tile_index = np.unique(label[inside], return_inverse=True)
+
+        # 2-D bincount over (label, class) of pixels within tiles, reading
+        # each raster's block once
+        for band, cls, cnt, dig in zip(bands, classes, counts, digests):
+            block = band.ReadAsArray(xoff, yoff, xcount, ycount)
+            if dig is not None:
+                dig.append(block_digests(block, xoff, yoff, band))
+            values = block[inside]
+            n_classes = cls.size
+            cnt[tiles - 1] += np.bincount(
+                tile_index * n_classes + np.searchsorted(cls, values),
+                minlength=tiles.size * n_classes).reshape(tiles.size,
+                                                          n_classes)
+
+
+def tile_histograms(layer_fn, rasters, classes, fids=None, part=None,
+                    digests=None):
+    """ Count pixels of each class of each raster within every tile
+
+    Tile windows and masks come from the tile index of each raster grid
+    (built once and cached), and each block of each raster is read once, so
+    statistics for any number of aligned maps come from a single pass.
+
+    Args:
+        layer_fn (str): tile vector filename
+        rasters (list): categorical maps (gdal.Dataset)
+        classes (list): sorted values of all classes (np.ndarray) in each map
+        fids (tuple or np.ndarray, optional): count only tiles with FIDs in
+            [start, stop), or only the FIDs listed
+        part (tuple, optional): count only part `i` of `n` ranges of the
+            blocks, as (i, n); counts of all `n` parts add up to the counts
+            of the whole map
+        digests (list, optional): one list for each raster, to which the
+            windows and CRC32 digests of its native blocks are appended as
+            they are read (see `checkpoint.block_digests`)
+
+    Returns:
+        list: pixel counts for each raster (np.ndarray), with one row per FID
+            (per FID in `fids` if given) and one column per class
+    """
+
+    # Group rasters sharing a pixel grid so they share tile labels
+    grids = []
+    for i, raster in enumerate(rasters):
+        grid = tile_index_filename(layer_fn, raster)
+        for g, members in grids:
+            if g == grid:
+                members.append(i)
+                break
+        else:
+            grids.append((grid, [i]))
+
+    indexes = [load_tile_index(layer_fn, rasters[members[0]])
+               for _, members in grids]
+    fid = indexes[0]['fid']
+    n_rows = int(fid.max()) + 1 if fid.size else 0
+    if fids is None:
+        fids = np.arange(n_rows)
+    elif isinstance(fids, tuple):
+        fids = np.arange(fids[0], min(fids[1], n_rows))
+    else:
+        fids = np.asarray(fids, dtype=np.int64)
+    counts = [np.zeros((n_rows, cls.size), dtype=np.int64) for cls in classes]
+
+    for index, (_, members) in zip(indexes, grids):
+        # Tiles being counted, skipping those outside the grid
+        rows = np.flatnonzero(np.in1d(index['fid'], fids) &
+                              (index['xcount'] > 0) & (index['ycount'] > 0))
+        if rows.size == 0:
+            continue
+        _count_grid(index, rows,
+                    [rasters[i] for i in members],
+                    [classes[i] for i in members],
+                    [counts[i] for i in members], part,
+                    None if digests is None else [digests[i] for i in members])
+
+    return [c[fids] for c in counts]
+
+
+def block_class_counts(label, values):
+    """ Return FID, class and pixel count of each class within each tile in
+    a block
+
+    Args:
+        label (np.ndarray): FID + 1 of the tile covering each pixel (0 if
+            none), from `label_block`
+        values (np.ndarray): map values of the block
+    """
+    inside = label > 0
+    tiles, tile_index = np.unique(label[inside], return_inverse=True)
+    values = values[inside].astype(np.int64)
+    if values.size == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+
+    low = int(values.min())
+    span = int(values.max()) - low + 1
+    codes = tile_index * span + (values - low)
+    if tiles.size * span <= 4 * codes.size:
+        counts = np.bincount(codes, minlength=tiles.size * span)
+        codes = np.flatnonzero(counts)
+        counts = counts[codes]
+    else:
+        codes, counts = np.unique(codes, return_counts=True)
+    return tiles[codes // span] - 1, codes % span + low, counts
+
+
+def merge_class_counts(parts, n_rows):
+    """ Return sorted classes and pixel counts of each class within each tile
+    (one row per FID) from the counts of blocks (`block_class_counts`) """
+    empty = np.array([], dtype=np.int64)
+    fid, values, n = [np.concatenate([p[i] for p in parts] + [empty])
+                      for i in range(3)]
+    classes, col = np.unique(values, return_inverse=True)
+    counts = np.zeros((n_rows, classes.size), dtype=np.int64)
+    np.add.at(counts, (fid, col.ravel()), n)
+    return classes, counts
+
+
+def _tile_histograms_worker(job):
+    """ Count tile class counts over a range of blocks with its own handles,
+    and digest the blocks read if asked to """
+    layer_fn, raster_fns, classes, fids, part, digest = job
+
+    rasters = [open_dataset(fn) for fn in raster_fns]
+    digests = [[] for _ in raster_fns] if digest else None
+    counts = tile_histograms(layer_fn, rasters, classes, fids, part,
+                             digests)
+    if digests is not None:
+        digests = [merge_digests(d) for d in digests]
+
+    rasters = None
+    return counts, digests
+
+
+def tile_histograms_pool(layer_fn, raster_fns, classes, jobs=1,
+                         checkpoint=None):
+    """ Count tile class counts in ranges of blocks, over `jobs` processes
+
+    Each worker opens its own raster handles and returns the counts of every
+    tile within its range of blocks, which are summed. Results are identical
+    to `tile_histograms`.
+
+    With a `checkpoint` directory, counts of each range, and digests of the
+    blocks it read, are appended to it as the range finishes. Tiles already
+    counted by an earlier run, and ranges finished by an interrupted run, are
+    reused unless tiles or the raster blocks they touch have changed (see
+    `checkpoint.refresh_checkpoint`).
+
+    Args:
+        layer_fn (str): tile vector filename
+        raster_fns (list): categorical map filenames
+        classes (list): sorted values of all classes (np.ndarray) in each map
+        jobs (int, optional): number of worker processes
+        checkpoint (str, optional): checkpoint directory
+
+    Returns:
+        list: pixel counts for each raster (np.ndarray), with one row per FID
+            and one column per class
+    """
+    # Build any missing tile index up front so workers only read it
+    rasters = [open_dataset(fn) for fn in raster_fns]
+    fid = [load_tile_index(layer_fn, r) for r in rasters][0]['fid']
+    n_rows = int(fid.max()) + 1 if fid.size else 0
+
+    state = None
+    todo = fid
+    n_parts = jobs * CHUNKS_PER_JOB
+    if checkpoint:
+        state = refresh_checkpoint(load_checkpoint(checkpoint), layer_fn,
+                                   rasters, classes)
+        todo = state['fid'][~state['done']]
+        n_blocks = sum(1 for _ in block_windows(rasters[0].GetRasterBand(1)))
+        n_parts = max(n_parts, -(-n_blocks // CHECKPOINT_BLOCKS))
+    rasters = None
+    parts = list(range(n_parts)) if todo.size else []
+
+    saved = {}
+    if state is not None:
+        start_run(state, todo, n_parts)
+        save_checkpoint(checkpoint, state)
+        saved = load_parts(checkpoint, state)
+    work = [(layer_fn, raster_fns, classes, todo, (i, n_parts),
+             state is not None) for i in parts if i not in saved]
+
+    counts = [np.zeros((n_rows, cls.size), dtype=np.int64) for cls in classes]
+    digests = []
+    for i in saved:
+        for cnt, res in zip(counts, saved[i][1]):
+            cnt[todo] += res
+        digests.append(saved[i][2])
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(work) > 1 else None
+    try:
+        results = (pool.imap(_tile_histograms_worker, work) if pool else
+                   (_tile_histograms_worker(job) for job in work))
+        for job, (result, digest) in zip(work, results):
+            if state is not None:
+                save_part(checkpoint, state, job[-2][0], todo, result,
+                          digest)
+                digests.append(digest)
+            for cnt, res in zip(counts, result):
+                cnt[todo] += res
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if state is not None:
+        record_counts(state, todo, [cnt[todo] for cnt in counts])
+        record_digests(state, digests)
+        state['run'] = np.array('', dtype='S12')
+        save_checkpoint(checkpoint, state)
+        for k, cnt in enumerate(counts):
+            cnt[state['fid']] = state['counts_%d' % k]
+    return counts
+
+
+def tile_counts_filename(output):
+    """ Return filename of the tile class count table of a stage-1 output """
+    return output + '.counts.npz'
+
+
+def tile_counts_table(tiles, classes, counts, overlap=None, raster=None):
+    """ Return a tile class count table, as saved by `write_tile_counts` """
+    tiles = np.asarray(tiles, dtype=np.int64)
+    order = np.argsort(tiles, kind='mergesort')
+    if overlap is None:
+        overlap = np.zeros(tiles.size, dtype=np.int64)
+    shape = ((raster.RasterYSize, raster.RasterXSize) if raster is not None
+             else (0, 0))
+    return {'tiles': tiles[order],
+            'classes': classes,
+            'counts': np.asarray(counts, dtype=np.int64).reshape(
+                tiles.size, classes.size)[order],
+            'overlap': np.asarray(overlap, dtype=np.int64)[order],
+            'grid': grid_key(raster) if raster is not None else '',
+            'map': raster_key(raster) if raster is not None else '',
+            'shape': np.array(shape, dtype=np.int64)}
+
+
+def write_tile_counts(filename, tiles, classes, counts, overlap=None,
+                      raster=None):
+    """ Save pixel counts of each class within each tile
+
+    Where tiles overlap, pixels are counted in the tile with the larger FID.
+    Counts are the populations of tiles sampled in stage 4 only if no other
+    tile covers their pixels, so the pixels of each tile lost to overlapping
+    tiles are saved with them.
+
+    Args:
+        filename (str): output `.npz` filename
+        tiles (np.ndarray): sample ID of each tile
+        classes (np.ndarray): sorted values of all classes in the map
+        counts (np.ndarray): pixel counts, one row per tile and one column
+            per class
+        overlap (np.ndarray, optional): pixels of each tile counted in an
+            overlapping tile instead
+        raster (gdal.Dataset, optional): map counted, whose grid, shape and
+            file identity are saved to check the map sampled against
+    """
+    np.savez(filename, **tile_counts_table(tiles, classes, counts, overlap,
+                                           raster))
+
+
+def read_tile_counts(filename):
+    """ Return a tile class count table: tiles (sorted sample IDs), classes,
+    counts and overlap of each tile, and the `grid`, `shape` and identity
+    (`map`) of the map counted """
+    saved = np.load(filename)
+    table = dict((key, saved[key]) for key in saved.files)
+    table['grid'], table['map'] = str(table['grid']), str(table['map'])
+    return table
@@ -56,11 +56,19 @@ def create_strata(changemap, lcmap, ndv, output, forest, nonforest, inforest, lc
 
     out_ar = np.zeros((lc_0, lc_1), dtype=np.byte)
 
+    #Size GDAL's block cache for reading the maps once through, unless it
+    #is configured already
+    if gdal.GetConfigOption('GDAL_CACHEMAX') is None:
+        gdal.SetCacheMax(512 * 1024 * 1024)
+
     #Create some dummy variables for logging
     percent = 0
     progress.setPercentage(percent)
     percent += 10
-    block = 100
+
+    #Read rows in windows of whole native blocks (about 4M pixels)
+    block_y = max(1, cm_band.GetBlockSize()[1])
+    block = max(block_y, (2 ** 22 // max(cm_1, 1)) // block_y * block_y)
     itera = 0
     for i in range(0,lc_0,block):
         if (i + block) < lc_0:
@@ -14,7 +14,20 @@ Options:
     --rformat <format>          Raster file format [default: GTiff]
     --vector <filename>         Vector filename [default: sample.shp]
     --vformat <format>          Vector file format [default: ESRI Shapefile]
+    --table <filename>          Sample table filename; format from extension
+                                    (.arrow, .parquet or .csv) [default: None]
     --seed_val <seed_value>     Initial RNG seed value [default: None]
+    --blocks                    Read map block by block instead of all at once
+    --jobs <n>                  Worker processes for block by block simple
+                                    random sampling; more than 1 implies
+                                    --blocks [default: 1]
+    --users_accuracy <values>   Expected user's accuracy of each class, or of
+                                    all classes, for "--size variance"
+                                    [default: 0.8]
+    --se <se>                   Target standard error of overall accuracy for
+                                    "--size variance" [default: 0.01]
+    --plan                      Print sample size and allocation, then exit
+                                    without sampling
     -v --verbose                Show verbose debugging messages
     -h --help                   Show help
 
@@ -24,7 +37,8 @@ Sample size (--size) "<n>" options:
 
 Allocation (--allocation) "<allocation>" options:
     proportional                Allocation proportional to area
-    good_practices              "Good Practices" allocation
+    good_practices              "Good Practices" allocation: proportional, but
+                                    with at least 50 samples per class
     equal                       Equal allocation across classes
     <specified>                 Comma or space separated list of integers
 
@@ -41,6 +55,7 @@ Example:
 """
 from __future__ import print_function, division
 import logging
+import multiprocessing
 import os
 import sys
 
@@ -55,10 +70,32 @@ except:
     import ogr
     import osr
 
+# Shared raster helpers live next to the stage scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'Python'))
+from blocks import BLOCK_PIXELS, block_windows
+from histogram import array_histogram, cached_histogram, raster_histogram
+from sampling import sample_ranks
+from table_io import write_table
+from vector_io import pixel_centers, pixel_polygons, write_features
+
 __version__ = '0.1.0'
 
 _allocation_methods = ['proportional', 'equal', 'good_practices']
 
+# Minimum class sample size for "good practices" allocation (Olofsson et al.
+# 2014 recommend 50-100 samples for rare classes)
+_good_practices_min = 50
+
+# Creation options for sample rasters written as sparse, tiled blocks
+_sparse_options = {
+    'GTiff': ['TILED=YES', 'COMPRESS=DEFLATE', 'SPARSE_OK=TRUE']
+}
+
+# Grid density margin over class sample counts when thinning a systematic
+# sample by strata, so each class is likely to get enough grid points
+_systematic_oversample = 1.25
+
 VERBOSE = False
 
 gdal.UseExceptions()
@@ -87,6 +124,11 @@ def random_stratified(image, classes, counts):
     Return pixel strata, row, column from within image from a random stratified
     sample of classes specified
 
+    Pixel indices are grouped by class with a counting sort: class counts give
+    each class its slice of one index array, which is filled chunk by chunk,
+    so the image is scanned once regardless of the number of classes and the
+    index takes 4 bytes per sampled-class pixel (int32 where it fits).
+
     Args:
         image (ndarray)         input map image
         classes (ndarray)       map image classes to be sampled
@@ -95,41 +137,149 @@ def random_stratified(image, classes, counts):
     Return:
         (strata, col, row)      tuple of ndarrays
     """
-    # Initialize outputs
-    strata = np.array([])
-    rows = np.array([])
-    cols = np.array([])
-
     logger.debug('Performing sampling')
 
-    for c, n in zip(classes, counts):
+    flat = image.ravel()
+    classes = np.asarray(classes)
+    sorter = np.argsort(classes)
+    k = classes.size
+
+    # Slice of the index array holding the pixels of each class
+    class_px = _class_counts(image, classes)
+    ends = np.cumsum(class_px)
+    bounds = ends - class_px
+    dtype = np.int32 if flat.size < 2 ** 31 else np.int64
+    order = np.empty(int(ends[-1]) if k else 0, dtype=dtype)
+
+    # Counting sort of pixel indices by class, one chunk of pixels at a time
+    fill = bounds.copy()
+    for start in range(0, flat.size if k else 0, BLOCK_PIXELS):
+        values = flat[start:start + BLOCK_PIXELS]
+        code = np.searchsorted(classes, values, sorter=sorter)
+        code = sorter[np.minimum(code, k - 1)]
+        pos = np.flatnonzero(classes[code] == values)
+        code = code[pos]
+
+        chunk = np.argsort(code, kind='mergesort')
+        code = code[chunk]
+        n_code = np.bincount(code, minlength=k)
+        rank = np.arange(code.size) - (np.cumsum(n_code) - n_code)[code]
+        order[fill[code] + rank] = pos[chunk] + start
+        fill += n_code
+
+    strata = [np.array([], dtype=classes.dtype)]
+    index = [np.array([], dtype=order.dtype)]
+    for c, n, lo, hi in zip(classes, counts, bounds, ends):
         logger.debug('Sampling class {c}'.format(c=c))
 
-        # Find pixels containing class c
-        row, col = np.where(image == c)
-
         # Check for sample size > population size
-        if n > col.size:
+        if n > hi - lo:
             logger.warning(
                 'Class {0} sample size larger than population'.format(c))
             logger.warning('Reducing sample count to size of population')
 
-            n = col.size
+            n = hi - lo
 
-        # Randomly sample x / y without replacement
-        # NOTE: np.random.choice new to 1.7.0...
-        # TODO: check requirement and provide replacement
-        samples = np.random.choice(col.size, n, replace=False)
+        # Randomly sample pixels of class c without replacement
+        samples = order[lo + sample_ranks(hi - lo, n)]
 
         logger.debug('    collected samples')
 
-        strata = np.append(strata, np.repeat(c, n))
-        rows = np.append(rows, row[samples])
-        cols = np.append(cols, col[samples])
+        strata.append(np.repeat(c, n))
+        index.append(samples)
+
+    strata = np.concatenate(strata)
+    rows, cols = np.unravel_index(np.concatenate(index), image.shape)
 
     return (strata, cols, rows)
 
 
+def _class_counts(image, classes):
+    """ Return pixel count of each of `classes` within `image` """
+    values, px = array_histogram(image)
+    counts = np.zeros(classes.size, dtype=np.int64)
+    found = np.in1d(values, classes)
+    sorter = np.argsort(classes)
+    counts[sorter[np.searchsorted(classes, values[found], sorter=sorter)]] = \
+        px[found]
+    return counts
+
+
+def random_stratified_blocks(band, classes, counts):
+    """
+    Return pixel strata, row, column from a random stratified sample of classes
+    specified, reading the map block by block rather than all at once
+
+    The first pass counts the pixels of each class within every block. Class
+    sample counts are then turned into sorted target ranks within each class
+    and mapped onto blocks, and the second pass reads only the blocks holding
+    targets to pick out those pixels. Memory scales with block and sample
+    size, not map size.
+
+    Args:
+        band (gdal.Band)        input map band
+        classes (ndarray)       map image classes to be sampled (sorted)
+        counts (ndarray)        map image class sample counts
+
+    Return:
+        (strata, col, row)      tuple of ndarrays
+    """
+    logger.debug('Counting class pixels by block')
+    windows = list(block_windows(band))
+    block_counts = np.zeros((len(windows), classes.size), dtype=np.int64)
+    for i, (xoff, yoff, xcount, ycount) in enumerate(windows):
+        block_counts[i] = _class_counts(
+            band.ReadAsArray(xoff, yoff, xcount, ycount), classes)
+
+    logger.debug('Performing sampling')
+
+    # Map each class's sample ranks onto (block, rank within block)
+    targets = {}
+    for k, (c, n) in enumerate(zip(classes, counts)):
+        logger.debug('Sampling class {c}'.format(c=c))
+
+        population = block_counts[:, k].sum()
+        if n > population:
+            logger.warning(
+                'Class {0} sample size larger than population'.format(c))
+            logger.warning('Reducing sample count to size of population')
+
+            n = population
+
+        ranks = sample_ranks(population, n)
+        cum = np.cumsum(block_counts[:, k])
+        blocks = np.searchsorted(cum, ranks, side='right')
+        local = ranks - (cum - block_counts[:, k])[blocks]
+
+        hit, starts = np.unique(blocks, return_index=True)
+        for b, block_ranks in zip(hit, np.split(local, starts[1:])):
+            targets.setdefault(b, []).append((c, block_ranks))
+
+    # Read only blocks containing samples and pick out the target pixels
+    strata, rows, cols = [], [], []
+    for b in sorted(targets):
+        xoff, yoff, xcount, ycount = windows[b]
+        flat = band.ReadAsArray(xoff, yoff, xcount, ycount).ravel()
+        for c, block_ranks in targets[b]:
+            index = np.flatnonzero(flat == c)[block_ranks]
+            strata.append(np.repeat(c, index.size))
+            rows.append(yoff + index // xcount)
+            cols.append(xoff + index % xcount)
+    logger.debug('    collected samples')
+
+    if not strata:
+        return (np.array([], dtype=classes.dtype),
+                np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+    # Keep output grouped by strata, as with in-memory sampling
+    strata = np.concatenate(strata)
+    by_strata = np.argsort(strata, kind='mergesort')
+
+    return (strata[by_strata],
+            np.concatenate(cols)[by_strata],
+            np.concatenate(rows)[by_strata])
+
+
 def random_simple(image, classes, count):
     """
     Return pixel strata, row, column from within image from a simple random
@@ -174,45 +324,342 @@ def random_simple(image, classes, count):
     return (np.ones(count), cols[sample], rows[sample])
 
 
-def random_systematic(image, classes, counts):
-    """ """
-    raise NotImplementedError(
-        "Sorry - haven't added Systematic Sampling")
+def _reservoir_worker(job):
+    """
+    Keep the `count` eligible pixels with the smallest random keys across a
+    range of blocks of a raster. Every block draws its keys from its own seed,
+    so the result doesn't depend on how blocks are split between workers.
+
+    Args:
+        job (tuple)             raster filename, band number, list of windows,
+                                seed for each window, classes, count
+
+    Return:
+        (keys, col, row, n)     reservoir keys and pixel locations, and the
+                                number of eligible pixels seen
+    """
+    path, band_num, windows, seeds, classes, count = job
 
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    band = ds.GetRasterBand(band_num)
 
-def sample(image, method,
-           size=None, allocation=None,
-           mask=None, order=False):
+    keys = np.array([], dtype=np.float64)
+    rows = np.array([], dtype=np.int64)
+    cols = np.array([], dtype=np.int64)
+    seen = 0
+    for (xoff, yoff, xcount, ycount), seed in zip(windows, seeds):
+        flat = band.ReadAsArray(xoff, yoff, xcount, ycount).ravel()
+        index = np.flatnonzero(np.in1d(flat, classes))
+        seen += index.size
+
+        keys = np.concatenate((
+            keys, np.random.RandomState(seed).random_sample(index.size)))
+        rows = np.concatenate((rows, yoff + index // xcount))
+        cols = np.concatenate((cols, xoff + index % xcount))
+
+        # Trim reservoir back to the `count` smallest keys
+        if keys.size > count:
+            keep = np.argpartition(keys, count - 1)[:count]
+            keys, rows, cols = keys[keep], rows[keep], cols[keep]
+
+    ds = None
+    return keys, cols, rows, seen
+
+
+def random_simple_blocks(band, classes, count, jobs=1):
     """
-    Make sampling decisions and perform sampling
+    Return pixel strata, row, column from a simple random sample of classes
+    specified, reading the map block by block across `jobs` processes
+
+    Every eligible pixel gets a uniform random key and each worker keeps the
+    `count` smallest keys it sees over its range of blocks. The `count`
+    smallest keys of the merged reservoirs are an exactly uniform sample
+    without replacement, and memory scales with sample size, not map size.
+    The strata returned will be all equal to 1.
+
+    Args:
+        band (gdal.Band)        input map band
+        classes (ndarray)       map image classes to be sampled
+        count (int)             sample count
+        jobs (int)              number of worker processes
+
+    Return:
+        (strata, col, row)      tuple of ndarrays
+    """
+    if isinstance(count, np.ndarray):
+        count = int(count.ravel()[0])
+
+    logger.debug('Performing sampling')
+
+    windows = list(block_windows(band))
+    seeds = np.random.randint(0, 2 ** 31 - 1, size=len(windows))
+    path = band.GetDataset().GetDescription()
+
+    ranges = np.array_split(np.arange(len(windows)), min(jobs, len(windows)))
+    work = [(path, band.GetBand(), [windows[i] for i in r], seeds[r],
+             classes, count) for r in ranges]
+
+    if jobs > 1:
+        logger.debug('Sampling blocks with {n} processes'.format(n=jobs))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_reservoir_worker, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_reservoir_worker(w) for w in work]
+
+    keys = np.concatenate([r[0] for r in results])
+    cols = np.concatenate([r[1] for r in results])
+    rows = np.concatenate([r[2] for r in results])
+    seen = sum(r[3] for r in results)
+
+    if count > seen:
+        logger.error('Sample size greater than population of all classes \
+            included')
+        logger.error('Sample count: {n}'.format(n=count))
+        logger.error('Population size: {n}'.format(n=seen))
+        sys.exit(1)
+
+    sample = np.argsort(keys)[:count]
+    logger.debug('    collected samples')
+
+    return (np.ones(count), cols[sample], rows[sample])
+
+
+def _read_grid(image, rows, cols):
+    """ Return values of `image` at the grid of `rows` x `cols`
+
+    When `image` is a raster band only the grid rows are read from disk.
+    """
+    if isinstance(image, np.ndarray):
+        return image[np.ix_(rows, cols)]
+
+    values = np.empty((rows.size, cols.size),
+                      dtype=image.ReadAsArray(0, 0, 1, 1).dtype)
+    for i, row in enumerate(rows):
+        values[i] = image.ReadAsArray(0, int(row), image.XSize, 1)[0, cols]
+    return values
+
+
+def random_systematic(image, classes, counts, class_px):
+    """
+    Return pixel strata, row, column from within image from a systematic
+    sample of classes specified
+
+    Samples are taken on a square grid with a random start. If `counts` is a
+    single number the grid spacing is chosen so about that many grid points
+    fall on the classes sampled, and the strata returned will be all equal to
+    1. If `counts` is an array of counts for each class (even of a single
+    class), the grid is made dense enough
+    for every class and then randomly thinned within each class down to its
+    count (strata-aware thinning). Only rows hit by the grid are read. An
+    empty sample is returned when no samples are asked for.
+
+    Args:
+        image (ndarray or gdal.Band)    input map image or band
+        classes (ndarray)               map image classes to be sampled
+        counts (int or ndarray)         total sample count, or sample count
+                                        for each class
+        class_px (ndarray)              pixel count of each class
+
+    Return:
+        (strata, col, row)      tuple of ndarrays
+    """
+    if isinstance(image, np.ndarray):
+        ysize, xsize = image.shape
+    else:
+        ysize, xsize = image.YSize, image.XSize
+
+    empty = (np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+             np.array([], dtype=np.int64))
+    thin = isinstance(counts, np.ndarray)
+    if thin:
+        has_sample = counts > 0
+        if not has_sample.any():
+            logger.warning('No samples allocated to any class')
+            return empty
+        spacing = np.sqrt(np.min(
+            class_px[has_sample] /
+            (counts[has_sample] * _systematic_oversample)))
+    else:
+        if counts <= 0:
+            logger.warning('Sample size is 0')
+            return empty
+        spacing = np.sqrt(class_px.sum() / float(counts))
+    spacing = max(spacing, 1.0)
+    logger.debug('Grid spacing is {d} pixels'.format(d=spacing))
+
+    # Random start within the first grid cell
+    x0, y0 = np.random.uniform(0, spacing, size=2)
+    cols = np.floor(np.arange(x0, xsize, spacing)).astype(np.int64)
+    rows = np.floor(np.arange(y0, ysize, spacing)).astype(np.int64)
+
+    logger.debug('Performing sampling')
+    values = _read_grid(image, rows, cols)
+    rows, cols = np.meshgrid(rows, cols, indexing='ij')
+    keep = np.in1d(values, classes).reshape(values.shape)
+    strata, rows, cols = values[keep], rows[keep], cols[keep]
+
+    if not thin:
+        logger.debug('    collected {n} samples'.format(n=strata.size))
+        return (np.ones(strata.size), cols, rows)
+
+    # Thin grid points in each class down to the class sample count
+    index = []
+    for c, n in zip(classes, counts):
+        in_class = np.flatnonzero(strata == c)
+        if n > in_class.size:
+            logger.warning(
+                'Class {0} has fewer grid points than its sample size'.format(
+                    c))
+            logger.warning('Reducing sample count to number of grid points')
+
+            n = in_class.size
+        index.append(in_class[sample_ranks(in_class.size, n)])
+    index = np.concatenate(index)
+    logger.debug('    collected samples')
+
+    return (strata[index], cols[index], rows[index])
+
+
+def _round_allocation(exact, size):
+    """ Round exact class sample sizes to integers summing to `size`
+
+    Uses the largest remainder method.
+    """
+    counts = np.floor(exact).astype(np.int64)
+    short = int(size - counts.sum())
+    if short > 0:
+        counts[np.argsort(counts - exact, kind='mergesort')[:short]] += 1
+    return counts
+
+
+def allocate(method, size, class_px):
+    """
+    Allocate a total sample size among classes
 
     Args:
-      image (np.ndarray): 1 dimensional array of the image
+      method (str): Allocation method ('proportional', 'equal', or
+        'good_practices')
+      size (int): Total sample size
+      class_px (np.ndarray): Pixel count of each class
+
+    Returns:
+      np.ndarray: sample count of each class
+
+    """
+    class_px = np.asarray(class_px, dtype=np.float64)
+    n_classes = class_px.size
+
+    if method == 'proportional':
+        return _round_allocation(size * class_px / class_px.sum(), size)
+    elif method == 'equal':
+        return _round_allocation(np.repeat(size / n_classes, n_classes), size)
+    elif method == 'good_practices':
+        # Proportional allocation, but raise small classes to the minimum and
+        # share what's left proportionally among the other classes
+        minimum = min(_good_practices_min, size // n_classes)
+        fixed = np.zeros(n_classes, dtype=bool)
+        while True:
+            counts = np.repeat(minimum, n_classes)
+            rest = ~fixed
+            counts[rest] = _round_allocation(
+                (size - minimum * fixed.sum()) *
+                class_px[rest] / class_px[rest].sum(),
+                size - minimum * fixed.sum())
+            small = rest & (counts < minimum)
+            if not small.any():
+                return counts
+            fixed |= small
+    else:
+        raise ValueError('Unknown allocation method {m}'.format(m=method))
+
+
+def variance_sample_size(class_px, users_accuracy, target_se):
+    """
+    Estimate the sample size needed for a target standard error of overall
+    accuracy under stratified random sampling (Cochran, 1977, eq. 5.25;
+    Olofsson et al., 2014, eq. 13):
+
+    n = ( Sum W_i S_i )^2 / [ S(O)^2 + (1 / N) Sum W_i S_i^2 ]
+
+    Where:
+    W_i = proportion of area mapped as class i
+    S_i = sqrt(U_i * (1 - U_i)), with U_i the expected user's accuracy
+    S(O) = target standard error of overall accuracy
+    N = total number of pixels
+
+    Args:
+      class_px (np.ndarray): Pixel count of each class
+      users_accuracy (float or np.ndarray): Expected user's accuracy of all
+        classes, or of each class
+      target_se (float): Target standard error of overall accuracy
+
+    Returns:
+      int: total sample size
+
+    """
+    class_px = np.asarray(class_px, dtype=np.float64)
+    total = class_px.sum()
+    weights = class_px / total
+    users_accuracy = np.asarray(users_accuracy, dtype=np.float64)
+    sd = np.sqrt(users_accuracy * (1 - users_accuracy))
+
+    n = ((weights * sd).sum() ** 2 /
+         (target_se ** 2 + (weights * sd ** 2).sum() / total))
+    return int(np.ceil(n))
+
+
+def design_sample(histogram, method,
+                  size=None, allocation=None, mask=None,
+                  users_accuracy=0.8, target_se=0.01):
+    """
+    Determine sample size and class sample counts from a class histogram
+
+    Args:
+      histogram (tuple): Sorted classes and pixel counts of the map
       method (str): Sampling method
-      size (int, optional): Total sample size
+      size (int or str, optional): Total sample size, or 'variance' to estimate
+        it from `users_accuracy` and `target_se`
       allocation (str, or list/np.ndarray): Allocation strategy specified as a
         string, or user specified allocation as list or np.ndarray
-      mask (list or np.ndarray, optional): Values to exclude from `image`
-      order (bool, optional): Order the output by strata, or not
+      mask (list or np.ndarray, optional): Values to exclude from the map
+      users_accuracy (float or np.ndarray, optional): Expected user's accuracy
+        of all, or each, unmasked class for variance based sample size
+      target_se (float, optional): Target standard error of overall accuracy
+        for variance based sample size
 
     Returns:
-        output (tuple): strata, row numbers, and column numbers
+        output (tuple): classes, class pixel counts, and sample count (int) or
+          sample counts per class (np.ndarray)
 
     """
-    # Find map classes within image
-    classes = np.sort(np.unique(image))
+    classes, class_px = histogram
+    total_px = class_px.sum()
 
     # Exclude masked values
-    classes = classes[~np.in1d(classes, mask)]
+    keep = ~np.in1d(classes, mask)
+    classes, class_px = classes[keep], class_px[keep]
 
     logger.debug('Found {n} classes'.format(n=classes.size))
-    for c in classes:
-        px = np.sum(image == c)
+    for c, px in zip(classes, class_px):
         logger.debug(
             '    class {c} - {pix}px ({pct}%)'.format(
                 c=c,
                 pix=px,
-                pct=np.round(float(px) / image.size * 100.0, decimals=2)))
+                pct=np.round(float(px) / total_px * 100.0, decimals=2)))
+
+    # Estimate sample size from target precision of overall accuracy
+    if size == 'variance':
+        if np.ndim(users_accuracy) and np.size(users_accuracy) != classes.size:
+            raise ValueError(
+                "Expected user's accuracy must be given for all classes, or "
+                'for each of the {n} unmasked classes in map; got {u}'.format(
+                    n=classes.size, u=np.size(users_accuracy)))
+        size = variance_sample_size(class_px, users_accuracy, target_se)
+        logger.debug('Estimated sample size is {n}'.format(n=size))
 
     # Determine class counts from allocation type and total sample size
     if allocation is None:
@@ -222,8 +669,7 @@ def sample(image, method,
         if not isinstance(size, int):
             raise TypeError('Must specify sample size if allocation to '
                             'calculate allocation')
-        raise NotImplementedError(
-            "Sorry - haven't added any allocation types")
+        counts = allocate(allocation, size, class_px)
 
     # Or use specified allocation
     elif isinstance(allocation, list):
@@ -236,19 +682,75 @@ def sample(image, method,
         raise TypeError(
             'Allocation must be a str for a method, or a list/np.ndarray')
 
-    # Ensure we found allocation for each class if stratified random
-    if method == 'stratified':
+    # Ensure we found allocation for each class if stratified random, or for
+    # systematic sampling thinned by strata
+    if method == 'stratified' or (method == 'systematic' and
+                                  isinstance(counts, np.ndarray)):
         if classes.size != counts.size:
             raise ValueError(
                 'Sample counts must be given for each unmasked class in map')
 
+    return (classes, class_px, counts)
+
+
+def sample(image, method,
+           size=None, allocation=None,
+           mask=None, order=False, histogram=None, jobs=1,
+           users_accuracy=0.8, target_se=0.01):
+    """
+    Make sampling decisions and perform sampling
+
+    Args:
+      image (np.ndarray or gdal.Band): 2 dimensional array of the image, or
+        the image band to sample block by block without reading it all
+      method (str): Sampling method
+      size (int or str, optional): Total sample size, or 'variance'
+      allocation (str, or list/np.ndarray): Allocation strategy specified as a
+        string, or user specified allocation as list or np.ndarray
+      mask (list or np.ndarray, optional): Values to exclude from `image`
+      order (bool, optional): Order the output by strata, or not
+      histogram (tuple, optional): Sorted classes and pixel counts of `image`
+        (e.g., from the histogram cache). Computed from `image` if not given
+      jobs (int, optional): Number of processes for block by block simple
+        random sampling
+      users_accuracy (float or np.ndarray, optional): Expected user's accuracy
+        for variance based sample size (see `design_sample`)
+      target_se (float, optional): Target standard error of overall accuracy
+        for variance based sample size
+
+    Returns:
+        output (tuple): strata, row numbers, and column numbers
+
+    """
+    # Find map classes within image
+    in_memory = isinstance(image, np.ndarray)
+    if histogram is None:
+        if in_memory:
+            histogram = array_histogram(image)
+        else:
+            histogram = raster_histogram(image)
+
+    # Determine sample counts
+    classes, class_px, counts = design_sample(
+        histogram, method, size=size, allocation=allocation, mask=mask,
+        users_accuracy=users_accuracy, target_se=target_se)
+
     # Perform sample using desired method
     if method == 'stratified':
-        strata, cols, rows = random_stratified(image, classes, counts)
+        if in_memory:
+            strata, cols, rows = random_stratified(image, classes, counts)
+        else:
+            strata, cols, rows = random_stratified_blocks(
+                image, classes, counts)
     elif method == 'random':
-        strata, cols, rows = random_simple(image, classes, counts)
+        if in_memory:
+            strata, cols, rows = random_simple(image, classes, counts)
+        else:
+            strata, cols, rows = random_simple_blocks(
+                image, classes, counts, jobs=jobs)
     elif method == 'systematic':
-        strata, cols, rows = random_systematic(image, classes, counts)
+        strata, cols, rows = random_systematic(image, classes, counts,
+                                               class_px)
 
     # Randomize samples if not ordered
     if order is not True:
@@ -265,42 +767,60 @@ def sample(image, method,
 def write_raster_output(strata, cols, rows, map_ds, output,
                         gdal_frmt='GTiff', ndv=255):
     """
-    """
-    # Init and fill output array with samples
-    raster = np.ones((map_ds.RasterYSize, map_ds.RasterXSize),
-                     dtype=np.uint8) * ndv
+    Write samples to a raster matching `map_ds`, one output block at a time
 
-    for s, c, r in zip(strata, cols, rows):
-        raster[r, c] = s
+    Samples are grouped by output block and only blocks containing samples are
+    written. GeoTIFF output is tiled, compressed and sparse, so blocks without
+    samples are never stored and read back as `ndv`. Other formats are filled
+    with `ndv` by GDAL first.
+    """
+    xsize, ysize = map_ds.RasterXSize, map_ds.RasterYSize
 
     # Get output driver
     driver = gdal.GetDriverByName(gdal_frmt)
 
     # Create output dataset
-    sample_ds = driver.Create(output,
-                              map_ds.RasterXSize, map_ds.RasterYSize, 1,
-                              gdal.GetDataTypeByName('Byte'))
-
-    # Write out band
-    sample_ds.GetRasterBand(1).SetNoDataValue(ndv)
-    sample_ds.GetRasterBand(1).WriteArray(raster)
+    sample_ds = driver.Create(output, xsize, ysize, 1,
+                              gdal.GetDataTypeByName('Byte'),
+                              options=_sparse_options.get(gdal_frmt, []))
 
     # Port over metadata, projection, geotransform, etc
     sample_ds.SetProjection(map_ds.GetProjection())
     sample_ds.SetGeoTransform(map_ds.GetGeoTransform())
     sample_ds.SetMetadata(map_ds.GetMetadata())
 
+    band = sample_ds.GetRasterBand(1)
+    band.SetNoDataValue(ndv)
+    if gdal_frmt not in _sparse_options:
+        band.Fill(ndv)
+
+    # Group samples by output block
+    bx, by = band.GetBlockSize()
+    nbx = -(-xsize // bx)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    block_id = (rows // by) * nbx + cols // bx
+    by_block = np.argsort(block_id, kind='mergesort')
+    ids, starts = np.unique(block_id[by_block], return_index=True)
+
+    # Write out only blocks containing samples
+    for b, index in zip(ids, np.split(by_block, starts[1:])):
+        xoff, yoff = (b % nbx) * bx, (b // nbx) * by
+        block = np.full((min(by, ysize - yoff), min(bx, xsize - xoff)), ndv,
+                        dtype=np.uint8)
+        block[rows[index] - yoff, cols[index] - xoff] = strata[index]
+        band.WriteArray(block, int(xoff), int(yoff))
+
     # Close
+    band = None
     sample_ds = None
 
 
 def write_vector_output(strata, cols, rows, map_ds, output,
                         ogr_frmt='ESRI Shapefile'):
     """
+    Write samples as pixel footprint polygons, encoded and written in bulk
     """
-    # Corners of pixel in pixel coordinates
-    corners = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
-
     # Raster geo-transform
     gt = map_ds.GetGeoTransform()
     # Get OSR spatial reference from raster to give to OGR dataset
@@ -322,32 +842,51 @@ def write_vector_output(strata, cols, rows, map_ds, output,
     # Strata field
     layer.CreateField(ogr.FieldDefn('STRATUM', ogr.OFTInteger))
 
-    # Loop through samples adding to layer
-    for i, (stratum, col, row) in enumerate(zip(strata, cols, rows)):
-        # Feature
-        feature = ogr.Feature(layer.GetLayerDefn())
-        feature.SetField('ID', i)
-        feature.SetField('ROW', row)
-        feature.SetField('COL', col)
-        feature.SetField('STRATUM', stratum)
+    # Add samples to layer in bulk
+    write_features(layer,
+                   [('ID', np.arange(len(strata))),
+                    ('ROW', np.asarray(rows, dtype=np.int64)),
+                    ('COL', np.asarray(cols, dtype=np.int64)),
+                    ('STRATUM', np.asarray(strata, dtype=np.int64))],
+                   pixel_polygons(cols, rows, gt))
 
-        # Geometry
-        ring = ogr.Geometry(type=ogr.wkbLinearRing)
+    layer = None
+    sample_ds = None
 
-        for corner in corners:
-            ring.AddPoint(
-                gt[0] + (col + corner[0]) * gt[1] + (row + corner[1]) * gt[2],
-                gt[3] + (col + corner[1]) * gt[4] + (row + corner[1]) * gt[5])
-        square = ogr.Geometry(type=ogr.wkbPolygon)
-        square.AddGeometry(ring)
 
-        feature.SetGeometry(square)
+def write_table_output(strata, cols, rows, map_ds, output,
+                       classes, class_px, stratified=True):
+    """
+    Write samples to a columnar table with their inclusion probabilities and
+    weights
 
-        layer.CreateFeature(feature)
+    Args:
+      strata, cols, rows (np.ndarray): sample strata and pixel locations
+      map_ds (gdal.Dataset): sampled map
+      output (str): table filename (.arrow, .parquet or .csv)
+      classes (np.ndarray): sorted, unmasked map classes
+      class_px (np.ndarray): pixel count of each class
+      stratified (bool, optional): Samples were drawn independently within
+        each class; otherwise from all unmasked pixels at once
 
-        feature.Destroy()
+    """
+    strata = np.asarray(strata).astype(np.int64)
+    if stratified:
+        index = np.searchsorted(classes, strata)
+        n = np.bincount(index, minlength=classes.size)
+        inclusion = n[index] / class_px[index].astype(np.float64)
+    else:
+        inclusion = np.repeat(strata.size / float(class_px.sum()), strata.size)
 
-    sample_ds = None
+    x, y = pixel_centers(cols, rows, map_ds.GetGeoTransform())
+    write_table(output, [('ID', np.arange(strata.size)),
+                         ('ROW', np.asarray(rows, dtype=np.int64)),
+                         ('COL', np.asarray(cols, dtype=np.int64)),
+                         ('X', x),
+                         ('Y', y),
+                         ('STRATUM', strata),
+                         ('INCLUSION', inclusion),
+                         ('WEIGHT', 1 / inclusion)])
 
 
 def main():
@@ -374,19 +913,36 @@ def main():
     logger.debug('Sampling method is {m}'.format(m=method))
 
     # Sample size
+    size = args['--size']
+    if size.lower() == 'variance':
+        size = 'variance'
+    else:
+        try:
+            size = int(size)
+        except:
+            logger.error("Sample size must be an integer or 'variance'")
+            sys.exit(1)
+    logger.debug('Sample size is {n}'.format(n=size))
+
+    # Parameters for sample size from variance formula
     try:
-        size = int(args['--size'])
+        users_accuracy = np.array([float(u) for u in
+                                   args['--users_accuracy'].replace(
+                                       ',', ' ').split(' ') if u != ''])
+        target_se = float(args['--se'])
     except:
-        logger.error('Sample size must be an integer')
+        logger.error("Expected user's accuracy (--users_accuracy) and "
+                     "target standard error (--se) must be numbers")
         sys.exit(1)
-    logger.debug('Sample size is {n}'.format(n=size))
+    if users_accuracy.size == 1:
+        users_accuracy = users_accuracy[0]
 
     # Test if allocation is built-in; if not then it needs to be list of ints
     allocation = args['--allocation']
     if allocation is None:
-        if method != 'random':
-            logger.error('Must specify allocation for designs other than\
-                simple random sampling')
+        if method == 'stratified':
+            logger.error('Must specify allocation for stratified random '
+                         'sampling')
             sys.exit(1)
     elif args['--allocation'] not in _allocation_methods:
         try:
@@ -400,6 +956,10 @@ def main():
             sys.exit(1)
 
         # Make sure size lines up with how many allocated
+        if size == 'variance':
+            logger.error('Cannot estimate sample size from variance for a '
+                         'specified allocation')
+            sys.exit(1)
         if size != allocation.sum():
             logger.error(
                 'Number of samples in specified allocation {n} does not equal '
@@ -407,9 +967,6 @@ def main():
                                                    s=size))
             sys.exit(1)
 
-    else:
-        raise NotImplementedError("Sorry - haven't added allocation methods")
-
     if allocation is not None:
         logger.debug('Allocation is {a}'.format(a=allocation))
 
@@ -431,6 +988,16 @@ def main():
             sys.exit(1)
     logger.debug('Mask values are {m}'.format(m=mask))
 
+    # Worker processes for block by block simple random sampling
+    try:
+        jobs = int(args['--jobs'])
+    except:
+        logger.error('Number of jobs (--jobs) must be an integer')
+        sys.exit(1)
+    if jobs < 1:
+        logger.error('Number of jobs (--jobs) must be at least 1')
+        sys.exit(1)
+
     # Should we order output by strata?
     order = args['--order']
 
@@ -451,6 +1018,10 @@ def main():
     if output_vector.lower() == 'none':
         output_vector = None
 
+    output_table = args['--table']
+    if output_table.lower() == 'none':
+        output_table = None
+
     # Output drivers
     gdal_frmt = args['--rformat']
     ogr_frmt = args['--vformat']
@@ -509,15 +1080,47 @@ def main():
     except:
         logger.error('Could not open {f}'.format(f=image_fn))
         sys.exit(1)
-    image = image_ds.GetRasterBand(1).ReadAsArray()
-    import pdb; pdb.set_trace()
+    histogram = cached_histogram(image_fn, 1, ds=image_ds)
+
+    # Only report the design if asked; this needs just the histogram
+    if args['--plan']:
+        try:
+            classes, class_px, counts = design_sample(
+                histogram, method, size=size, allocation=allocation,
+                mask=mask, users_accuracy=users_accuracy,
+                target_se=target_se)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        if isinstance(counts, np.ndarray):
+            for c, px, n in zip(classes, class_px, counts):
+                print('Class {c}: {px} pixels, {n} samples'.format(
+                    c=c, px=px, n=n))
+            counts = counts.sum()
+        print('Total sample size: {n}'.format(n=counts))
+        return
+
+    # Systematic samples only read the rows hit by the grid; several jobs
+    # split the map by blocks
+    if args['--blocks'] or jobs > 1 or method == 'systematic':
+        image = image_ds.GetRasterBand(1)
+    else:
+        image = image_ds.GetRasterBand(1).ReadAsArray()
 
     # Do the sampling
-    strata, cols, rows = sample(image, method,
-                                size=size,
-                                allocation=allocation,
-                                mask=mask,
-                                order=order)
+    try:
+        strata, cols, rows = sample(image, method,
+                                    size=size,
+                                    allocation=allocation,
+                                    mask=mask,
+                                    order=order,
+                                    histogram=histogram,
+                                    jobs=jobs,
+                                    users_accuracy=users_accuracy,
+                                    target_se=target_se)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
     logger.debug('Finished collecting samples')
 
     image = None
@@ -533,6 +1136,15 @@ def main():
         write_vector_output(strata, cols, rows,
                             image_ds, output_vector, ogr_frmt)
 
+    if output_table is not None:
+        logger.debug('Writing sample table to {f}'.format(f=output_table))
+        keep = ~np.in1d(histogram[0], mask)
+        stratified = (method == 'stratified' or
+                      (method == 'systematic' and allocation is not None))
+        write_table_output(strata, cols, rows, image_ds, output_table,
+                           histogram[0][keep], histogram[1][keep],
+                           stratified=stratified)
+
     logger.debug('Sampling complete')
 
 if __name__ == '__main__':